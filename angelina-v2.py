@@ -1,9 +1,30 @@
 import os
+import re
+import json
+import asyncio
 import time
+import gzip
+import hashlib
+import queue
+import socket
 import pickle  # Добавь этот импорт в начало файла
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
-from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeout
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeout, Error as PlaywrightError
+from playwright.async_api import async_playwright
 from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 
 
@@ -26,10 +47,33 @@ PAGE_TIMEOUT = int(os.getenv("PAGE_TIMEOUT", "60000"))
 
 # Файлы
 COOKIES_FILE = os.getenv("COOKIES_FILE", "session_cookies.json")
+STORAGE_STATE_FILE = os.getenv("STORAGE_STATE_FILE", "storage_state.json")  # Сохраняется между запусками
 OUTPUT_EXCEL = os.getenv("OUTPUT_EXCEL", "table_container_html.xlsx")
-TEMP_DATA = os.getenv("TEMP_DATA", "temp_parsing_data.pkl")  # Изменено на pickle
-LAST_POSITION_FILE = os.getenv("LAST_POSITION_FILE", "last_position.txt")
+TEMP_DATA = os.getenv("TEMP_DATA", "temp_parsing_data.pkl")  # Старый формат, читается только для переноса в журнал
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "parsing_journal.jsonl")
+JOURNAL_FSYNC_EVERY = int(os.getenv("JOURNAL_FSYNC_EVERY", "20"))  # fsync журнала раз в N порций
+LAST_POSITION_FILE = os.getenv("LAST_POSITION_FILE", "last_position.txt")  # Старый формат, читается, пока индекс позиций пуст
+POSITION_INDEX_DB = os.getenv("POSITION_INDEX_DB", "position_index.sqlite")  # Позиция прокрутки каждой строки, хранится между запусками
+RECRAWL_MARGIN = int(os.getenv("RECRAWL_MARGIN", "1600"))  # Запас вокруг позиции строки при пересборе по коду, px
+SHARD_POSITIONS_FILE = os.getenv("SHARD_POSITIONS_FILE", "shard_positions.json")
 FINAL_EXCEL = os.getenv("FINAL_EXCEL", "результат.xlsx")
+KEEP_TEMP_FILES = os.getenv("KEEP_TEMP_FILES", "false").lower() == "true"  # Не удалять журнал после выгрузки
+STORE_DB = os.getenv("STORE_DB", os.path.splitext(FINAL_EXCEL)[0] + ".sqlite")  # Хранилище, из которого выгружается Excel
+SEARCH_DB = os.getenv("SEARCH_DB", os.path.splitext(FINAL_EXCEL)[0] + "_поиск.sqlite")  # Индекс для поиска из бота
+DELTA_FILE = os.getenv("DELTA_FILE", os.path.splitext(FINAL_EXCEL)[0] + "_изменения.csv")
+DELTA_MIN_COVERAGE = float(os.getenv("DELTA_MIN_COVERAGE", "0.9"))  # Доля прошлого каталога, при которой считаем удаленные
+FINAL_PARQUET = os.getenv("FINAL_PARQUET", os.path.splitext(FINAL_EXCEL)[0] + ".parquet")
+FINAL_CSV = os.getenv("FINAL_CSV", os.path.splitext(FINAL_EXCEL)[0] + ".csv.gz")
+
+
+# Форматы финальной выгрузки через запятую: xlsx, parquet, csv.gz
+EXPORT_FORMATS = [f.strip().lower() for f in os.getenv("EXPORT_FORMATS", "xlsx").split(",") if f.strip()]
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+
+
+# Потоковая обработка журнала: размер порций подбирается под бюджет памяти
+MEMORY_BUDGET_MB = int(os.getenv("MEMORY_BUDGET_MB", "256"))
+PROCESS_CHUNK_ROWS = int(os.getenv("PROCESS_CHUNK_ROWS", "20000"))  # Начальный размер порции, строк
 
 
 # Параметры прокрутки
@@ -40,11 +84,101 @@ MAX_SCROLL_POSITION = int(os.getenv("MAX_SCROLL_POSITION", "725000"))
 RESTART_THRESHOLD = int(os.getenv("RESTART_THRESHOLD", "100000"))
 
 
+# Досрочное завершение: общее число позиций берется из счетчика на странице (CSS селектор)
+# или из поля total в ответах API; без него конец определяется по неизменной высоте внизу таблицы
+TOTAL_COUNT_SELECTOR = os.getenv("TOTAL_COUNT_SELECTOR", "")  # Например: .nomenclatures_total
+TOTAL_COUNT_KEY = os.getenv("TOTAL_COUNT_KEY", "")  # Ключ JSON с размером каталога; пусто - угадывать по TOTAL_COUNT_KEYS
+SCROLL_END_STABLE_STEPS = int(os.getenv("SCROLL_END_STABLE_STEPS", "3"))  # Пустых шагов внизу таблицы до остановки
+
+
+# Удаление уже собранных строк из DOM во время прокрутки (высота сохраняется строкой-заполнителем)
+BOUNDED_DOM = os.getenv("BOUNDED_DOM", "false").lower() == "true"
+
+
+# Параллельный обход: число шардов диапазона прокрутки и сколько браузеров работают одновременно.
+# Каждый шард (и обработчик папок, FOLDER_WORKERS) - поток со своим sync_playwright() и своим Chromium:
+# объекты синхронного API привязаны к создавшему их потоку, один браузер на несколько потоков не разделить,
+# а обход прокруткой синхронный. Цена - память: шард держит свой драйвер Playwright (~130 МБ) и браузер
+# (~200 МБ) против ~160 МБ на еще один контекст в общем браузере (замер на mock-портале, 2000 строк в DOM),
+# то есть около 330 МБ на единицу SHARD_CONCURRENCY.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_CONCURRENCY = int(os.getenv("SHARD_CONCURRENCY", "2"))
+
+
+# Режим ожидания: event - ждать появления новых строк или затишья в DOM/сети, fixed - фиксированные паузы
+WAIT_MODE = os.getenv("WAIT_MODE", "event").lower()
+SCROLL_WAIT_TIMEOUT = float(os.getenv("SCROLL_WAIT_TIMEOUT", "5"))  # Верхняя граница ожидания шага, сек
+SCROLL_QUIET_MS = int(os.getenv("SCROLL_QUIET_MS", "300"))  # Тишина в DOM после новых строк, мс
+SCROLL_IDLE_MS = int(os.getenv("SCROLL_IDLE_MS", "1000"))  # Тишина без новых строк, после которой шаг пустой, мс
+
+
+# Режим извлечения строк: evaluate - разбор только новых строк внутри страницы,
+# html - полный page.content() + BeautifulSoup на каждом шаге (старый режим)
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "evaluate").lower()
+
+
+# Разбор HTML: lxml - быстрый разбор через XPath, bs4 - прежний BeautifulSoup с html.parser
+HTML_PARSER = os.getenv("HTML_PARSER", "lxml").lower()
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 1)))
+
+
+# Режим обхода: scroll - прокрутка таблицы, network - перехват ответов API номенклатур,
+# pipeline - асинхронный конвейер, где прокрутка, разбор и запись журнала идут одновременно,
+# folders - обход по папкам каталога, где заново собираются только изменившиеся папки
+CRAWL_MODE = os.getenv("CRAWL_MODE", "scroll").lower()
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))  # Шагов в очереди между этапами конвейера
+NETWORK_URL_PATTERN = os.getenv("NETWORK_URL_PATTERN", "nomenclature")
+NETWORK_LEARN_STEPS = int(os.getenv("NETWORK_LEARN_STEPS", "5"))
+NETWORK_PAGE_PARAM = os.getenv("NETWORK_PAGE_PARAM", "")  # Пусто - определить автоматически
+NETWORK_SIZE_PARAM = os.getenv("NETWORK_SIZE_PARAM", "")  # Пусто - определить автоматически
+NETWORK_PAGE_SIZE = int(os.getenv("NETWORK_PAGE_SIZE", "500"))
+NETWORK_MAX_PAGES = int(os.getenv("NETWORK_MAX_PAGES", "10000"))
+NETWORK_FIELD_MAP = os.getenv("NETWORK_FIELD_MAP", "")  # Например: id:guid,code:Code,price:Price
+
+
+# Обход по папкам (CRAWL_MODE=folders): отпечаток папки - число позиций и хэш ее первых строк
+FOLDER_SELECTOR = os.getenv("FOLDER_SELECTOR", ".folder_container .folder_item")  # Только конечные папки дерева
+FOLDER_STATE_FILE = os.getenv("FOLDER_STATE_FILE", "folder_state.json")
+FOLDER_WORKERS = int(os.getenv("FOLDER_WORKERS", "2"))  # Браузеров, обходящих папки параллельно (память - см. SHARD_CONCURRENCY)
+FOLDER_FINGERPRINT_ROWS = int(os.getenv("FOLDER_FINGERPRINT_ROWS", "50"))  # Первых строк папки в отпечатке
+FOLDER_MAX_AGE_HOURS = float(os.getenv("FOLDER_MAX_AGE_HOURS", "24"))  # Собирать папку не реже, 0 - только по отпечатку
+
+
+# Отчет о запуске: JSON с метриками этапов и (опционально) textfile для node exporter
+METRICS_REPORT_FILE = os.getenv("METRICS_REPORT_FILE", "run_report.json")  # Пусто - не писать
+METRICS_PROMETHEUS_FILE = os.getenv("METRICS_PROMETHEUS_FILE", "")  # Например: /var/lib/node_exporter/textfile_collector/angelina.prom
+
+
+# Канал событий прогресса для бота: номер файлового дескриптора, куда пишутся строки JSON
+PROGRESS_FD = int(os.getenv("PROGRESS_FD") or -1)  # -1 - не отправлять
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "1"))  # Не чаще раза в N секунд для событий progress
+
+
+# Служба с прогретым браузером (--serve): задания сбора приходят через Unix-сокет
+DAEMON_SOCKET = os.getenv("DAEMON_SOCKET", "angelina.sock")
+DAEMON_HEALTH_INTERVAL = float(os.getenv("DAEMON_HEALTH_INTERVAL", "60"))  # Проверка браузера между заданиями, сек
+DAEMON_REVALIDATE_MINUTES = float(os.getenv("DAEMON_REVALIDATE_MINUTES", "15"))  # Плановая перезагрузка таблицы и проверка сессии
+DAEMON_RECYCLE_RUNS = int(os.getenv("DAEMON_RECYCLE_RUNS", "20"))  # Перезапуск браузера после N заданий, 0 - не перезапускать
+DAEMON_RECYCLE_HOURS = float(os.getenv("DAEMON_RECYCLE_HOURS", "6"))  # Перезапуск браузера по возрасту, 0 - не перезапускать
+
+
 # Браузерные настройки
 HEADLESS = os.getenv("HEADLESS", "true").lower() == "true"
 USER_AGENT = os.getenv("USER_AGENT", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.7049.52 Safari/537.36")
 
 
+# Блокировка ресурсов, не нужных для чтения таблицы
+BLOCK_RESOURCE_TYPES = [t.strip() for t in os.getenv("BLOCK_RESOURCE_TYPES", "image,media,font").split(",") if t.strip()]
+BLOCK_CSS = os.getenv("BLOCK_CSS", "false").lower() == "true"
+BLOCK_THIRD_PARTY_SCRIPTS = os.getenv("BLOCK_THIRD_PARTY_SCRIPTS", "false").lower() == "true"
+TRACKER_DOMAINS = [d.strip() for d in os.getenv(
+    "TRACKER_DOMAINS",
+    "google-analytics.com,googletagmanager.com,doubleclick.net,mc.yandex.ru,an.yandex.ru,"
+    "top-fwz1.mail.ru,connect.facebook.net,vk.com/rtrg,jivosite.com,cdn.carrotquest.io"
+).split(",") if d.strip()]
+BLOCK_ALLOWLIST = [a.strip() for a in os.getenv("BLOCK_ALLOWLIST", "").split(",") if a.strip()]  # Подстроки URL, которые не блокируются
+
+
 # Проверка обязательных переменных
 if not EMAIL or not PASSWORD:
     raise ValueError("⚠️ APP_EMAIL и APP_PASSWORD должны быть указаны в .env файле!")
@@ -55,12 +189,310 @@ print(f"   📧 Email: {EMAIL}")
 print(f"   🌐 Login URL: {LOGIN_URL}")
 print(f"   📋 Nomenclatures URL: {NOMENCLATURES_URL}")
 print(f"   👁️ Headless режим: {HEADLESS}")
+print(f"   🧩 Режим извлечения строк: {EXTRACTION_MODE}")
+print(f"   🛰️ Режим обхода: {CRAWL_MODE}")
+print(f"   🧮 Разбор HTML: {HTML_PARSER}, процессов: {PARSE_WORKERS}")
+print(f"   ⏱️ Режим ожидания: {WAIT_MODE}")
+print(f"   🧹 Ограничение DOM: {BOUNDED_DOM}")
+print(f"   🚫 Блокируемые ресурсы: {', '.join(BLOCK_RESOURCE_TYPES + (['stylesheet'] if BLOCK_CSS else [])) or 'нет'}")
+if SHARD_COUNT > 1:
+    print(f"   🧵 Шардов: {SHARD_COUNT}, одновременно: {SHARD_CONCURRENCY}")
+if CRAWL_MODE == "folders":
+    print(f"   🗂️ Папки: {FOLDER_SELECTOR}, браузеров: {FOLDER_WORKERS}")
+
+
+# --- Метрики запуска ---
+class RunMetrics:
+    """Счетчики, суммарное время этапов и гистограммы шагов прокрутки (потокобезопасно)"""
+    
+    # Границы корзин гистограмм
+    BUCKETS = {
+        'step_seconds': [0.1, 0.25, 0.5, 1, 2, 3, 5, 10],
+        'step_wait_seconds': [0.1, 0.25, 0.5, 1, 2, 3, 5, 10],
+        'step_new_rows': [0, 1, 5, 10, 25, 50, 100, 250]
+    }
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """Начинает отчет заново (служба вызывает перед каждым заданием)"""
+        with self.lock:
+            self.started_at = time.time()
+            self.stages = {}
+            self.counters = {}
+            self.histograms = {}
+            self.status = "running"
+    
+    @contextmanager
+    def stage(self, name):
+        """Засекает время блока и добавляет его к этапу name"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - started)
+    
+    def add_stage(self, name, seconds):
+        """Добавляет уже измеренное время к этапу"""
+        with self.lock:
+            calls, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (calls + 1, total + seconds)
+    
+    def count(self, name, value=1):
+        """Увеличивает счетчик"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def observe(self, name, value):
+        """Добавляет значение в гистограмму"""
+        with self.lock:
+            self.histograms.setdefault(name, []).append(value)
+    
+    def histogram(self, name):
+        """Сводка гистограммы: количество, сумма, перцентили и накопленные корзины"""
+        values = sorted(self.histograms.get(name, []))
+        if not values:
+            return None
+        
+        def percentile(q):
+            return values[min(len(values) - 1, int(q * len(values)))]
+        
+        buckets = {str(bound): sum(1 for v in values if v <= bound) for bound in self.BUCKETS.get(name, [])}
+        buckets['+Inf'] = len(values)
+        return {
+            'count': len(values),
+            'sum': round(sum(values), 4),
+            'mean': round(sum(values) / len(values), 4),
+            'p50': round(percentile(0.5), 4),
+            'p95': round(percentile(0.95), 4),
+            'max': round(values[-1], 4),
+            'buckets': buckets
+        }
+    
+    def report(self):
+        """Собирает отчет о запуске в словарь для JSON"""
+        finished_at = time.time()
+        with self.lock:
+            stages = dict(self.stages)
+            counters = dict(self.counters)
+            names = list(self.histograms)
+        with resource_stats_lock:
+            network = {key: dict(value) for key, value in resource_stats.items()}
+        duration = finished_at - self.started_at
+        return {
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'finished_at': datetime.fromtimestamp(finished_at).isoformat(timespec='seconds'),
+            'duration_seconds': round(duration, 2),
+            'status': self.status,
+            'settings': {
+                'crawl_mode': CRAWL_MODE,
+                'extraction_mode': EXTRACTION_MODE,
+                'html_parser': HTML_PARSER,
+                'wait_mode': WAIT_MODE,
+                'scroll_step': SCROLL_STEP,
+                'shard_count': SHARD_COUNT,
+                'bounded_dom': BOUNDED_DOM,
+                'export_formats': EXPORT_FORMATS
+            },
+            'stages': {
+                name: {
+                    'calls': calls,
+                    'seconds': round(total, 4),
+                    'share': round(total / duration, 4) if duration else None
+                }
+                for name, (calls, total) in sorted(stages.items(), key=lambda x: -x[1][1])
+            },
+            'counters': counters,
+            'histograms': {name: self.histogram(name) for name in names},
+            'network': network
+        }
+    
+    def prometheus_text(self, report):
+        """Переводит отчет в текстовый формат Prometheus"""
+        lines = [
+            "# TYPE angelina_run_duration_seconds gauge",
+            f"angelina_run_duration_seconds {report['duration_seconds']}",
+            "# TYPE angelina_run_finished_timestamp_seconds gauge",
+            f"angelina_run_finished_timestamp_seconds {int(time.time())}",
+            "# TYPE angelina_run_success gauge",
+            f"angelina_run_success {1 if report['status'] == 'ok' else 0}",
+            "# TYPE angelina_stage_seconds_total counter"
+        ]
+        lines += [f'angelina_stage_seconds_total{{stage="{name}"}} {stage["seconds"]}' for name, stage in report['stages'].items()]
+        lines.append("# TYPE angelina_stage_calls_total counter")
+        lines += [f'angelina_stage_calls_total{{stage="{name}"}} {stage["calls"]}' for name, stage in report['stages'].items()]
+        for name, value in sorted(report['counters'].items()):
+            lines.append(f"# TYPE angelina_{name}_total counter")
+            lines.append(f"angelina_{name}_total {value}")
+        for name, histogram in report['histograms'].items():
+            if not histogram:
+                continue
+            lines.append(f"# TYPE angelina_{name} histogram")
+            lines += [f'angelina_{name}_bucket{{le="{bound}"}} {count}' for bound, count in histogram['buckets'].items()]
+            lines.append(f"angelina_{name}_sum {histogram['sum']}")
+            lines.append(f"angelina_{name}_count {histogram['count']}")
+        lines.append("# TYPE angelina_network_bytes_total counter")
+        lines += [
+            f'angelina_network_bytes_total{{type="{resource_type}"}} {size}'
+            for resource_type, size in sorted(report['network']['loaded_bytes'].items())
+        ]
+        lines.append("# TYPE angelina_blocked_requests_total counter")
+        lines += [
+            f'angelina_blocked_requests_total{{category="{category}"}} {count}'
+            for category, count in sorted(report['network']['blocked'].items())
+        ]
+        return "\n".join(lines) + "\n"
+    
+    def write(self, status=None):
+        """Пишет JSON отчет и textfile Prometheus (атомарно, через временный файл)"""
+        if status:
+            self.status = status
+        report = self.report()
+        targets = [
+            (METRICS_REPORT_FILE, lambda: json.dumps(report, ensure_ascii=False, indent=2)),
+            (METRICS_PROMETHEUS_FILE, lambda: self.prometheus_text(report))
+        ]
+        for path, render in targets:
+            if not path:
+                continue
+            try:
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    f.write(render())
+                os.replace(path + ".tmp", path)
+                print(f"📊 Отчет о запуске сохранен в {path}")
+            except Exception as e:
+                print(f"⚠️ Ошибка при сохранении отчета {path}: {e}")
+        return report
+    
+    def print_stages(self, report):
+        """Печатает самые долгие этапы"""
+        if not report['stages']:
+            return
+        print(f"⏱️ Время по этапам (запуск {report['duration_seconds']:.1f}с):")
+        for name, stage in list(report['stages'].items())[:10]:
+            print(f"   {name:<16} {stage['seconds']:>9.2f}с  {stage['calls']:>7} вызовов  {stage['share'] or 0:>6.1%}")
+
+
+metrics = RunMetrics()
+
+
+
+# --- Состояние канала прогресса ---
+progress_channel = {'fd': PROGRESS_FD, 'enabled': PROGRESS_FD >= 0, 'last_sent': 0.0}
+progress_lock = threading.Lock()
+
+
+
+# --- Функция отправки события прогресса ---
+def emit_progress(event, force=True, **fields):
+    """Пишет событие строкой JSON в PROGRESS_FD (или сокет клиента службы); частые события progress прореживаются"""
+    if not progress_channel['enabled']:
+        return
+    with progress_lock:
+        now = time.monotonic()
+        if not force and now - progress_channel['last_sent'] < PROGRESS_INTERVAL:
+            return
+        progress_channel['last_sent'] = now
+        line = json.dumps({'event': event, **fields}, ensure_ascii=False) + "\n"
+        try:
+            os.write(progress_channel['fd'], line.encode('utf-8'))
+        except OSError:
+            # Читатель закрыл канал - продолжаем работу без него
+            progress_channel['enabled'] = False
+
+
+
+# --- Функция открытия индекса позиций ---
+def open_position_index(path=None):
+    """Открывает SQLite индекс: позиция прокрутки каждой строки и прогресс текущего обхода"""
+    conn = sqlite3.connect(path or POSITION_INDEX_DB, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS row_positions "
+        "(row_id TEXT PRIMARY KEY, code TEXT, position INTEGER NOT NULL, seen_at REAL NOT NULL) WITHOUT ROWID"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS row_positions_position ON row_positions(position)")
+    conn.execute("CREATE INDEX IF NOT EXISTS row_positions_code ON row_positions(code)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS crawl_progress "
+        "(name TEXT PRIMARY KEY, position INTEGER NOT NULL, run_started REAL NOT NULL, updated_at REAL NOT NULL)"
+    )
+    return conn
+
+
+
+# --- Функция записи позиций строк в индекс ---
+def record_row_positions(conn, rows, position):
+    """Запоминает, на какой позиции прокрутки встретились строки (последняя встреча побеждает)"""
+    now = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT INTO row_positions (row_id, code, position, seen_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(row_id) DO UPDATE SET code=excluded.code, position=excluded.position, seen_at=excluded.seen_at",
+            [(row[0], row[1] if len(row) > 1 else None, position, now) for row in rows]
+        )
+
+
+
+# --- Функция записи прогресса обхода ---
+def set_progress(conn, position):
+    """Сохраняет позицию последнего пройденного шага; время начала обхода остается от первой записи"""
+    now = time.time()
+    with conn:
+        conn.execute(
+            "INSERT INTO crawl_progress (name, position, run_started, updated_at) VALUES ('scroll', ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET position=excluded.position, updated_at=excluded.updated_at",
+            (position, now, now)
+        )
+
+
+
+# --- Функция чтения позиции последней порции журнала ---
+def journal_tail_position():
+    """Возвращает позицию последней целой порции журнала или None, если журнал пуст"""
+    if not os.path.exists(JOURNAL_FILE):
+        return None
+    with open(JOURNAL_FILE, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - 1048576))
+        lines = f.read().split(b'\n')
+    # Последний элемент - недописанный хвост или пустая строка после перевода строки
+    for line in reversed(lines[:-1]):
+        try:
+            return json.loads(line)['position']
+        except (ValueError, KeyError, TypeError):
+            continue
+    return None
 
 
 
 # --- Функция чтения последней позиции прокрутки ---
 def get_last_position():
-    """Читает последнюю сохраненную позицию прокрутки из файла"""
+    """Возвращает позицию, с которой продолжить обход: последний шаг из индекса позиций"""
+    conn = open_position_index()
+    try:
+        progress = conn.execute("SELECT position, run_started FROM crawl_progress WHERE name = 'scroll'").fetchone()
+        if progress is not None:
+            position, run_started = progress
+            # Шаг попадает в индекс сразу, а журнал сбрасывается на диск раз в JOURNAL_FSYNC_EVERY порций:
+            # строки этого обхода дальше последней порции журнала после сбоя придется собрать заново
+            tail = journal_tail_position()
+            lost = conn.execute(
+                "SELECT MIN(position) FROM row_positions WHERE seen_at >= ? AND position > ?",
+                (run_started, tail if tail is not None else -1)
+            ).fetchone()[0]
+    finally:
+        conn.close()
+    
+    if progress is not None:
+        if lost is not None and lost < position:
+            print(f"⚠️ Строки с позиции {lost}px не дошли до журнала, продолжаем с нее (последний шаг: {position}px)")
+            return lost
+        return position
+    
     if os.path.exists(LAST_POSITION_FILE):
         with open(LAST_POSITION_FILE, "r") as f:
             try:
@@ -73,49 +505,151 @@ def get_last_position():
 
 
 # --- Функция сохранения последней позиции прокрутки ---
-def save_last_position(position):
-    """Сохраняет текущую позицию прокрутки в файл"""
-    with open(LAST_POSITION_FILE, "w") as f:
-        f.write(str(position))
+def save_last_position(position, conn=None):
+    """Сохраняет текущую позицию прокрутки в индекс позиций"""
+    own = conn is None
+    conn = conn or open_position_index()
+    try:
+        set_progress(conn, position)
+    finally:
+        if own:
+            conn.close()
     print(f"💾 Сохранена последняя позиция прокрутки: {position}px")
 
 
 
-# --- Функция сохранения данных в промежуточный файл (PICKLE) ---
-def save_temp_data(data_to_save):
-    """Сохраняет промежуточные данные в pickle файл"""
+# --- Функция сброса прогресса обхода ---
+def clear_last_position():
+    """Удаляет прогресс завершенного обхода; позиции строк остаются для точечного пересбора"""
+    if not os.path.exists(POSITION_INDEX_DB):
+        return
+    conn = open_position_index()
     try:
-        with open(TEMP_DATA, 'wb') as f:
-            pickle.dump(data_to_save, f)
-        print(f"💾 Промежуточные данные сохранены в файл: {TEMP_DATA} ({len(data_to_save)} записей)")
-    except Exception as e:
-        print(f"❌ Ошибка при сохранении промежуточных данных: {e}")
+        with conn:
+            conn.execute("DELETE FROM crawl_progress WHERE name = 'scroll'")
+    finally:
+        conn.close()
+
+
+
+# --- Функция сохранения позиций шардов ---
+def save_shard_positions(positions):
+    """Сохраняет диапазоны и текущие позиции шардов в JSON файл"""
+    with open(SHARD_POSITIONS_FILE, "w") as f:
+        json.dump(positions, f)
+    print(f"💾 Сохранены позиции шардов: " + ", ".join(
+        f"{shard}={info['position']}px" for shard, info in sorted(positions.items(), key=lambda x: int(x[0]))
+    ))
+
+
+
+# --- Функция чтения позиций шардов ---
+def load_shard_positions():
+    """Читает сохраненные диапазоны и позиции шардов"""
+    if os.path.exists(SHARD_POSITIONS_FILE):
+        try:
+            with open(SHARD_POSITIONS_FILE, "r") as f:
+                return json.load(f)
+        except ValueError:
+            print("⚠️ Ошибка чтения позиций шардов, начинаем заново.")
+    return {}
+
+
+
+# --- Функция открытия журнала для дозаписи ---
+def open_journal():
+    """Открывает журнал на дозапись, отрезая недописанную после сбоя последнюю строку"""
+    journal = open(JOURNAL_FILE, 'ab+')
+    size = journal.seek(0, os.SEEK_END)
+    if size:
+        # Ищем последний перевод строки и обрезаем хвост после него
+        tail_start = max(0, size - 65536)
+        while True:
+            journal.seek(tail_start)
+            tail = journal.read(size - tail_start)
+            newline = tail.rfind(b'\n')
+            if newline != -1 or tail_start == 0:
+                break
+            tail_start = max(0, tail_start - 65536)
+        keep = tail_start + newline + 1
+        if keep < size:
+            journal.truncate(keep)
+            print(f"⚠️ В журнале {JOURNAL_FILE} отрезана недописанная запись ({size - keep} байт)")
+        journal.seek(0, os.SEEK_END)
+    return journal
 
 
 
-# --- Функция загрузки промежуточных данных ---
-def load_temp_data():
-    """Загружает промежуточные данные из pickle файла"""
+# --- Функция дозаписи порции данных в журнал ---
+def append_journal(journal, item):
+    """Дописывает порцию разобранных строк в журнал одной строкой JSON"""
+    line = (json.dumps(item, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+    with metrics.stage("journal_write"):
+        journal.write(line)
+    metrics.count("journal_bytes", len(line))
+
+
+
+# --- Функция сброса журнала на диск ---
+def sync_journal(journal):
+    """Сбрасывает буферы журнала и выполняет fsync"""
     try:
-        if os.path.exists(TEMP_DATA):
-            with open(TEMP_DATA, 'rb') as f:
-                data = pickle.load(f)
-            print(f"📂 Загружены промежуточные данные: {len(data)} записей")
-            return data
-        return []
+        with metrics.stage("journal_fsync"):
+            journal.flush()
+            os.fsync(journal.fileno())
     except Exception as e:
-        print(f"⚠️ Ошибка при загрузке промежуточных данных: {e}")
-        return []
+        print(f"❌ Ошибка при сохранении журнала: {e}")
+
+
+
+# --- Функция чтения журнала ---
+def read_journal():
+    """Построчно читает журнал, пропуская поврежденные и недописанные строки"""
+    if not os.path.exists(JOURNAL_FILE):
+        return
+    with open(JOURNAL_FILE, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.endswith(b'\n'):
+                print(f"⚠️ Пропущена недописанная последняя запись журнала (строка {line_number})")
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                print(f"⚠️ Пропущена поврежденная строка журнала {line_number}")
 
 
 
+# --- Функция переноса старого pickle в журнал ---
+def migrate_temp_data():
+    """Переносит промежуточные данные старого формата (pickle с HTML) в журнал"""
+    if not os.path.exists(TEMP_DATA):
+        return
+    try:
+        with open(TEMP_DATA, 'rb') as f:
+            data = pickle.load(f)
+        # Старые HTML блоки разбираются параллельно, готовые строки переносятся как есть
+        blob_indexes = [i for i, item in enumerate(data) if 'rows' not in item]
+        parsed = parse_html_blobs([data[i]['html_content'] for i in blob_indexes])
+        for i, rows in zip(blob_indexes, parsed):
+            data[i] = {'position': data[i]['position'], 'rows': rows}
+        
+        journal = open_journal()
+        for item in data:
+            append_journal(journal, {'position': item['position'], 'rows': item['rows']})
+        sync_journal(journal)
+        journal.close()
+        os.remove(TEMP_DATA)
+        print(f"📦 Промежуточные данные {TEMP_DATA} перенесены в журнал {JOURNAL_FILE} ({len(data)} порций)")
+    except Exception as e:
+        print(f"⚠️ Ошибка при переносе промежуточных данных: {e}")
 
 
 
 # --- Функция удаления временных файлов ---
 def clear_temp_files():
     """Удаляет все временные файлы"""
-    for file in [COOKIES_FILE, TEMP_DATA, LAST_POSITION_FILE]:  # Убрал OUTPUT_EXCEL
+    clear_last_position()
+    for file in [COOKIES_FILE, TEMP_DATA, JOURNAL_FILE, LAST_POSITION_FILE, SHARD_POSITIONS_FILE]:  # Убрал OUTPUT_EXCEL
         if os.path.exists(file):
             try:
                 os.remove(file)
@@ -144,264 +678,2467 @@ def remove_folder_container(page):
 
 
 
-# --- Функция обработки HTML и создания финального Excel ---
-def process_html_to_excel(output_file=None):
-    """Обрабатывает HTML из pickle файла и создает финальный Excel"""
-    if output_file is None:
-        output_file = FINAL_EXCEL
-        
-    print(f"🔄 Обработка HTML данных и создание файла {output_file}...")
-    try:
-        # Загружаем данные из pickle
-        data_list = load_temp_data()
-        if not data_list:
-            print("❌ Нет данных для обработки")
-            return
-        
-        data = {
-            'Код номенклатуры': [],
-            'Наименование товара': [],
-            'Полное наименование': [],
-            'Остаток': [],
-            'Цена (руб)': [],
-            'НТД': [],
-            'Марка стали': [],
-            'Вес': []
-        }
-        
-        def clean_price(price):
-            """Очищает цену от запятых и преобразует в float"""
+# Колонки финальной таблицы
+COLUMNS = [
+    'Код номенклатуры',
+    'Наименование товара',
+    'Полное наименование',
+    'Остаток',
+    'Цена (руб)',
+    'НТД',
+    'Марка стали',
+    'Вес'
+]
+
+
+# --- Скрипт извлечения новых строк таблицы внутри страницы ---
+# Множество уже собранных id хранится в window, наружу возвращаются только новые строки
+# в виде массивов [id, код, наименование, полное наименование, остаток, цена, НТД, марка стали, вес].
+# Для строк, в которых меньше 8 ячеек, возвращается только [id].
+EXTRACT_NEW_ROWS_JS = """
+    (seedIds) => {
+        if (!window.__angelinaSeenIds) {
+            window.__angelinaSeenIds = new Set();
+        }
+        const seen = window.__angelinaSeenIds;
+        if (seedIds) {
+            for (const id of seedIds) {
+                seen.add(id);
+            }
+        }
+        const copyText = (cell) => {
+            const span = cell.querySelector('div.row_width_copy span');
+            return span ? span.textContent.trim() : '';
+        };
+        const rows = [];
+        for (const tr of document.querySelectorAll('.table_container tr[id]')) {
+            if (seen.has(tr.id)) {
+                continue;
+            }
+            seen.add(tr.id);
+            const cells = tr.querySelectorAll('td');
+            if (cells.length < 8) {
+                rows.push([tr.id]);
+                continue;
+            }
+            rows.push([
+                tr.id,
+                cells[0].textContent.trim(),
+                copyText(cells[1]),
+                copyText(cells[2]),
+                cells[3].textContent.trim(),
+                copyText(cells[4]) || '0',
+                cells[5].textContent.trim(),
+                cells[6].textContent.trim(),
+                cells[7].textContent.trim()
+            ]);
+        }
+        return rows;
+    }
+"""
+
+
+
+# --- Скрипт пометки строк выше видимой области как уже просмотренных ---
+# Таблица не виртуализирует строки: после перемотки в DOM остаются все строки выше цели.
+# Их id добавляются в множество страницы, чтобы первое извлечение не собрало их заново.
+SKIP_ROWS_ABOVE_JS = """
+    () => {
+        if (!window.__angelinaSeenIds) {
+            window.__angelinaSeenIds = new Set();
+        }
+        const container = document.querySelector('.main_content_container');
+        const viewportTop = container ? container.getBoundingClientRect().top : 0;
+        const skipped = [];
+        for (const tr of document.querySelectorAll('.table_container tr[id]')) {
+            if (tr.getBoundingClientRect().bottom <= viewportTop) {
+                window.__angelinaSeenIds.add(tr.id);
+                skipped.push(tr.id);
+            }
+        }
+        return skipped;
+    }
+"""
+
+
+
+# --- Функция пропуска строк выше позиции перемотки ---
+def skip_rows_above(page):
+    """Помечает строки выше видимой области просмотренными и возвращает их id"""
+    return set(page.evaluate(SKIP_ROWS_ABOVE_JS))
+
+
+
+# --- Функция извлечения новых строк через page.evaluate ---
+def extract_new_rows(page, seed_ids=None):
+    """Возвращает новые строки таблицы, разобранные прямо в странице"""
+    return page.evaluate(EXTRACT_NEW_ROWS_JS, list(seed_ids) if seed_ids else None)
+
+
+
+# --- Предкомпилированные XPath для разбора строк через lxml ---
+ROWS_XPATH = etree.XPath('//tr[@id]')
+TABLE_CONTAINER_ROWS_XPATH = etree.XPath(
+    '(//div[contains(concat(" ", normalize-space(@class), " "), " table_container ")])[1]//tr[@id]'
+)
+CELLS_XPATH = etree.XPath('.//td')
+COPY_SPAN_XPATH = etree.XPath(
+    '(.//div[contains(concat(" ", normalize-space(@class), " "), " row_width_copy ")])[1]/descendant::span[1]'
+)
+TEXT_XPATH = etree.XPath('string()')
+
+
+
+# --- Функция разбора одной строки таблицы (lxml) ---
+def lxml_row(row):
+    """Извлекает id и все восемь колонок строки за один проход по ячейкам"""
+    cells = CELLS_XPATH(row)
+    if len(cells) < 8:
+        return [row.get('id')]
+    
+    def copy_text(cell, default):
+        spans = COPY_SPAN_XPATH(cell)
+        return TEXT_XPATH(spans[0]).strip() if spans else default
+    
+    return [
+        row.get('id'),
+        TEXT_XPATH(cells[0]).strip(),
+        copy_text(cells[1], ''),
+        copy_text(cells[2], ''),
+        TEXT_XPATH(cells[3]).strip(),
+        copy_text(cells[4], '0'),
+        TEXT_XPATH(cells[5]).strip(),
+        TEXT_XPATH(cells[6]).strip(),
+        TEXT_XPATH(cells[7]).strip()
+    ]
+
+
+
+# --- Функция разбора одной строки таблицы (BeautifulSoup) ---
+def bs4_row(row):
+    """Извлекает id и колонки строки прежним способом через find/find_all"""
+    cells = row.find_all('td')
+    if len(cells) < 8:
+        return [row['id']]
+    
+    shortname_div = cells[1].find('div', class_='row_width_copy')
+    fullname_div = cells[2].find('div', class_='row_width_copy')
+    price_div = cells[4].find('div', class_='row_width_copy')
+    return [
+        row['id'],
+        cells[0].text.strip(),
+        shortname_div.find('span').text.strip() if shortname_div and shortname_div.find('span') else '',
+        fullname_div.find('span').text.strip() if fullname_div and fullname_div.find('span') else '',
+        cells[3].text.strip(),
+        price_div.find('span').text.strip() if price_div and price_div.find('span') else '0',
+        cells[5].text.strip(),
+        cells[6].text.strip(),
+        cells[7].text.strip()
+    ]
+
+
+
+# --- Функция разбора строк таблицы из HTML ---
+def parse_html_rows(html_content, parser=None):
+    """Разбирает HTML в сырые строки [id, значения ячеек...] выбранным движком"""
+    parser = parser or HTML_PARSER
+    if parser == "lxml":
+        if not html_content.strip():
+            return []
+        return [lxml_row(row) for row in ROWS_XPATH(lxml_html.fromstring(html_content))]
+    soup = BeautifulSoup(html_content, 'html.parser')
+    return [bs4_row(row) for row in soup.find_all('tr', id=True)]
+
+
+
+# --- Функция разбора строк внутри table_container целой страницы ---
+def parse_table_container_rows(html_content, parser=None):
+    """Разбирает строки tr[id] первого .table_container из полного HTML страницы"""
+    parser = parser or HTML_PARSER
+    if parser == "lxml":
+        return [lxml_row(row) for row in TABLE_CONTAINER_ROWS_XPATH(lxml_html.fromstring(html_content))]
+    table_container = BeautifulSoup(html_content, 'html.parser').find('div', class_='table_container')
+    if not table_container:
+        return []
+    return [bs4_row(row) for row in table_container.find_all('tr', id=True)]
+
+
+
+# --- Функция параллельного разбора набора HTML блоков ---
+def parse_html_blobs(blobs, parser=None, workers=None):
+    """Разбирает HTML блоки в пуле процессов и возвращает списки строк в исходном порядке"""
+    parser = parser or HTML_PARSER
+    workers = workers or PARSE_WORKERS
+    if workers <= 1 or len(blobs) < 2:
+        return [parse_html_rows(blob, parser) for blob in blobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(blobs) // (workers * 4))
+        return list(executor.map(parse_html_rows, blobs, [parser] * len(blobs), chunksize=chunksize))
+
+
+
+# --- Функция получения сырых строк из элемента промежуточных данных ---
+def item_rows(item):
+    """Возвращает сырые строки элемента: готовые из evaluate или разобранные из HTML"""
+    if 'rows' in item:
+        return item['rows']
+    return parse_html_rows(item['html_content'])
+
+
+
+# --- Скрипт удаления собранных строк выше видимой области ---
+# Высота удаленных строк переносится в строку-заполнитель, чтобы позиция прокрутки не сдвигалась
+EVICT_ROWS_JS = """
+    () => {
+        const container = document.querySelector('.main_content_container');
+        const viewportTop = container ? container.getBoundingClientRect().top : 0;
+        
+        // Сначала читаем геометрию, потом меняем DOM, чтобы не пересчитывать раскладку на каждой строке
+        const evicted = [];
+        for (const tr of document.querySelectorAll('.table_container tr[id]')) {
+            const rect = tr.getBoundingClientRect();
+            if (rect.bottom < viewportTop) {
+                evicted.push([tr, rect.height]);
+            }
+        }
+        
+        for (const [tr, height] of evicted) {
+            const parent = tr.parentNode;
+            let spacer = parent.querySelector(':scope > tr.angelina_spacer');
+            if (!spacer) {
+                spacer = document.createElement('tr');
+                spacer.className = 'angelina_spacer';
+                spacer.dataset.height = '0';
+                const cell = document.createElement('td');
+                cell.colSpan = 100;
+                cell.style.padding = '0';
+                cell.style.border = '0';
+                spacer.appendChild(cell);
+                parent.insertBefore(spacer, tr);
+            }
+            const total = parseFloat(spacer.dataset.height) + height;
+            spacer.dataset.height = String(total);
+            spacer.style.height = total + 'px';
+            tr.remove();
+        }
+        return evicted.length;
+    }
+"""
+
+
+
+# --- Функция построения типизированной порции записей ---
+def records_frame(rows):
+    """Векторно превращает сырые строки [id, значения ячеек...] в DataFrame с компактными типами"""
+    values = [row[1:] for row in rows if len(row) > 1]
+    raw = pd.DataFrame(values, columns=COLUMNS, dtype=object)
+    # Нечисловые значения становятся нулями; дробный остаток ("2.5") тоже считается нулем, а "2.0" - двойкой
+    stock = pd.to_numeric(raw['Остаток'], errors='coerce')
+    stock = stock.where(stock % 1 == 0)
+    # astype молча заворачивает значения вне диапазона типа в отрицательный остаток:
+    # больше int32 - храним в int64, больше int64 - это не остаток, а испорченная ячейка
+    oversized = stock.abs() >= 2.0 ** 63
+    if oversized.any():
+        print(f"⚠️ Остаток вне диапазона int64 в {oversized.sum()} строках (например, код "
+              f"{raw['Код номенклатуры'][oversized].iloc[0]}), записан как 0")
+        stock = stock.mask(oversized)
+    wide = stock.abs() >= 2.0 ** 31
+    if wide.any():
+        print(f"⚠️ Остаток больше int32 в {wide.sum()} строках (например, код "
+              f"{raw['Код номенклатуры'][wide].iloc[0]}), порция хранится в int64")
+    price = pd.to_numeric(raw['Цена (руб)'].str.replace(',', '.', regex=False), errors='coerce')
+    return pd.DataFrame({
+        'Код номенклатуры': raw['Код номенклатуры'],
+        'Наименование товара': raw['Наименование товара'],
+        'Полное наименование': raw['Полное наименование'],
+        'Остаток': stock.fillna(0).astype('int64' if wide.any() else 'int32'),
+        'Цена (руб)': price.fillna(0.0).astype('float64'),
+        'НТД': raw['НТД'].astype('category'),
+        'Марка стали': raw['Марка стали'].astype('category'),
+        'Вес': pd.to_numeric(raw['Вес'], errors='coerce').fillna(0.0).astype('float64')
+    })
+
+
+
+# Во сколько раз пик памяти на порцию больше самой порции (сырые списки, DataFrame, копия для SQLite)
+CHUNK_MEMORY_FACTOR = 6
+
+
+
+# --- Функция подбора размера порции под бюджет памяти ---
+def fit_chunk_rows(chunk):
+    """Оценивает байты на строку по готовой порции и возвращает размер порции в пределах MEMORY_BUDGET_MB"""
+    bytes_per_row = chunk.memory_usage(deep=True).sum() / max(1, len(chunk))
+    rows = int(MEMORY_BUDGET_MB * 1024 * 1024 / (bytes_per_row * CHUNK_MEMORY_FACTOR))
+    return min(500000, max(1000, rows))
+
+
+
+# --- Функция потокового чтения журнала порциями записей ---
+def journal_record_chunks(stats):
+    """Читает журнал построчно и отдает типизированные порции записей, не держа весь журнал в памяти"""
+    chunk_rows = PROCESS_CHUNK_ROWS
+    batch = []
+    for item in read_journal():
+        rows = item_rows(item)
+        stats['items'] += 1
+        stats['raw_rows'] += len(rows)
+        batch.extend(rows)
+        if len(batch) >= chunk_rows:
+            chunk = records_frame(batch)
+            batch = []
+            fitted = fit_chunk_rows(chunk)
+            if fitted != chunk_rows and stats['chunks'] == 0:
+                print(f"📐 Размер порции под бюджет {MEMORY_BUDGET_MB} МБ: {fitted} строк")
+            chunk_rows = fitted
+            stats['chunks'] += 1
+            stats['records'] += len(chunk)
+            yield chunk
+    if batch:
+        chunk = records_frame(batch)
+        stats['chunks'] += 1
+        stats['records'] += len(chunk)
+        yield chunk
+
+
+
+# --- Функция удаления уже собранных строк таблицы из DOM ---
+def evict_harvested_rows(page):
+    """Удаляет собранные строки выше видимой области, заменяя их высоту строкой-заполнителем"""
+    try:
+        return page.evaluate(EVICT_ROWS_JS)
+    except Exception as e:
+        print(f"⚠️ Ошибка при удалении собранных строк из DOM: {e}")
+        return 0
+
+
+
+# --- Функция потоковой записи Excel ---
+def write_excel_streaming(chunks, path):
+    """Пишет таблицу в xlsx в режиме write-only порциями строк, не держа лист в памяти"""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    header_written = False
+    rows = 0
+    for chunk in chunks:
+        if not header_written:
+            header = []
+            for column in chunk.columns:
+                cell = WriteOnlyCell(sheet, value=column)
+                cell.font = Font(bold=True)
+                header.append(cell)
+            sheet.append(header)
+            header_written = True
+        # Пустые значения (NaN) в Excel пишутся пустыми ячейками
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        for row in chunk.itertuples(index=False, name=None):
+            sheet.append(row)
+        rows += len(chunk)
+    
+    temp_path = path + ".tmp"
+    workbook.save(temp_path)
+    os.replace(temp_path, path)
+    return rows
+
+
+
+# --- Функция записи Parquet ---
+def write_parquet(chunks, path):
+    """Пишет таблицу в Parquet порциями (нужен pyarrow)"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("⚠️ Для выгрузки в Parquet установите pyarrow: pip install pyarrow")
+        return 0
+    
+    temp_path = path + ".tmp"
+    writer = None
+    rows = 0
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(temp_path, table.schema, compression='zstd')
+            writer.write_table(table.cast(writer.schema))
+            rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.replace(temp_path, path)
+    return rows
+
+
+
+# --- Функция записи сжатого CSV ---
+def write_csv_gz(chunks, path):
+    """Пишет таблицу в CSV, сжатый gzip, порциями"""
+    temp_path = path + ".tmp"
+    rows = 0
+    with gzip.open(temp_path, 'wt', encoding='utf-8', newline='', compresslevel=6) as f:
+        for chunk in chunks:
+            chunk.to_csv(f, index=False, header=rows == 0)
+            rows += len(chunk)
+    os.replace(temp_path, path)
+    return rows
+
+
+
+# --- Функция выгрузки результата во все выбранные форматы ---
+def export_results(chunk_factory, excel_file=None):
+    """Параллельно пишет результат в форматы из EXPORT_FORMATS; chunk_factory() отдает порции DataFrame"""
+    targets = {
+        'xlsx': (write_excel_streaming, excel_file or FINAL_EXCEL),
+        'parquet': (write_parquet, FINAL_PARQUET),
+        'csv.gz': (write_csv_gz, FINAL_CSV)
+    }
+    formats = [f for f in EXPORT_FORMATS if f in targets]
+    for unknown in set(EXPORT_FORMATS) - set(targets):
+        print(f"⚠️ Неизвестный формат выгрузки: {unknown}")
+    
+    def run(export_format):
+        writer, path = targets[export_format]
+        started = time.monotonic()
+        rows = writer(chunk_factory(), path)
+        metrics.add_stage(f"export_{export_format}", time.monotonic() - started)
+        if rows:
+            print(f"💾 Таблица сохранена в {path} ({rows} строк, {time.monotonic() - started:.1f}с)")
+    
+    with ThreadPoolExecutor(max_workers=max(1, len(formats))) as executor:
+        for future in [executor.submit(run, export_format) for export_format in formats]:
+            future.result()
+
+
+
+# --- Колонки хранилища: имя в SQLite, колонка таблицы и тип ---
+STORE_FIELDS = [
+    ('code', 'Код номенклатуры', 'TEXT PRIMARY KEY'),
+    ('shortname', 'Наименование товара', 'TEXT'),
+    ('fullname', 'Полное наименование', 'TEXT'),
+    ('stock', 'Остаток', 'INTEGER'),
+    ('price', 'Цена (руб)', 'REAL'),
+    ('ntd', 'НТД', 'TEXT'),
+    ('steel', 'Марка стали', 'TEXT'),
+    ('weight', 'Вес', 'REAL')
+]
+
+
+
+# --- Функция создания таблицы номенклатур ---
+def create_nomenclatures_table(conn, table="nomenclatures", temp=False):
+    """Создает таблицу со схемой STORE_FIELDS (временную - для промежуточных данных)"""
+    columns = ", ".join(f"{name} {sql_type}" for name, _, sql_type in STORE_FIELDS)
+    conn.execute(f"CREATE {'TEMP ' if temp else ''}TABLE IF NOT EXISTS {table} ({columns}) WITHOUT ROWID")
+
+
+
+# --- Функция открытия хранилища ---
+def open_store(path=None):
+    """Открывает SQLite хранилище номенклатур (WAL), создавая таблицу при необходимости"""
+    conn = sqlite3.connect(path or STORE_DB)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # Временные таблицы - на диске, кэш страниц - в пределах четверти бюджета памяти
+    conn.execute("PRAGMA temp_store=FILE")
+    conn.execute(f"PRAGMA cache_size=-{MEMORY_BUDGET_MB * 1024 // 4}")
+    create_nomenclatures_table(conn)
+    # Отметка о пропаже с портала: строка остается в выгрузке, но не попадает в прошлый снимок отчета
+    if 'removed_at' not in [row[1] for row in conn.execute("PRAGMA table_info(nomenclatures)")]:
+        conn.execute("ALTER TABLE nomenclatures ADD COLUMN removed_at REAL")
+    return conn
+
+
+
+# --- Функция пакетного upsert записей ---
+def upsert_records(conn, df, batch_size=5000, table="nomenclatures"):
+    """Вставляет новые и обновляет существующие записи по коду номенклатуры"""
+    names = [name for name, _, _ in STORE_FIELDS]
+    updates = ", ".join(f"{name}=excluded.{name}" for name in names[1:])
+    sql = (
+        f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+        f"ON CONFLICT(code) DO UPDATE SET {updates}"
+    )
+    df = df[[column for _, column, _ in STORE_FIELDS]]
+    df = df.astype(object).where(df.notna(), None)
+    with conn:
+        for start in range(0, len(df), batch_size):
+            conn.executemany(sql, df.iloc[start:start + batch_size].itertuples(index=False, name=None))
+
+
+
+# --- Функция переноса промежуточной таблицы в хранилище ---
+def merge_staging(conn, staging="staging"):
+    """Одним запросом upsert-ит все записи промежуточной таблицы в nomenclatures"""
+    names = ", ".join(name for name, _, _ in STORE_FIELDS)
+    # Код снова встретился на портале - снимаем отметку о пропаже
+    updates = ", ".join([f"{name}=excluded.{name}" for name, _, _ in STORE_FIELDS[1:]] + ["removed_at=NULL"])
+    with conn:
+        # WHERE true нужен SQLite, чтобы отличить ON CONFLICT от условия соединения
+        conn.execute(
+            f"INSERT INTO nomenclatures ({names}) SELECT {names} FROM {staging} WHERE true "
+            f"ON CONFLICT(code) DO UPDATE SET {updates}"
+        )
+
+
+
+# --- Функция отметки пропавших с портала записей ---
+def mark_removed_codes(conn, codes):
+    """Отмечает записи с указанными кодами как пропавшие с портала, не удаляя их"""
+    now = time.time()
+    with conn:
+        conn.executemany("UPDATE nomenclatures SET removed_at = ? WHERE code = ?", [(now, code) for code in codes])
+
+
+
+# --- Функция подсчета записей в хранилище ---
+def store_count(conn, table="nomenclatures"):
+    """Возвращает количество записей в хранилище"""
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+
+# --- Функция первичного заполнения хранилища из Excel ---
+def bootstrap_store(conn, excel_file):
+    """Один раз переносит существующий Excel в пустое хранилище"""
+    if store_count(conn) or not os.path.exists(excel_file):
+        return
+    print(f"📂 Хранилище пустое, переносим существующий файл {excel_file}...")
+    existing_df = pd.read_excel(excel_file, engine='openpyxl', dtype={'Код номенклатуры': str})
+    upsert_records(conn, existing_df)
+    print(f"📋 Перенесено записей: {len(existing_df)}")
+
+
+
+# --- Функция чтения хранилища порциями ---
+def store_chunks(path=None, chunk_rows=None):
+    """Отдает содержимое хранилища порциями DataFrame, отсортированными по коду"""
+    select = ", ".join(f'{name} AS "{column}"' for name, column, _ in STORE_FIELDS)
+    conn = sqlite3.connect(path or STORE_DB)
+    try:
+        yield from pd.read_sql_query(
+            f"SELECT {select} FROM nomenclatures ORDER BY code", conn, chunksize=chunk_rows or EXPORT_CHUNK_ROWS
+        )
+    finally:
+        conn.close()
+
+
+
+# --- Функция выгрузки хранилища в файлы ---
+def export_store(output_file=None):
+    """Материализует хранилище в Excel и другие форматы из EXPORT_FORMATS"""
+    output_file = output_file or FINAL_EXCEL
+    open_store().close()
+    export_results(lambda: store_chunks(), output_file)
+
+
+
+# --- Функция построения поискового индекса ---
+def build_search_index(path=None, store_path=None):
+    """Собирает из хранилища файл поиска: точный по коду и триграммный по названиям, марке стали и НТД"""
+    path = path or SEARCH_DB
+    temp_path = path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    
+    names = ", ".join(name for name, _, _ in STORE_FIELDS)
+    columns = ", ".join(
+        f"{name} {'TEXT NOT NULL UNIQUE' if name == 'code' else sql_type}" for name, _, sql_type in STORE_FIELDS
+    )
+    conn = sqlite3.connect(temp_path)
+    try:
+        # Файл собирается с нуля и подменяется целиком, журнал транзакций не нужен
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("ATTACH DATABASE ? AS store", (store_path or STORE_DB,))
+        # lower() в SQLite меняет регистр только латиницы - кириллицу приводим в Python
+        conn.create_function("casefold", 1, lambda text: text.lower(), deterministic=True)
+        # Уникальный индекс по коду - точный поиск за один спуск по B-дереву,
+        # id нужен FTS5 как rowid внешней таблицы содержимого;
+        # search_text - все текстовые поля в нижнем регистре для слов короче триграммы
+        conn.execute(f"CREATE TABLE items (id INTEGER PRIMARY KEY, {columns}, search_text TEXT)")
+        conn.execute(
+            f"INSERT INTO items ({names}, search_text) SELECT {names}, casefold("
+            "coalesce(shortname, '') || ' ' || coalesce(fullname, '') || ' ' || "
+            "coalesce(steel, '') || ' ' || coalesce(ntd, '')) FROM store.nomenclatures ORDER BY code"
+        )
+        conn.execute(
+            "CREATE VIRTUAL TABLE search USING fts5(shortname, fullname, steel, ntd, "
+            "content='items', content_rowid='id', tokenize='trigram')"
+        )
+        conn.execute("INSERT INTO search(search) VALUES('rebuild')")
+        conn.execute("INSERT INTO search(search) VALUES('optimize')")
+        conn.commit()
+        conn.execute("DETACH DATABASE store")
+        count = store_count(conn, "items")
+    finally:
+        conn.close()
+    
+    # Бот держит старый файл открытым, пока не заметит новый: замена атомарная
+    os.replace(temp_path, path)
+    return count
+
+
+
+# --- Функция чтения прошлого снимка цен и остатков ---
+def load_store_snapshot(conn, table="nomenclatures"):
+    """Читает из хранилища код, цену и остаток всех записей (кроме уже отмеченных пропавшими)"""
+    where = " WHERE removed_at IS NULL" if table == "nomenclatures" else ""
+    return pd.read_sql_query(
+        f'SELECT code AS "Код номенклатуры", price AS "Цена (руб)", stock AS "Остаток" FROM {table}{where}', conn
+    )
+
+
+
+# --- Функция расчета изменений между снимками ---
+def compute_delta(previous_df, new_df, include_removed=True):
+    """Векторно сравнивает снимки и возвращает добавленные, удаленные и изменившиеся коды"""
+    key = 'Код номенклатуры'
+    merged = previous_df.merge(
+        new_df[[key, 'Цена (руб)', 'Остаток']], on=key, how='outer', suffixes=(' было', ' стало'), indicator=True
+    )
+    price_old, price_new = merged['Цена (руб) было'].to_numpy(float), merged['Цена (руб) стало'].to_numpy(float)
+    stock_old, stock_new = merged['Остаток было'].to_numpy(float), merged['Остаток стало'].to_numpy(float)
+    both = (merged['_merge'] == 'both').to_numpy()
+    changed = both & (
+        ~np.isclose(price_old, price_new, equal_nan=True) | ~np.isclose(stock_old, stock_new, equal_nan=True)
+    )
+    added = (merged['_merge'] == 'right_only').to_numpy()
+    removed = (merged['_merge'] == 'left_only').to_numpy() & include_removed
+    
+    merged['Статус'] = np.select([added, removed, changed], ['добавлен', 'удален', 'изменен'], default='')
+    merged['Изменение цены'] = price_new - price_old
+    merged['Изменение остатка'] = stock_new - stock_old
+    delta = merged[merged['Статус'] != ''].drop(columns='_merge')
+    return delta[[
+        key, 'Статус', 'Цена (руб) было', 'Цена (руб) стало', 'Изменение цены',
+        'Остаток было', 'Остаток стало', 'Изменение остатка'
+    ]].sort_values(key).reset_index(drop=True)
+
+
+
+# --- Функция записи отчета об изменениях ---
+def write_delta_report(previous_df, new_df, delta_file=None, include_removed=None):
+    """Считает изменения цен и остатков относительно прошлого снимка и пишет компактный CSV"""
+    delta_file = delta_file or DELTA_FILE
+    if previous_df.empty:
+        print("ℹ️ Прошлого снимка нет, отчет об изменениях не создается")
+        return None
+    
+    if include_removed is None:
+        # Удаленные считаем только если сбор покрыл почти весь прошлый каталог
+        coverage = len(new_df) / len(previous_df)
+        include_removed = coverage >= DELTA_MIN_COVERAGE
+        if not include_removed:
+            print(f"⚠️ Собрано {coverage:.0%} прошлого каталога, удаленные позиции в отчет не включаются")
+    elif not include_removed:
+        print("ℹ️ Сбор покрыл только часть каталога, удаленные позиции в отчет не включаются")
+    
+    delta = compute_delta(previous_df, new_df, include_removed)
+    delta.to_csv(delta_file, index=False, encoding='utf-8')
+    counts = delta['Статус'].value_counts()
+    print(f"📈 Отчет об изменениях сохранен в {delta_file}: "
+          f"добавлено {counts.get('добавлен', 0)}, удалено {counts.get('удален', 0)}, изменено {counts.get('изменен', 0)}")
+    return delta
+
+
+
+# Примерный объем памяти на одну позицию при сравнении снимков (код, цена, остаток в двух таблицах и merge)
+DELTA_BYTES_PER_ROW = 400
+
+
+
+# --- Функция переноса промежуточной таблицы с отчетом об изменениях ---
+def merge_staging_with_delta(conn, unique_records, include_removed=None, delta_file=None):
+    """Пишет отчет об изменениях, отмечает пропавшие коды и переносит staging в хранилище; возвращает число записей до переноса"""
+    # Отчет об изменениях сравнивает только код, цену и остаток
+    count_before = store_count(conn)
+    with metrics.stage("delta_report"):
+        delta_mb = (count_before + unique_records) * DELTA_BYTES_PER_ROW / (1024 * 1024)
+        if delta_mb > MEMORY_BUDGET_MB:
+            print(f"⚠️ Отчет об изменениях пропущен: нужно ≈{delta_mb:.0f} МБ при бюджете {MEMORY_BUDGET_MB} МБ")
+        else:
+            delta = write_delta_report(
+                load_store_snapshot(conn), load_store_snapshot(conn, "staging"), delta_file, include_removed
+            )
+            # Пропавшие коды только отмечаются: неполный сбор не должен стирать записи из результата,
+            # а отметка не дает следующим сборам снова сообщать о тех же кодах как об удаленных
+            if delta is not None:
+                removed_codes = delta.loc[delta['Статус'] == 'удален', 'Код номенклатуры']
+                if len(removed_codes):
+                    mark_removed_codes(conn, removed_codes)
+                    print(f"🏷️ Отмечено записей, пропавших с портала: {len(removed_codes)}")
+    
+    with metrics.stage("store_upsert"):
+        merge_staging(conn)
+    return count_before
+
+
+
+# --- Функция обработки HTML и создания финального Excel ---
+def process_html_to_excel(output_file=None, include_removed=None):
+    """Потоково переносит строки из журнала в хранилище и создает финальный Excel; возвращает True при успехе"""
+    if output_file is None:
+        output_file = FINAL_EXCEL
+        
+    print(f"🔄 Обработка HTML данных и создание файла {output_file}...")
+    try:
+        migrate_temp_data()
+        if not os.path.exists(JOURNAL_FILE):
+            print("❌ Нет данных для обработки")
+            return False
+        
+        conn = open_store()
+        try:
+            with metrics.stage("store_bootstrap"):
+                bootstrap_store(conn, output_file)
+            
+            # Журнал порциями переносится во временную таблицу: дубликаты по коду схлопывает
+            # SQLite (побеждает последняя запись), в памяти одновременно только одна порция
+            print(f"📊 Потоковый разбор журнала (бюджет памяти {MEMORY_BUDGET_MB} МБ)...")
+            stats = {'items': 0, 'raw_rows': 0, 'records': 0, 'chunks': 0}
+            create_nomenclatures_table(conn, "staging", temp=True)
+            with metrics.stage("process_parse"):
+                for chunk in journal_record_chunks(stats):
+                    upsert_records(conn, chunk, table="staging")
+            unique_records = store_count(conn, "staging")
+            if not unique_records:
+                print("❌ Нет данных для обработки")
+                return False
+            removed_dupes = stats['records'] - unique_records
+            print(f"📝 Распарсено {stats['raw_rows']} HTML строк → {stats['records']} записей товаров ({stats['chunks']} порций)")
+            if removed_dupes > 0:
+                print(f"🗑️ Удалено дубликатов по коду номенклатуры: {removed_dupes}")
+            
+            count_before = merge_staging_with_delta(conn, unique_records, include_removed)
+            total_records = store_count(conn)
+        finally:
+            conn.close()
+        
+        added = total_records - count_before
+        print(f"🔄 Обновлено записей: {unique_records - added}")
+        print(f"➕ Добавлено новых записей: {added}")
+        print(f"✅ Итого записей в хранилище {STORE_DB}: {total_records}")
+        
+        # Excel и остальные форматы - выгрузка из хранилища
+        emit_progress("phase", phase="export", rows=total_records)
+        export_store(output_file)
+        
+        # Индекс для поиска из бота: не обязателен для выгрузки, ошибка только предупреждение
+        with metrics.stage("search_index"):
+            try:
+                indexed = build_search_index()
+                print(f"🔎 Поисковый индекс {SEARCH_DB}: {indexed} записей")
+            except sqlite3.Error as e:
+                print(f"⚠️ Поисковый индекс не создан: {e}")
+        
+        # Статистика
+        print("\n📊 Статистика:")
+        print(f"   🔢 HTML строк собрано: {stats['items']}")
+        print(f"   📦 Записей товаров распарсено: {stats['raw_rows']}")
+        print(f"   ✅ Уникальных товаров в финале: {total_records}")
+        print(f"   🗑️ Дубликатов удалено: {removed_dupes}")
+        
+        if KEEP_TEMP_FILES:
+            clear_last_position()
+            print(f"\n📁 Временные файлы сохранены (KEEP_TEMP_FILES), журнал: {JOURNAL_FILE}")
+        else:
+            clear_temp_files()
+            print("\n🗑️ Временные файлы удалены после создания финального Excel.")
+        return True
+        
+    except Exception as e:
+        print(f"❌ Ошибка при обработке HTML и создании финального Excel: {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+
+# --- Функция определения прокручиваемого контейнера ---
+def detect_scroll_container(page):
+    """Проверяет наличие main_content_container, иначе используется прокрутка окна"""
+    try:
+        container = page.locator(".main_content_container").first
+        if container.count() > 0:
+            print("✅ Найден контейнер main_content_container")
+            return True
+        print("⚠️ Контейнер не найден, используем прокрутку окна")
+        return False
+    except:
+        print("⚠️ Используем прокрутку окна вместо контейнера")
+        return False
+
+
+
+# --- Функция получения высоты прокручиваемой области ---
+def get_scroll_height(page, use_container):
+    """Возвращает scrollHeight контейнера или страницы"""
+    if use_container:
+        return page.evaluate("""
+            () => {
+                const container = document.querySelector('.main_content_container');
+                return container ? container.scrollHeight : 0;
+            }
+        """)
+    return page.evaluate("() => document.body.scrollHeight")
+
+
+
+# --- Функция прокрутки на заданную позицию ---
+def scroll_to_position(page, position, use_container):
+    """Прокручивает контейнер или окно на указанную позицию"""
+    if use_container:
+        page.evaluate("""
+            (position) => {
+                const container = document.querySelector('.main_content_container');
+                if (container) {
+                    container.scrollTop = position;
+                }
+            }
+        """, position)
+    else:
+        page.evaluate("(position) => window.scrollTo(0, position)", position)
+
+
+
+# --- Скрипт наблюдения за появлением строк и сетевой активностью страницы ---
+# Устанавливается один раз на страницу и возвращает снимок счетчиков перед шагом прокрутки
+ROW_WAIT_SNAPSHOT_JS = """
+    () => {
+        if (!window.__angelinaWait) {
+            const state = {rowAdds: 0, lastMutation: performance.now(), inflight: 0};
+            window.__angelinaWait = state;
+            new MutationObserver((mutations) => {
+                for (const mutation of mutations) {
+                    for (const node of mutation.addedNodes) {
+                        if (node.nodeType !== 1) {
+                            continue;
+                        }
+                        if (node.matches('tr[id]')) {
+                            state.rowAdds += 1;
+                        } else {
+                            state.rowAdds += node.querySelectorAll('tr[id]').length;
+                        }
+                    }
+                }
+                state.lastMutation = performance.now();
+            }).observe(document.body, {childList: true, subtree: true});
+            
+            const originalFetch = window.fetch;
+            window.fetch = function (...args) {
+                state.inflight += 1;
+                return originalFetch.apply(this, args).finally(() => { state.inflight -= 1; });
+            };
+            const originalSend = XMLHttpRequest.prototype.send;
+            XMLHttpRequest.prototype.send = function (...args) {
+                state.inflight += 1;
+                this.addEventListener('loadend', () => { state.inflight -= 1; }, {once: true});
+                return originalSend.apply(this, args);
+            };
+        }
+        return {rowAdds: window.__angelinaWait.rowAdds, startedAt: performance.now()};
+    }
+"""
+
+
+# Шаг считается загруженным, когда после новых строк DOM затих на quietMs,
+# либо когда новых строк нет, запросов в полете нет и DOM молчит idleMs
+ROW_WAIT_CONDITION_JS = """
+    ({rowAdds, startedAt, quietMs, idleMs}) => {
+        const state = window.__angelinaWait;
+        if (!state) {
+            return 'reload';
+        }
+        const now = performance.now();
+        const quietFor = now - state.lastMutation;
+        if (state.rowAdds > rowAdds) {
+            return quietFor >= quietMs ? 'rows' : false;
+        }
+        if (state.inflight === 0 && now - startedAt >= idleMs && quietFor >= idleMs) {
+            return 'idle';
+        }
+        return false;
+    }
+"""
+
+
+
+# --- Функция снимка состояния перед шагом прокрутки ---
+def take_wait_snapshot(page):
+    """Устанавливает наблюдатель в странице и возвращает счетчики перед шагом"""
+    if WAIT_MODE != "event":
+        return None
+    try:
+        return page.evaluate(ROW_WAIT_SNAPSHOT_JS)
+    except Exception as e:
+        print(f"⚠️ Не удалось установить наблюдатель строк: {e}")
+        return None
+
+
+
+# --- Функция ожидания подгрузки после шага прокрутки ---
+def wait_for_step(page, snapshot):
+    """Ждет новых строк или затишья (event) либо фиксированную паузу (fixed), возвращает (исход, секунды)"""
+    started = time.monotonic()
+    if snapshot is None:
+        # Пауза через Playwright: синхронный обработчик маршрутов блокировки работает только внутри
+        # вызовов Playwright, и time.sleep задерживал бы все запросы страницы, включая XHR таблицы
+        page.wait_for_timeout(2000)
+        return "fixed", time.monotonic() - started
+    
+    try:
+        handle = page.wait_for_function(
+            ROW_WAIT_CONDITION_JS,
+            arg={**snapshot, 'quietMs': SCROLL_QUIET_MS, 'idleMs': SCROLL_IDLE_MS},
+            polling=100,
+            timeout=SCROLL_WAIT_TIMEOUT * 1000
+        )
+        outcome = handle.json_value()
+    except PlaywrightTimeout:
+        outcome = "timeout"
+    return outcome, time.monotonic() - started
+
+
+
+# --- Функция вывода статистики ожиданий ---
+def print_wait_stats(wait_log):
+    """Печатает суммарное время ожиданий, перцентили и исходы шагов"""
+    if not wait_log:
+        return
+    durations = sorted(seconds for _, seconds in wait_log)
+    outcomes = {}
+    for outcome, _ in wait_log:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    
+    def percentile(q):
+        return durations[min(len(durations) - 1, int(q * len(durations)))]
+    
+    print("⏱️ Статистика ожиданий шагов прокрутки:")
+    print(f"   Шагов: {len(durations)}, всего ожидания: {sum(durations):.1f}с, в среднем: {sum(durations) / len(durations):.2f}с")
+    print(f"   p50: {percentile(0.5):.2f}с, p95: {percentile(0.95):.2f}с, максимум: {durations[-1]:.2f}с")
+    print(f"   Исходы: {', '.join(f'{name}={count}' for name, count in sorted(outcomes.items()))}")
+
+
+
+# --- Ключи JSON, в которых API отдает общее число записей ---
+TOTAL_COUNT_KEYS = ['total', 'totalcount', 'total_count', 'totalitems', 'totalrecords', 'recordstotal', 'recordcount']
+
+
+
+# --- Функция поиска общего числа записей в JSON ---
+def find_total_count(payload):
+    """Возвращает значение поля total ближайшего к корню объекта или None"""
+    keys = [TOTAL_COUNT_KEY.lower()] if TOTAL_COUNT_KEY else TOTAL_COUNT_KEYS
+    queue = [payload]
+    while queue:
+        node = queue.pop(0)
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key.lower() in keys and isinstance(value, int) and not isinstance(value, bool) and value > 0:
+                    return value
+            queue.extend(v for v in node.values() if isinstance(v, (dict, list)))
+        elif isinstance(node, list):
+            queue.extend(v for v in node if isinstance(v, dict))
+    return None
+
+
+
+# --- Функция извлечения общего числа записей из тела ответа ---
+def total_from_body(body, content_type):
+    """Разбирает JSON ответа и ищет в нем общее число записей (не меньше числа строк самого ответа)"""
+    if 'json' not in content_type:
+        return None
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    total = find_total_count(payload)
+    # total меньше строк ответа - это размер страницы или итог по странице, а не каталога
+    if total and total < len(find_record_list(payload)):
+        return None
+    return total
+
+
+
+# --- Функция создания состояния поиска размера каталога ---
+def new_total_watch():
+    """Ответы API, число повторов каждого найденного total и отвергнутые значения"""
+    return {'responses': [], 'total': None, 'source': None, 'seen': {}, 'latest': None, 'rejected': set()}
+
+
+
+# --- Функция учета найденного в ответе общего числа записей ---
+def note_total(watch, total):
+    """Принимает total как размер каталога, только когда то же значение пришло во втором ответе"""
+    if not total or total in watch['rejected']:
+        return
+    watch['seen'][total] = watch['seen'].get(total, 0) + 1
+    watch['latest'] = total
+    if watch['total'] is None and watch['seen'][total] >= 2:
+        watch['total'], watch['source'] = total, "API"
+
+
+
+# --- Функция отказа от размера каталога ---
+def reject_total(watch, state, prefix=""):
+    """Забывает total, после которого таблица продолжила расти, и больше его не принимает"""
+    print(f"⚠️ {prefix}Собрано {len(state.seen_ids)} из {state.total_count} позиций, но строки продолжают поступать: "
+          f"это не размер каталога, продолжаем сбор")
+    metrics.count("total_rejected")
+    watch['rejected'].add(state.total_count)
+    watch['total'] = watch['source'] = None
+    state.total_count = None
+
+
+
+# --- Функция подписки на ответы для определения размера каталога ---
+def start_total_watch(page):
+    """Копит ответы API номенклатур, из которых потом читается поле total"""
+    watch = new_total_watch()
+    
+    def on_response(response):
+        if NETWORK_URL_PATTERN.lower() in response.url.lower() and response.request.resource_type in ("xhr", "fetch"):
+            watch['responses'].append(response)
+    
+    page.on("response", on_response)
+    watch['handler'] = on_response
+    return watch
+
+
+
+# --- Функция чтения общего числа записей из счетчика на странице ---
+def parse_counter_text(text):
+    """Достает число из текста счетчика вида 'Найдено: 12 345'"""
+    digits = re.sub(r'\D', '', text or '')
+    return int(digits) if digits else None
+
+
+
+# --- Функция получения общего числа записей каталога ---
+def read_total_count(page, watch):
+    """Обновляет размер каталога из перехваченных ответов API или счетчика на странице"""
+    while watch['responses']:
+        response = watch['responses'].pop(0)
+        try:
+            total = total_from_body(response.body(), response.headers.get('content-type', ''))
+        except Exception:
+            continue
+        note_total(watch, total)
+    
+    if watch['total'] is None and TOTAL_COUNT_SELECTOR:
+        try:
+            total = parse_counter_text(page.locator(TOTAL_COUNT_SELECTOR).first.text_content(timeout=1000))
+            if total and total not in watch['rejected']:
+                watch['total'], watch['source'] = total, "счетчик на странице"
+        except Exception:
+            pass
+    return watch['total']
+
+
+
+# --- Скрипт состояния прокрутки: верх, видимая высота и полная высота области ---
+SCROLL_STATE_JS = """
+    () => {
+        const target = document.querySelector('.main_content_container') || document.scrollingElement;
+        return [target.scrollTop, target.clientHeight, target.scrollHeight];
+    }
+"""
+
+
+
+# --- Функция проверки конца таблицы ---
+def table_end_reached(page, use_container):
+    """Докручивает до низа таблицы и проверяет, что после ожидания ее высота не выросла"""
+    height = get_scroll_height(page, use_container)
+    snapshot = take_wait_snapshot(page)
+    scroll_to_position(page, height, use_container)
+    wait_for_step(page, snapshot)
+    return get_scroll_height(page, use_container) <= height
+
+
+
+# --- Функция вывода и учета досрочной остановки ---
+def report_early_stop(reason, remaining_steps, step_seconds, prefix=""):
+    """Печатает причину остановки и оценку сэкономленного времени, записывает их в метрики"""
+    saved = remaining_steps * step_seconds
+    reasons = {
+        'total_reached': "собран весь каталог",
+        'scroll_end': "конец таблицы (высота не меняется)"
+    }
+    print(f"⏩ {prefix}Досрочная остановка: {reasons.get(reason, reason)}. "
+          f"Сэкономлено ≈ {saved:.0f}с ({remaining_steps} шагов по {step_seconds:.2f}с)")
+    metrics.count(f"early_stop_{reason}")
+    metrics.count("early_stop_saved_seconds", round(saved, 1))
+    metrics.count("early_stop_saved_steps", remaining_steps)
+
+
+
+# --- Общее состояние обхода ---
+class CrawlState:
+    """Журнал, множество собранных id и позиции шардов под общей блокировкой"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.seen_ids = set()
+        self.shard_positions = {}
+        self.item_count = 0
+        self.total_count = None
+        self.save_positions = True
+        self.index_rows = True  # Позиции - пиксели прокрутки (в обходе через API - номера страниц)
+        self.position_index = open_position_index()
+        
+        # Восстанавливаем id из журнала без повторного разбора HTML
+        migrate_temp_data()
+        for item in read_journal():
+            self.item_count += 1
+            for row in item['rows']:
+                self.seen_ids.add(row[0])
+        self.journal = open_journal()
+        
+        if self.seen_ids:
+            print(f"📂 Загружено {len(self.seen_ids)} уникальных id из журнала ({self.item_count} порций)")
+        self.started = time.monotonic()
+        self.initial_rows = len(self.seen_ids)
+    
+    def report_progress(self, position, start_position, limit):
+        """Отправляет боту число строк, позицию, скорость и оценку оставшегося времени"""
+        elapsed = time.monotonic() - self.started
+        rows = len(self.seen_ids)
+        rate = (rows - self.initial_rows) / elapsed if elapsed else 0
+        eta = None
+        if self.total_count and rate:
+            eta = max(0, self.total_count - rows) / rate
+        elif limit and position > start_position:
+            eta = max(0, limit - position) / ((position - start_position) / elapsed)
+        emit_progress(
+            "progress", force=False, rows=rows, position=position, total=self.total_count,
+            rows_per_sec=round(rate, 1), eta_seconds=round(eta) if eta is not None else None
+        )
+    
+    def complete(self):
+        """Возвращает True, если собрано не меньше позиций, чем всего в каталоге"""
+        return bool(self.total_count) and len(self.seen_ids) >= self.total_count
+    
+    def claim(self, ids):
+        """Отмечает id как собранные и возвращает те, что раньше не встречались"""
+        with self.lock:
+            new_ids = {row_id for row_id in ids if row_id not in self.seen_ids}
+            self.seen_ids.update(new_ids)
+        return new_ids
+    
+    def add_item(self, item, position, shard=None):
+        """Дописывает порцию в журнал, периодически делает fsync и сохраняет позицию"""
+        with self.lock:
+            append_journal(self.journal, item)
+            if self.save_positions and self.index_rows:
+                record_row_positions(self.position_index, item['rows'], position)
+            self.item_count += 1
+            if self.item_count % 50 == 0:
+                self._checkpoint(position, shard)
+            elif self.item_count % JOURNAL_FSYNC_EVERY == 0:
+                sync_journal(self.journal)
+    
+    def record_step(self, position, shard=None):
+        """Запоминает пройденный шаг в индексе позиций, чтобы продолжить ровно с него"""
+        if self.save_positions and shard is None:
+            with self.lock:
+                set_progress(self.position_index, position)
+    
+    def checkpoint(self, position, shard=None):
+        """Сбрасывает журнал на диск и сохраняет позицию прокрутки (или позиции всех шардов)"""
+        with self.lock:
+            self._checkpoint(position, shard)
+    
+    def _checkpoint(self, position, shard):
+        # Позиция сохраняется только после того, как данные до нее уже на диске
+        sync_journal(self.journal)
+        print(f"💾 Журнал сохранен: {JOURNAL_FILE} ({self.item_count} порций, {len(self.seen_ids)} строк)")
+        if not self.save_positions:
+            return  # Обход по папкам возобновляется по отпечаткам папок, а не по позиции
+        if shard is None:
+            save_last_position(position, self.position_index)
+        else:
+            save_shard_positions(self.shard_positions)
+    
+    def close(self):
+        """Сбрасывает и закрывает журнал; пустой журнал удаляет"""
+        with self.lock:
+            if not self.journal.closed:
+                sync_journal(self.journal)
+                self.journal.close()
+                # Обход без единой строки (например, все папки без изменений) не должен
+                # оставлять пустой журнал, который выглядит как незавершенный сбор
+                if os.path.exists(JOURNAL_FILE) and not os.path.getsize(JOURNAL_FILE):
+                    os.remove(JOURNAL_FILE)
+            self.position_index.close()
+
+
+
+# --- Функция медленной прокрутки контейнера main_content_container ---
+def scroll_to_load_table_container(page, start_position=0, scroll_step=None, max_empty_attempts=10000,
+                                   end_position=None, state=None, shard=None, label=None, skip_ids=None):
+    """Постепенно прокручивает страницу и собирает данные (строки из skip_ids не собираются)"""
+    if scroll_step is None:
+        scroll_step = SCROLL_STEP
+    if end_position is None:
+        end_position = MAX_SCROLL_POSITION
+    owns_state = state is None
+    if owns_state:
+        state = CrawlState()
+    prefix = f"[шард {shard}] " if shard is not None else (f"[{label}] " if label else "")
+        
+    print(f"🔄 {prefix}Начинаем поэтапную прокрутку main_content_container с позиции {start_position}px...")
+    empty_attempts = 0
+    scroll_position = start_position
+    first_extraction = True
+    
+    use_container = detect_scroll_container(page)
+    if start_position:
+        # Таблица растет по мере прокрутки: без перемотки ее высота - только первая страница,
+        # и проверка предела ниже закончила бы возобновленный обход после первого шага
+        seek_to_position(page, start_position, use_container)
+    wait_log = []
+    evicted_total = 0
+    watch = start_total_watch(page)
+    stable_end = 0
+    last_height = None
+    total_unchecked = False
+    loop_started = time.monotonic()
+    steps = 0
+    
+    while empty_attempts < max_empty_attempts and not state.stop.is_set():
+        step_started = time.perf_counter()
+        steps += 1
+        
+        # Получаем текущую высоту и прокручиваем по шагу
+        with metrics.stage("scroll"):
+            max_height = get_scroll_height(page, use_container)
+            snapshot = take_wait_snapshot(page)
+            scroll_to_position(page, scroll_position, use_container)
+        
+        # Ждем подгрузки контента
+        outcome, waited = wait_for_step(page, snapshot)
+        wait_log.append((outcome, waited))
+        metrics.add_stage("wait", waited)
+        metrics.observe("step_wait_seconds", waited)
+        metrics.count(f"wait_outcome_{outcome}")
+        
+        # Собираем новые строки
+        if EXTRACTION_MODE == "evaluate":
+            # Разбор выполняется в странице, передаем только новые строки
+            with metrics.stage("evaluate"):
+                rows = extract_new_rows(page, state.seen_ids if first_extraction else None)
+            first_extraction = False
+            claimed = state.claim(row[0] for row in rows)
+            new_rows = [row for row in rows if row[0] in claimed]
+            # Страница отдает только не виденные ею строки: отказ claim - повторный сбор (например, другим шардом)
+            metrics.count("rows_extracted", len(rows))
+            metrics.count("rows_duplicate", len(rows) - len(new_rows))
+            new_item = {'position': scroll_position, 'rows': new_rows} if new_rows else None
+            new_count = len(new_rows)
+        else:
+            with metrics.stage("page_content"):
+                html_content = page.content()
+            metrics.count("page_content_bytes", len(html_content))
+            with metrics.stage("parse_html"):
+                rows = parse_table_container_rows(html_content)
+            if skip_ids:
+                rows = [row for row in rows if row[0] not in skip_ids]
+            claimed = state.claim(row[0] for row in rows)
+            new_rows = []
+            for row in rows:
+                if row[0] in claimed:
+                    claimed.discard(row[0])
+                    new_rows.append(row)
+            new_item = {'position': scroll_position, 'rows': new_rows} if new_rows else None
+            new_count = len(new_rows)
+        
+        if shard is not None:
+            state.shard_positions[str(shard)]['position'] = scroll_position
+        
+        metrics.count("scroll_steps")
+        metrics.count("rows_collected", new_count)
+        metrics.observe("step_new_rows", new_count)
+        
+        if new_item:
+            # Сохраняем промежуточные данные каждые 50 новых записей
+            state.add_item(new_item, scroll_position, shard)
+            empty_attempts = 0
+            print(f"✅ {prefix}Найдено {new_count} новых строк на позиции {scroll_position}px (всего: {len(state.seen_ids)}, ожидание {waited:.2f}с)")
+            
+            # Собранные строки выше видимой области больше не нужны странице
+            if BOUNDED_DOM:
+                with metrics.stage("evict"):
+                    evicted_total += evict_harvested_rows(page)
+        else:
+            metrics.count("empty_steps")
+            empty_attempts += 1
+            if empty_attempts % 10 == 0:
+                print(f"⏳ {prefix}Новых данных не найдено на позиции {scroll_position}px (попытка {empty_attempts}/{max_empty_attempts})")
+        
+        metrics.observe("step_seconds", time.perf_counter() - step_started)
+        state.record_step(scroll_position, shard)
+        state.report_progress(scroll_position, start_position, min(max_height, end_position))
+        
+        # Размер каталога известен - останавливаемся, как только все позиции собраны
+        if state.total_count is None and read_total_count(page, watch):
+            state.total_count = watch['total']
+            print(f"🎯 {prefix}Всего позиций в каталоге: {state.total_count} (источник: {watch['source']})")
+        early_stop = None
+        if state.complete() and not total_unchecked:
+            # Число из ответа могло оказаться не размером каталога - останавливаемся, только если таблица кончилась
+            # (или другой шард это уже проверил)
+            if state.stop.is_set() or table_end_reached(page, use_container):
+                early_stop = "total_reached"
+                state.stop.set()
+            elif shard is not None:
+                # Страница шарда видит только свой участок: шард доходит свой диапазон, конец проверит последний
+                total_unchecked = True
+            else:
+                reject_total(watch, state, prefix)
+        elif not new_item:
+            # Пустой шаг внизу таблицы, высота которой не растет - данных больше не будет
+            top, client_height, height = page.evaluate(SCROLL_STATE_JS)
+            at_end = top + client_height >= height - 2 and height == last_height
+            stable_end = stable_end + 1 if at_end else 0
+            last_height = height
+            if stable_end >= SCROLL_END_STABLE_STEPS:
+                early_stop = "scroll_end"
+        else:
+            stable_end = 0
+        
+        # Увеличиваем позицию прокрутки
+        scroll_position += scroll_step
+        
+        if early_stop:
+            limit = min(max_height, end_position)
+            remaining_steps = max(0, -(-(limit - scroll_position) // scroll_step))
+            report_early_stop(early_stop, remaining_steps, (time.monotonic() - loop_started) / steps, prefix)
+            if shard is not None:
+                state.shard_positions[str(shard)]['position'] = end_position if early_stop == "scroll_end" else scroll_position
+            break
+        
+        # Проверяем достижение максимальной высоты или лимита. Высота, снятая до ожидания, могла
+        # с тех пор вырасти: после перемотки (шард, возобновление) она лишь чуть больше позиции
+        if scroll_position >= max_height:
+            max_height = get_scroll_height(page, use_container)
+        if scroll_position >= max_height or scroll_position >= end_position:
+            print(f"🏁 {prefix}Достигнут предел прокрутки: {scroll_position}px")
+            if shard is not None:
+                state.shard_positions[str(shard)]['position'] = end_position
+            break
+        
+        # Небольшая пауза между итерациями (в режиме event темп задает сам сайт)
+        if WAIT_MODE != "event":
+            page.wait_for_timeout(SCROLL_STEP_PAUSE * 1000)
+    
+    page.remove_listener("response", watch['handler'])
+    print_wait_stats(wait_log)
+    if BOUNDED_DOM:
+        print(f"🧹 {prefix}Удалено из DOM собранных строк: {evicted_total}")
+    
+    # Финальное сохранение данных
+    if state.item_count:
+        state.checkpoint(scroll_position, shard)
+        print(f"✅ {prefix}Сбор данных завершен. Всего собрано {len(state.seen_ids)} уникальных HTML строк.")
+    if owns_state:
+        state.close()
+    
+    return len(state.seen_ids)
+
+
+
+# --- Функция перемотки к началу диапазона шарда ---
+def seek_to_position(page, target, use_container, max_stalled=3):
+    """Докручивает до позиции, дожидаясь подгрузки, если таблица растет по мере прокрутки"""
+    stalled = 0
+    while stalled < max_stalled:
+        height = get_scroll_height(page, use_container)
+        if height > target:
+            break
+        snapshot = take_wait_snapshot(page)
+        scroll_to_position(page, height, use_container)
+        wait_for_step(page, snapshot)
+        stalled = stalled + 1 if get_scroll_height(page, use_container) == height else 0
+    scroll_to_position(page, target, use_container)
+
+
+
+# --- Функция разбиения диапазона прокрутки на шарды ---
+def plan_shards(start_position=0):
+    """Возвращает диапазоны шардов: сохраненные при возобновлении или новые равные отрезки"""
+    saved = load_shard_positions()
+    if len(saved) == SHARD_COUNT:
+        print(f"📂 Возобновляем {SHARD_COUNT} шардов с сохраненных позиций")
+        return saved
+    
+    span = MAX_SCROLL_POSITION - start_position
+    size = max(SCROLL_STEP, (span // SHARD_COUNT) // SCROLL_STEP * SCROLL_STEP)
+    shards = {}
+    for index in range(SHARD_COUNT):
+        start = start_position + index * size
+        end = MAX_SCROLL_POSITION if index == SHARD_COUNT - 1 else start + size
+        shards[str(index)] = {'start': start, 'end': end, 'position': start}
+    return shards
+
+
+
+# --- Функция обхода одного шарда в собственном браузере ---
+def run_shard(shard, state):
+    """Открывает отдельный браузер с cookies основной сессии и обходит диапазон шарда"""
+    # Свой браузер, а не контекст общего: синхронный Playwright не разделить между потоками (см. SHARD_CONCURRENCY)
+    info = state.shard_positions[str(shard)]
+    if info['position'] >= info['end']:
+        print(f"✅ [шард {shard}] Диапазон уже пройден")
+        return
+    
+    with sync_playwright() as p:
+        browser = launch_browser(p)
+        context = create_context(browser)
+        try:
+            load_cookies(context)
+            page = context.new_page()
+            page.set_default_timeout(PAGE_TIMEOUT)
+            if not open_nomenclatures(page):
+                raise RuntimeError("не удалось открыть страницу номенклатур")
+            remove_folder_container(page)
+            
+            use_container = detect_scroll_container(page)
+            seek_to_position(page, info['position'], use_container)
+            # Строки выше начала шарда подгружены перемоткой, но принадлежат предыдущим шардам
+            skip_ids = skip_rows_above(page)
+            print(f"⏭️ [шард {shard}] Пропущено строк выше {info['position']}px: {len(skip_ids)}")
+            scroll_to_load_table_container(
+                page, info['position'], end_position=info['end'], state=state, shard=shard, skip_ids=skip_ids
+            )
+        except Exception as e:
+            # Сбор без этого диапазона неполон - решение о выгрузке принимает crawl_sharded
+            print(f"❌ [шард {shard}] Ошибка: {e}")
+            raise
+        finally:
+            context.close()
+            browser.close()
+
+
+
+# --- Функция параллельного обхода шардами ---
+def crawl_sharded(start_position=0):
+    """Обходит непересекающиеся диапазоны прокрутки в нескольких браузерах с общим множеством id"""
+    state = CrawlState()
+    state.shard_positions = plan_shards(start_position)
+    for shard, info in sorted(state.shard_positions.items(), key=lambda x: int(x[0])):
+        print(f"🧵 Шард {shard}: {info['start']}-{info['end']}px, позиция {info['position']}px")
+    
+    failed = {}
+    with ThreadPoolExecutor(max_workers=SHARD_CONCURRENCY) as executor:
+        futures = {executor.submit(run_shard, int(shard), state): shard for shard in state.shard_positions}
+        try:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed[futures[future]] = e
+        except KeyboardInterrupt:
+            # Шарды завершают текущий шаг и сохраняют свои позиции
+            state.stop.set()
+            raise
+        finally:
+            state.close()
+            # Журнал уже сброшен на диск - позиции всех шардов, включая упавшие, можно сохранить
+            save_shard_positions(state.shard_positions)
+    
+    # Каталог собран целиком - недошедшие до конца шарды остановлены штатно
+    unfinished = sorted(
+        (shard for shard, info in state.shard_positions.items() if info['position'] < info['end']), key=int
+    )
+    if (failed or unfinished) and not state.complete():
+        details = ', '.join(
+            f"{shard} ({failed[shard]})" if shard in failed else f"{shard} (остановлен на {state.shard_positions[shard]['position']}px)"
+            for shard in sorted(set(failed) | set(unfinished), key=int)
+        )
+        # Без этих диапазонов выгрузка неполна, а часть хранилища ушла бы в удаленные
+        raise RuntimeError(f"Шарды не завершены: {details}. Позиции сохранены в {SHARD_POSITIONS_FILE}, повторный запуск продолжит сбор")
+    
+    print(f"✅ Параллельный сбор завершен. Всего собрано {len(state.seen_ids)} уникальных строк.")
+    return len(state.seen_ids)
+
+
+
+# --- Скрипт перечисления папок каталога ---
+LIST_FOLDERS_JS = """
+    (selector) => Array.from(document.querySelectorAll(selector)).map((element, index) => ({
+        index,
+        key: element.dataset.id || element.getAttribute('data-folder-id') || element.id || element.textContent.trim(),
+        name: element.textContent.trim()
+    }))
+"""
+
+
+# --- Скрипт ожидания смены содержимого таблицы после выбора папки ---
+# Подпись таблицы - число строк и id первых из них; ждем, пока она сменится на непустую
+TABLE_SIGNATURE_JS = """
+    () => {
+        const rows = document.querySelectorAll('.table_container tr[id]');
+        return rows.length + ':' + Array.from(rows).slice(0, 5).map(row => row.id).join(',');
+    }
+"""
+FOLDER_SWITCHED_JS = """
+    (before) => {
+        const rows = document.querySelectorAll('.table_container tr[id]');
+        const signature = rows.length + ':' + Array.from(rows).slice(0, 5).map(row => row.id).join(',');
+        return rows.length > 0 && signature !== before;
+    }
+"""
+
+
+# --- Скрипт чтения первых строк папки для отпечатка ---
+FOLDER_HEAD_JS = """
+    (count) => Array.from(document.querySelectorAll('.table_container tr[id]')).slice(0, count)
+        .map(row => row.id + '\\t' + row.innerText).join('\\n')
+"""
+
+
+
+# --- Функция чтения отпечатков папок ---
+def load_folder_state():
+    """Читает отпечатки папок прошлых запусков: ключ папки -> отпечаток, время и число строк"""
+    if os.path.exists(FOLDER_STATE_FILE):
+        try:
+            with open(FOLDER_STATE_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            print("⚠️ Ошибка чтения отпечатков папок, все папки собираются заново.")
+    return {}
+
+
+
+# --- Функция сохранения отпечатков папок ---
+def save_folder_state(folders):
+    """Сохраняет отпечатки папок в JSON файл"""
+    with open(FOLDER_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump(folders, f, ensure_ascii=False)
+
+
+
+# --- Состояние обхода одной папки ---
+class FolderStop:
+    """Остановка обхода папки: своя (папка собрана) или общая (прерван весь сбор)"""
+    
+    def __init__(self, shared):
+        self.shared = shared
+        self.done = False
+    
+    def set(self):
+        self.done = True
+    
+    def is_set(self):
+        return self.done or self.shared.is_set()
+
+
+class FolderState:
+    """Обход одной папки поверх общего CrawlState: журнал и учет дубликатов общие, размер и полнота - свои"""
+    
+    def __init__(self, shared, total_count=None):
+        self.shared = shared
+        self.stop = FolderStop(shared.stop)
+        self.seen_ids = set()  # id, встреченные в этой папке (в том числе уже собранные в других)
+        self.total_count = total_count
+    
+    @property
+    def item_count(self):
+        return self.shared.item_count
+    
+    def claim(self, ids):
+        ids = list(ids)
+        self.seen_ids.update(ids)
+        return self.shared.claim(ids)
+    
+    def complete(self):
+        return bool(self.total_count) and len(self.seen_ids) >= self.total_count
+    
+    def add_item(self, item, position, shard=None):
+        self.shared.add_item(item, position)
+    
+    def record_step(self, position, shard=None):
+        pass  # Позиции внутри папки не относятся к общему списку
+    
+    def checkpoint(self, position, shard=None):
+        self.shared.checkpoint(position)
+    
+    def report_progress(self, position, start_position, limit):
+        self.shared.report_progress(position, start_position, limit)
+
+
+
+# --- Функция выбора папки ---
+def select_folder(page, folder, watch):
+    """Прокручивает таблицу к началу, открывает папку и ждет, пока таблица сменит содержимое"""
+    scroll_to_position(page, 0, detect_scroll_container(page))
+    before = page.evaluate(TABLE_SIGNATURE_JS)
+    # Размер каталога и собранные в странице id из прошлой папки к новой не относятся
+    watch.update(new_total_watch())
+    page.evaluate("() => { window.__angelinaSeenIds = new Set(); }")
+    page.locator(FOLDER_SELECTOR).nth(folder['index']).click()
+    try:
+        page.wait_for_function(FOLDER_SWITCHED_JS, arg=before, timeout=POST_NAVIGATION_WAIT * 1000)
+    except PlaywrightTimeout:
+        print(f"⚠️ Таблица не сменилась после выбора папки «{folder['name']}» (пустая папка?)")
+    page.wait_for_timeout(SCROLL_QUIET_MS)
+
+
+
+# --- Функция отпечатка папки ---
+def folder_fingerprint(page, watch):
+    """Число позиций папки и хэш ее первых FOLDER_FINGERPRINT_ROWS строк вместе с ценами и остатками"""
+    head = page.evaluate(FOLDER_HEAD_JS, FOLDER_FINGERPRINT_ROWS)
+    return {
+        # Для отпечатка хватает и неподтвержденного числа: оно лишь должно совпасть с прошлым
+        'total': read_total_count(page, watch) or watch['latest'],
+        'head': hashlib.sha1(head.encode('utf-8')).hexdigest()
+    }
+
+
+
+# --- Функция обхода одной папки ---
+def crawl_folder(page, folder, watch, state, previous, folder_state):
+    """Открывает папку, сравнивает отпечаток с прошлым и при изменении собирает ее заново"""
+    label = f"папка «{folder['name']}»"
+    select_folder(page, folder, watch)
+    fingerprint = folder_fingerprint(page, watch)
+    
+    # Отпечаток видит только начало папки, поэтому старые папки собираются заново и без изменений в нем
+    fresh = previous and (not FOLDER_MAX_AGE_HOURS or time.time() - previous['crawled_at'] < FOLDER_MAX_AGE_HOURS * 3600)
+    if fresh and previous['fingerprint'] == fingerprint:
+        print(f"⏭️ [{label}] Без изменений ({fingerprint['total'] or '?'} позиций), берем записи из хранилища")
+        metrics.count("folders_skipped")
+        metrics.count("folders_skipped_rows", previous.get('rows') or 0)
+        return
+    
+    reason = "новая папка" if not previous else ("отпечаток изменился" if fresh else "истек срок давности")
+    print(f"🗂️ [{label}] Сбор: {reason}, позиций: {fingerprint['total'] or '?'}")
+    # Останавливаться по размеру папки можно только по подтвержденному числу
+    folder_view = FolderState(state, watch['total'])
+    scroll_to_load_table_container(page, 0, state=folder_view, label=label)
+    if state.stop.is_set():
+        return  # Прерванная папка не запоминается и будет собрана в следующий раз
+    
+    metrics.count("folders_crawled")
+    with state.lock:
+        folder_state[folder['key']] = {
+            'name': folder['name'], 'fingerprint': fingerprint, 'crawled_at': time.time(), 'rows': len(folder_view.seen_ids)
+        }
+        save_folder_state(folder_state)
+
+
+
+# --- Функция обработчика папок в собственном браузере ---
+def run_folder_worker(worker, folders, state, previous_state, folder_state):
+    """Открывает отдельный браузер с cookies основной сессии и берет папки из общей очереди"""
+    with sync_playwright() as p:
+        browser = launch_browser(p)
+        context = create_context(browser)
+        try:
+            load_cookies(context)
+            page = context.new_page()
+            page.set_default_timeout(PAGE_TIMEOUT)
+            if not open_nomenclatures(page):
+                print(f"❌ [браузер {worker}] Не удалось открыть страницу номенклатур")
+                return
+            watch = start_total_watch(page)
+            while not state.stop.is_set():
+                try:
+                    folder = folders.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    crawl_folder(page, folder, watch, state, previous_state.get(folder['key']), folder_state)
+                except Exception as e:
+                    print(f"❌ [браузер {worker}] Ошибка в папке «{folder['name']}»: {e}")
+        except Exception as e:
+            print(f"❌ [браузер {worker}] Ошибка: {e}")
+        finally:
+            context.close()
+            browser.close()
+
+
+
+# --- Функция обхода каталога по папкам ---
+def crawl_folders(page):
+    """Собирает заново только папки с изменившимся отпечатком, остальные записи берутся из хранилища"""
+    folders = page.evaluate(LIST_FOLDERS_JS, FOLDER_SELECTOR)
+    if not folders:
+        print(f"⚠️ Папки не найдены ({FOLDER_SELECTOR}), собираем весь список")
+        remove_folder_container(page)
+        return scroll_to_load_table_container(page, get_last_position())
+    
+    metrics.count("folders_listed", len(folders))
+    previous_state = load_folder_state()
+    # Пропускать папки можно, только если их записи действительно лежат в хранилище
+    conn = open_store()
+    try:
+        store_empty = not store_count(conn)
+    finally:
+        conn.close()
+    if previous_state and store_empty:
+        print("⚠️ Хранилище пустое, все папки собираются заново")
+        previous_state = {}
+    
+    # В файле остаются и папки, которых сейчас нет на портале: они могут вернуться
+    folder_state = dict(previous_state)
+    work = queue.Queue()
+    for folder in folders:
+        work.put(folder)
+    workers = max(1, min(FOLDER_WORKERS, len(folders)))
+    print(f"🗂️ Папок: {len(folders)} (известных по прошлым запускам: {sum(f['key'] in previous_state for f in folders)}), браузеров: {workers}")
+    
+    state = CrawlState()
+    state.save_positions = False
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(run_folder_worker, worker, work, state, previous_state, folder_state)
+            for worker in range(workers)
+        ]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except KeyboardInterrupt:
+            # Обработчики дописывают текущий шаг, собранные папки уже запомнены
+            state.stop.set()
+            raise
+        finally:
+            state.close()
+    
+    crawled = metrics.counters.get('folders_crawled', 0)
+    skipped = metrics.counters.get('folders_skipped', 0)
+    print(f"✅ Обход по папкам завершен: собрано папок {crawled}, пропущено без изменений {skipped}, "
+          f"не обработано {len(folders) - crawled - skipped}. Новых строк: {len(state.seen_ids)}")
+    if not state.seen_ids and not state.stop.is_set():
+        print(f"ℹ️ Изменившихся папок нет, {FINAL_EXCEL} остается актуальным")
+    return len(state.seen_ids)
+
+
+
+# --- Функция объединения диапазонов прокрутки ---
+def merge_ranges(ranges):
+    """Сортирует диапазоны и сливает пересекающиеся"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
+
+
+
+# --- Функция поиска диапазонов по кодам номенклатуры ---
+def code_ranges(codes):
+    """Возвращает диапазоны прокрутки вокруг позиций, где в прошлый раз встретились коды"""
+    conn = open_position_index()
+    try:
+        ranges = []
+        for code in codes:
+            row = conn.execute(
+                "SELECT position FROM row_positions WHERE code = ? ORDER BY seen_at DESC LIMIT 1", (code,)
+            ).fetchone()
+            if row is None:
+                print(f"⚠️ Код {code} не найден в индексе позиций {POSITION_INDEX_DB}")
+                continue
+            ranges.append((max(0, row[0] - RECRAWL_MARGIN), row[0] + RECRAWL_MARGIN))
+    finally:
+        conn.close()
+    return merge_ranges(ranges)
+
+
+
+# --- Функция разбора аргументов точечного пересбора ---
+def recrawl_ranges_from_args(argv):
+    """Разбирает --recrawl FROM:TO[,FROM:TO] и --recrawl-codes КОД[,КОД] в список диапазонов"""
+    ranges = []
+    if "--recrawl" in argv:
+        for part in argv[argv.index("--recrawl") + 1].split(","):
+            start, end = part.split(":")
+            ranges.append((int(start), int(end)))
+    if "--recrawl-codes" in argv:
+        ranges.extend(code_ranges([c.strip() for c in argv[argv.index("--recrawl-codes") + 1].split(",") if c.strip()]))
+    return merge_ranges(ranges)
+
+
+
+# --- Функция точечного пересбора диапазонов ---
+def recrawl_ranges(page, ranges):
+    """Собирает заново только заданные диапазоны прокрутки, перематывая к ним без сбора строк"""
+    state = CrawlState()
+    state.save_positions = False  # Прогресс основного обхода не трогаем
+    use_container = detect_scroll_container(page)
+    try:
+        for start, end in ranges:
+            if state.stop.is_set():
+                break
+            print(f"🎯 Диапазон {start}-{end}px: перемотка...")
+            seek_to_position(page, start, use_container)
+            # Строки выше диапазона подгружены перемоткой и в пересбор не входят
+            skip_ids = skip_rows_above(page)
+            scroll_to_load_table_container(
+                page, start, end_position=end, state=state, label=f"{start}-{end}px", skip_ids=skip_ids
+            )
+    finally:
+        state.close()
+    print(f"✅ Точечный пересбор завершен: {len(ranges)} диапазонов, {len(state.seen_ids)} строк")
+    return len(state.seen_ids)
+
+
+
+# --- Скрипт прокрутки для конвейера: прокручивает и возвращает высоту за один вызов ---
+PIPELINE_SCROLL_JS = """
+    (position) => {
+        const target = document.querySelector('.main_content_container') || document.scrollingElement;
+        const height = target.scrollHeight;
+        target.scrollTop = position;
+        return height;
+    }
+"""
+
+
+
+# --- Асинхронный конвейер сбора: прокрутка -> разбор -> дедупликация и журнал ---
+async def pipeline_crawl(start_position, state, max_empty_attempts=10000):
+    """Браузер прокручивает таблицу, пока предыдущие шаги разбираются и пишутся в журнал"""
+    loop = asyncio.get_running_loop()
+    raw_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    write_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    # Позиция, до которой все шаги уже записаны в журнал, и счетчик пустых шагов подряд
+    progress = {
+        'position': start_position, 'empty_attempts': 0, 'early_stop': None, 'check_total': False,
+        'max_height': MAX_SCROLL_POSITION
+    }
+    watch = new_total_watch()
+    parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS) if EXTRACTION_MODE != "evaluate" and PARSE_WORKERS > 1 else None
+    
+    async def put(queue, message):
+        # Время, которое этап простоял на полной очереди (следующий этап не успевает)
+        started = time.perf_counter()
+        await queue.put(message)
+        metrics.add_stage("pipeline_backpressure", time.perf_counter() - started)
+    
+    async def update_total(page):
+        # То же, что read_total_count, но с await для асинхронной страницы
+        while watch['responses']:
+            response = watch['responses'].pop(0)
+            try:
+                total = total_from_body(await response.body(), response.headers.get('content-type', ''))
+            except Exception:
+                continue
+            note_total(watch, total)
+        if watch['total'] is None and TOTAL_COUNT_SELECTOR:
+            try:
+                total = parse_counter_text(await page.locator(TOTAL_COUNT_SELECTOR).first.text_content(timeout=1000))
+                if total and total not in watch['rejected']:
+                    watch['total'], watch['source'] = total, "счетчик на странице"
+            except Exception:
+                pass
+        if watch['total'] and state.total_count is None:
+            state.total_count = watch['total']
+            print(f"🎯 Всего позиций в каталоге: {state.total_count} (источник: {watch['source']})")
+    
+    def on_response(response):
+        if NETWORK_URL_PATTERN.lower() in response.url.lower() and response.request.resource_type in ("xhr", "fetch"):
+            watch['responses'].append(response)
+    
+    async def wait_step(page, snapshot):
+        # То же, что wait_for_step, для асинхронной страницы
+        if snapshot is None:
+            await asyncio.sleep(2)
+            return "fixed"
+        try:
+            handle = await page.wait_for_function(
+                ROW_WAIT_CONDITION_JS,
+                arg={**snapshot, 'quietMs': SCROLL_QUIET_MS, 'idleMs': SCROLL_IDLE_MS},
+                polling=100,
+                timeout=SCROLL_WAIT_TIMEOUT * 1000
+            )
+            return await handle.json_value()
+        except PlaywrightTimeout:
+            return "timeout"
+    
+    async def table_end(page):
+        # То же, что table_end_reached, для асинхронной страницы
+        height = (await page.evaluate(SCROLL_STATE_JS))[2]
+        snapshot = await page.evaluate(ROW_WAIT_SNAPSHOT_JS) if WAIT_MODE == "event" else None
+        await page.evaluate(PIPELINE_SCROLL_JS, height)
+        await wait_step(page, snapshot)
+        return (await page.evaluate(SCROLL_STATE_JS))[2] <= height
+    
+    async def seek(page, target, max_stalled=3):
+        # То же, что seek_to_position: таблица растет по мере прокрутки, без перемотки ее высота - первая страница
+        stalled = 0
+        while stalled < max_stalled:
+            height = (await page.evaluate(SCROLL_STATE_JS))[2]
+            if height > target:
+                break
+            snapshot = await page.evaluate(ROW_WAIT_SNAPSHOT_JS) if WAIT_MODE == "event" else None
+            await page.evaluate(PIPELINE_SCROLL_JS, height)
+            await wait_step(page, snapshot)
+            stalled = stalled + 1 if (await page.evaluate(SCROLL_STATE_JS))[2] == height else 0
+        await page.evaluate(PIPELINE_SCROLL_JS, target)
+    
+    async def produce(page):
+        scroll_position = start_position
+        first_extraction = True
+        stable_end = 0
+        last_height = None
+        loop_started = time.monotonic()
+        steps = 0
+        max_height = MAX_SCROLL_POSITION
+        try:
+            while progress['empty_attempts'] < max_empty_attempts and not state.stop.is_set():
+                step_started = time.perf_counter()
+                steps += 1
+                snapshot = await page.evaluate(ROW_WAIT_SNAPSHOT_JS) if WAIT_MODE == "event" else None
+                with metrics.stage("scroll"):
+                    max_height = await page.evaluate(PIPELINE_SCROLL_JS, scroll_position)
+                progress['max_height'] = min(max_height, MAX_SCROLL_POSITION)
+                
+                # Ждем подгрузки контента
+                wait_started = time.perf_counter()
+                outcome = await wait_step(page, snapshot)
+                waited = time.perf_counter() - wait_started
+                metrics.add_stage("wait", waited)
+                metrics.observe("step_wait_seconds", waited)
+                metrics.count(f"wait_outcome_{outcome}")
+                
+                # Снимаем строки и сразу передаем дальше, не дожидаясь разбора
+                if EXTRACTION_MODE == "evaluate":
+                    with metrics.stage("evaluate"):
+                        rows = await page.evaluate(EXTRACT_NEW_ROWS_JS, list(state.seen_ids) if first_extraction else None)
+                    first_extraction = False
+                    await put(raw_queue, (scroll_position, "rows", rows))
+                else:
+                    with metrics.stage("page_content"):
+                        html_content = await page.content()
+                    metrics.count("page_content_bytes", len(html_content))
+                    await put(raw_queue, (scroll_position, "html", html_content))
+                
+                if BOUNDED_DOM:
+                    with metrics.stage("evict"):
+                        await page.evaluate(EVICT_ROWS_JS)
+                metrics.observe("step_seconds", time.perf_counter() - step_started)
+                
+                if state.total_count is None:
+                    await update_total(page)
+                elif progress['check_total']:
+                    # Писатель собрал total строк - страницу проверяет только производитель
+                    progress['check_total'] = False
+                    if await table_end(page):
+                        progress['early_stop'] = "total_reached"
+                        state.stop.set()
+                    else:
+                        reject_total(watch, state)
+                # Писатель отстает на длину очереди, поэтому пустые шаги внизу считаются по его счетчику
+                if progress['empty_attempts']:
+                    top, client_height, height = await page.evaluate(SCROLL_STATE_JS)
+                    at_end = top + client_height >= height - 2 and height == last_height
+                    stable_end = stable_end + 1 if at_end else 0
+                    last_height = height
+                    if stable_end >= SCROLL_END_STABLE_STEPS:
+                        progress['early_stop'] = "scroll_end"
+                else:
+                    stable_end = 0
+                
+                scroll_position += SCROLL_STEP
+                if progress['early_stop']:
+                    break
+                if scroll_position >= max_height:
+                    # Высота снята до ожидания: после перемотки она могла с тех пор вырасти
+                    max_height = (await page.evaluate(SCROLL_STATE_JS))[2]
+                if scroll_position >= max_height or scroll_position >= MAX_SCROLL_POSITION:
+                    print(f"🏁 Достигнут предел прокрутки: {scroll_position}px")
+                    break
+                if WAIT_MODE != "event":
+                    await asyncio.sleep(SCROLL_STEP_PAUSE)
+            
+            if progress['early_stop']:
+                limit = min(max_height, MAX_SCROLL_POSITION)
+                remaining_steps = max(0, -(-(limit - scroll_position) // SCROLL_STEP))
+                report_early_stop(progress['early_stop'], remaining_steps, (time.monotonic() - loop_started) / max(1, steps))
+        finally:
+            await raw_queue.put(None)
+    
+    async def parse():
+        while True:
+            message = await raw_queue.get()
+            if message is None:
+                await write_queue.put(None)
+                return
+            position, kind, payload = message
+            if kind == "html":
+                # Разбор уходит в пул, в очередь записи кладется его future - порядок шагов сохраняется
+                rows = loop.run_in_executor(parse_pool, parse_table_container_rows, payload)
+            else:
+                rows = loop.create_future()
+                rows.set_result(payload)
+            await put(write_queue, (position, kind, rows))
+    
+    async def write():
+        while True:
+            message = await write_queue.get()
+            if message is None:
+                return
+            position, kind, rows = message
+            with metrics.stage("pipeline_parse_wait"):
+                rows = await rows
+            claimed = state.claim(row[0] for row in rows)
+            new_rows = []
+            for row in rows:
+                if row[0] in claimed:
+                    claimed.discard(row[0])
+                    new_rows.append(row)
+            if kind == "rows":
+                # HTML содержит всю таблицу, поэтому повторы считаются только для evaluate
+                metrics.count("rows_extracted", len(rows))
+                metrics.count("rows_duplicate", len(rows) - len(new_rows))
+            
+            metrics.count("scroll_steps")
+            metrics.count("rows_collected", len(new_rows))
+            metrics.observe("step_new_rows", len(new_rows))
+            if new_rows:
+                # Запись и fsync журнала блокируют, поэтому выполняются в потоке
+                await loop.run_in_executor(None, state.add_item, {'position': position, 'rows': new_rows}, position)
+                progress['empty_attempts'] = 0
+                print(f"✅ Найдено {len(new_rows)} новых строк на позиции {position}px (всего: {len(state.seen_ids)})")
+                state.report_progress(position, start_position, progress['max_height'])
+                if state.complete() and not progress['early_stop']:
+                    progress['check_total'] = True
+            else:
+                metrics.count("empty_steps")
+                progress['empty_attempts'] += 1
+                if progress['empty_attempts'] % 10 == 0:
+                    print(f"⏳ Новых данных не найдено на позиции {position}px (попытка {progress['empty_attempts']}/{max_empty_attempts})")
+            progress['position'] = position
+            await loop.run_in_executor(None, state.record_step, position)
+    
+    try:
+        async with async_playwright() as p:
+            print(f"🌐 Запуск браузера конвейера (headless={HEADLESS})...")
+            browser = await p.chromium.launch(headless=HEADLESS, args=BROWSER_ARGS)
+            context = await browser.new_context(**context_options())
+            await setup_resource_blocking_async(context)
+            try:
+                page = await context.new_page()
+                page.set_default_timeout(PAGE_TIMEOUT)
+                page.on("response", on_response)
+                print("📋 Переход на страницу номенклатур...")
+                await page.goto(NOMENCLATURES_URL, wait_until="domcontentloaded", timeout=PAGE_TIMEOUT)
+                try:
+                    await page.wait_for_selector(
+                        '.table_container tr[id], input[name="email"]', state="attached", timeout=POST_NAVIGATION_WAIT * 1000
+                    )
+                except PlaywrightTimeout:
+                    print(f"⚠️ Строки таблицы не появились за {POST_NAVIGATION_WAIT} секунд, продолжаем")
+                if await page.locator('input[name="email"]').count():
+                    print("❌ Сессия конвейера недействительна (открылась страница входа)")
+                    return len(state.seen_ids)
+                await page.evaluate("""
+                    () => {
+                        for (const element of [...document.getElementsByClassName('folder_container')]) {
+                            element.remove();
+                        }
+                    }
+                """)
+                
+                if start_position:
+                    print(f"⏩ Перемотка к позиции {start_position}px...")
+                    await seek(page, start_position)
+                print(f"🔄 Конвейер: прокрутка с позиции {start_position}px, очередь {PIPELINE_QUEUE_SIZE} шагов")
+                await asyncio.gather(produce(page), parse(), write())
+            finally:
+                await context.close()
+                await browser.close()
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+        # Сохраняем только позицию, до которой все строки уже в журнале
+        if state.item_count:
+            state.checkpoint(progress['position'])
+    
+    print(f"✅ Конвейер завершен. Всего собрано {len(state.seen_ids)} уникальных строк.")
+    return len(state.seen_ids)
+
+
+
+# --- Функция запуска асинхронного конвейера ---
+def crawl_pipeline(start_position=0):
+    """Запускает конвейер в отдельном потоке со своим циклом событий и корректно останавливает его по Ctrl+C"""
+    state = CrawlState()
+    # В главном потоке уже работает синхронный Playwright со своим циклом событий
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(asyncio.run, pipeline_crawl(start_position, state))
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            # Прокрутка останавливается, уже снятые шаги дописываются в журнал
+            print("\n⚠️ Остановка конвейера: дописываем уже снятые строки в журнал...")
+            state.stop.set()
+            future.result()
+            raise
+        finally:
+            state.close()
+
+
+
+# --- Поля записи в порядке сырой строки и ключи JSON, по которым они ищутся ---
+NETWORK_FIELDS = ['id', 'code', 'shortname', 'fullname', 'stock', 'price', 'ntd', 'steel', 'weight']
+NETWORK_FIELD_CANDIDATES = {
+    'id': ['id', 'guid', 'uid', 'ref_key', 'refkey'],
+    'code': ['code', 'kod', 'nomenclaturecode', 'article'],
+    'shortname': ['shortname', 'short_name', 'name', 'title'],
+    'fullname': ['fullname', 'full_name', 'fulltitle', 'description'],
+    # count и amount в списочных API обычно итог или сумма денег - для остатка только через NETWORK_FIELD_MAP
+    'stock': ['stock', 'rest', 'balance', 'quantity'],
+    'price': ['price', 'cost'],
+    'ntd': ['ntd', 'standard', 'gost'],
+    'steel': ['steel', 'steelgrade', 'steel_grade', 'mark', 'grade'],
+    'weight': ['weight', 'mass']
+}
+NETWORK_PAGE_CANDIDATES = ['page', 'pagenumber', 'pageindex', 'skip', 'offset', 'start', 'from']
+NETWORK_SIZE_CANDIDATES = ['pagesize', 'size', 'limit', 'take', 'perpage', 'per_page']
+NETWORK_OFFSET_PARAMS = {'skip', 'offset', 'start', 'from'}
+
+
+
+# --- Функция подписки на ответы API номенклатур ---
+def start_network_capture(page):
+    """Подписывается на ответы страницы и копит подходящие под NETWORK_URL_PATTERN"""
+    captured = []
+    
+    def on_response(response):
+        if NETWORK_URL_PATTERN.lower() not in response.url.lower():
+            return
+        if response.request.resource_type not in ("xhr", "fetch", "document"):
+            return
+        captured.append(response)
+    
+    page.on("response", on_response)
+    print(f"🛰️ Перехват ответов включен (шаблон URL: '{NETWORK_URL_PATTERN}')")
+    return captured
+
+
+
+# --- Функция поиска списка записей в JSON ---
+def find_record_list(payload):
+    """Возвращает самый длинный список объектов внутри JSON-ответа"""
+    best = []
+    stack = [payload]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            if len(node) > len(best) and all(isinstance(x, dict) for x in node):
+                best = node
+            stack.extend(node)
+        elif isinstance(node, dict):
+            stack.extend(node.values())
+    return best
+
+
+
+# --- Функция сопоставления полей JSON с колонками таблицы ---
+def resolve_field_map(record):
+    """Определяет, из каких ключей JSON брать значения колонок"""
+    field_map = {}
+    if NETWORK_FIELD_MAP:
+        for pair in NETWORK_FIELD_MAP.split(','):
+            if ':' in pair:
+                field, key = pair.split(':', 1)
+                field_map[field.strip()] = key.strip()
+    
+    keys = {key.lower(): key for key in record}
+    for field in NETWORK_FIELDS:
+        if field in field_map:
+            continue
+        for candidate in NETWORK_FIELD_CANDIDATES[field]:
+            if candidate in keys:
+                field_map[field] = keys[candidate]
+                break
+    
+    if 'id' not in field_map and 'code' in field_map:
+        field_map['id'] = field_map['code']
+    return field_map
+
+
+
+# --- Функция приведения значения JSON к тексту ячейки ---
+def json_value(value):
+    """Приводит значение из JSON к строке, как оно выглядело бы в ячейке"""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+
+# --- Функция преобразования тела ответа в сырые строки ---
+def rows_from_payload(body, content_type):
+    """Строит сырые строки [id, значения ячеек...] из JSON или HTML ответа"""
+    if 'json' in content_type:
+        try:
+            records = find_record_list(json.loads(body))
+        except ValueError:
+            return []
+        if not records:
+            return []
+        field_map = resolve_field_map(records[0])
+        if 'id' not in field_map:
+            return []
+        return [
+            [json_value(record.get(field_map[field])) if field in field_map else '' for field in NETWORK_FIELDS]
+            for record in records
+        ]
+    if 'html' in content_type:
+        return [row for row in parse_html_rows(body.decode('utf-8', errors='replace')) if len(row) > 1]
+    return []
+
+
+
+# --- Функция разбора перехваченных ответов ---
+def drain_captured_responses(captured):
+    """Читает тела накопленных ответов и возвращает их вместе с разобранными строками"""
+    payloads = []
+    while captured:
+        response = captured.pop(0)
+        try:
+            body = response.body()
+        except Exception as e:
+            print(f"⚠️ Не удалось прочитать ответ {response.url}: {e}")
+            continue
+        content_type = response.headers.get('content-type', '')
+        rows = rows_from_payload(body, content_type)
+        if rows:
+            request = response.request
+            payloads.append({
+                'url': response.url,
+                'method': request.method,
+                'headers': request.headers,
+                'post_data': request.post_data,
+                'rows': rows,
+                'total': total_from_body(body, content_type)
+            })
+    return payloads
+
+
+
+# --- Функция определения параметров постраничной выдачи ---
+def learn_paging(payloads):
+    """Находит в перехваченных запросах endpoint и параметры страницы/размера"""
+    for payload in payloads:
+        sources = [('query', dict(parse_qsl(urlsplit(payload['url']).query, keep_blank_values=True)))]
+        if payload['post_data']:
             try:
-                return float(price.replace(',', '.'))
-            except:
-                return 0.0
-        
-        # Парсинг новых данных
-        print("📊 Парсинг HTML данных из pickle...")
-        total_html_rows = 0
-        for item in data_list:
-            soup = BeautifulSoup(item['html_content'], 'html.parser')
-            rows = soup.find_all('tr', id=True)
-            total_html_rows += len(rows)
-            
-            for row in rows:
-                cells = row.find_all('td')
-                if len(cells) >= 8:
-                    data['Код номенклатуры'].append(cells[0].text.strip())
-                    
-                    shortname_div = cells[1].find('div', class_='row_width_copy')
-                    data['Наименование товара'].append(
-                        shortname_div.find('span').text.strip() 
-                        if shortname_div and shortname_div.find('span') else ''
-                    )
-                    
-                    fullname_div = cells[2].find('div', class_='row_width_copy')
-                    data['Полное наименование'].append(
-                        fullname_div.find('span').text.strip() 
-                        if fullname_div and fullname_div.find('span') else ''
-                    )
-                    
-                    try:
-                        data['Остаток'].append(int(cells[3].text.strip()))
-                    except:
-                        data['Остаток'].append(0)
-                    
-                    price_div = cells[4].find('div', class_='row_width_copy')
-                    price = price_div.find('span').text.strip() if price_div and price_div.find('span') else '0'
-                    data['Цена (руб)'].append(clean_price(price))
-                    
-                    data['НТД'].append(cells[5].text.strip())
-                    data['Марка стали'].append(cells[6].text.strip())
-                    
-                    try:
-                        data['Вес'].append(float(cells[7].text.strip()))
-                    except:
-                        data['Вес'].append(0.0)
-        
-        # Создание DataFrame с новыми данными
-        new_df = pd.DataFrame(data)
-        print(f"📝 Распарсено {total_html_rows} HTML строк → {len(new_df)} записей товаров")
-        
-        # Проверка существования финального файла и объединение данных
-        if os.path.exists(output_file):
-            print(f"📂 Файл {output_file} уже существует, загружаем...")
-            existing_df = pd.read_excel(output_file, engine='openpyxl')
-            print(f"📋 В существующем файле {len(existing_df)} записей")
-            
-            # Получаем существующие коды номенклатуры
-            existing_codes = set(existing_df['Код номенклатуры'].values)
-            new_codes = set(new_df['Код номенклатуры'].values)
-            
-            # Определяем обновленные и новые записи
-            updated_codes = existing_codes.intersection(new_codes)
-            added_codes = new_codes - existing_codes
-            
-            print(f"🔄 Будет обновлено записей: {len(updated_codes)}")
-            print(f"➕ Будет добавлено новых записей: {len(added_codes)}")
-            
-            # Удаляем из старого DataFrame записи, которые будут обновлены
-            existing_df = existing_df[~existing_df['Код номенклатуры'].isin(updated_codes)]
-            
-            # Объединяем старые (без обновляемых) и новые данные
-            result_df = pd.concat([existing_df, new_df], ignore_index=True)
-            
-            # Удаляем полные дубликаты
-            before_dedup = len(result_df)
-            result_df = result_df.drop_duplicates(subset=['Код номенклатуры'], keep='last')
-            removed_dupes = before_dedup - len(result_df)
-            
-            if removed_dupes > 0:
-                print(f"🗑️ Удалено дубликатов: {removed_dupes}")
-            
-            print(f"✅ Итого записей в финальном файле: {len(result_df)}")
-        else:
-            print(f"📄 Создается новый файл {output_file}")
-            result_df = new_df
-            before_dedup = len(result_df)
-            result_df = result_df.drop_duplicates(subset=['Код номенклатуры'], keep='last')
-            removed_dupes = before_dedup - len(result_df)
-            
-            if removed_dupes > 0:
-                print(f"🗑️ Удалено дубликатов по коду номенклатуры: {removed_dupes}")
-            
-            print(f"✅ Уникальных записей: {len(result_df)}")
-        
-        # Сортировка по коду номенклатуры
-        result_df = result_df.sort_values('Код номенклатуры').reset_index(drop=True)
-        
-        # Сохранение результата
-        result_df.to_excel(output_file, index=False, engine='openpyxl')
-        print(f"💾 Таблица сохранена в {output_file}")
-        
-        # Статистика
-        print("\n📊 Статистика:")
-        print(f"   🔢 HTML строк собрано: {len(data_list)}")
-        print(f"   📦 Записей товаров распарсено: {total_html_rows}")
-        print(f"   ✅ Уникальных товаров в финале: {len(result_df)}")
-        print(f"   🗑️ Дубликатов удалено: {total_html_rows - len(result_df)}")
-        
-        clear_temp_files()
-        print("\n🗑️ Временные файлы удалены после создания финального Excel.")
+                body = json.loads(payload['post_data'])
+                if isinstance(body, dict):
+                    sources.append(('body', body))
+            except ValueError:
+                pass
         
-    except Exception as e:
-        print(f"❌ Ошибка при обработке HTML и создании финального Excel: {e}")
-        import traceback
-        traceback.print_exc()
+        for location, params in sources:
+            keys = {key.lower(): key for key in params}
+            page_param = NETWORK_PAGE_PARAM or next((keys[c] for c in NETWORK_PAGE_CANDIDATES if c in keys), None)
+            if not page_param or page_param not in params:
+                continue
+            size_param = NETWORK_SIZE_PARAM or next((keys[c] for c in NETWORK_SIZE_CANDIDATES if c in keys), None)
+            try:
+                start_value = int(params[page_param])
+            except (TypeError, ValueError):
+                continue
+            is_offset = page_param.lower() in NETWORK_OFFSET_PARAMS
+            # Смещение всегда начинается с 0; номер страницы 1 (или больше) в первом перехваченном
+            # запросе не говорит, с 0 или с 1 нумерует API - страница 0 могла прийти вместе с документом
+            return {
+                'url': payload['url'],
+                'method': payload['method'],
+                'headers': {
+                    k: v for k, v in payload['headers'].items()
+                    if k.lower() not in ('content-length', 'host', 'cookie')
+                },
+                'location': location,
+                'params': params,
+                'page_param': page_param,
+                'size_param': size_param if size_param in params else None,
+                'is_offset': is_offset,
+                'start_value': 0 if is_offset else min(start_value, 1),
+                'probe_zero': not is_offset and start_value > 0
+            }
+    return None
 
 
 
-# --- Функция медленной прокрутки контейнера main_content_container ---
-def scroll_to_load_table_container(page, start_position=0, scroll_step=None, max_empty_attempts=10000):
-    """Постепенно прокручивает страницу и собирает данные"""
-    if scroll_step is None:
-        scroll_step = SCROLL_STEP
-        
-    print(f"🔄 Начинаем поэтапную прокрутку main_content_container с позиции {start_position}px...")
-    data_to_save = []
-    seen_ids = set()
-    empty_attempts = 0
+# --- Функция запроса одной страницы выдачи ---
+def fetch_network_page(context, paging, value):
+    """Запрашивает страницу выдачи через context.request с cookies текущей сессии"""
+    params = dict(paging['params'])
+    params[paging['page_param']] = value
+    if paging['size_param']:
+        params[paging['size_param']] = NETWORK_PAGE_SIZE
+    
+    if paging['location'] == 'query':
+        parts = urlsplit(paging['url'])
+        url = urlunsplit(parts._replace(query=urlencode(params)))
+        response = context.request.fetch(url, method=paging['method'], headers=paging['headers'])
+    else:
+        response = context.request.fetch(
+            paging['url'], method=paging['method'], headers=paging['headers'], data=json.dumps(params)
+        )
+    
+    if not response.ok:
+        print(f"⚠️ Ответ {response.status} при запросе страницы {value}")
+        return None
+    body = response.body()
+    metrics.count("network_body_bytes", len(body))
+    return rows_from_payload(body, response.headers.get('content-type', ''))
+
+
+
+# --- Функция определения начала нумерации страниц ---
+def probe_zero_page(context, paging):
+    """Запрашивает страницы 0 и 1: нумерация с 0, если на странице 0 есть строки, которых нет на 1"""
+    with metrics.stage("network_fetch"):
+        zero_rows = fetch_network_page(context, paging, 0)
+        first_rows = fetch_network_page(context, paging, 1) if zero_rows else None
+    metrics.count("network_pages", 2 if zero_rows else 1)
+    # API с нумерацией с 1 обычно отдает на 0 пустую страницу, ошибку или ту же первую страницу
+    if zero_rows and {row[0] for row in zero_rows} - {row[0] for row in first_rows or []}:
+        print(f"🔎 Страница {paging['page_param']}=0 содержит свои строки: нумерация с 0")
+        return 0
+    print(f"🔎 Страница {paging['page_param']}=0 не добавляет строк: нумерация с 1")
+    return 1
+
+
+
+# --- Функция сбора данных через API номенклатур ---
+def crawl_via_network(page, context, captured, start_position=0):
+    """Собирает записи из ответов API, а после изучения endpoint листает его напрямую"""
+    print("🛰️ Сбор данных через перехват ответов API...")
+    state = CrawlState()
+    # Строки из ответов API не привязаны к пикселям прокрутки - в индекс позиций их не пишем
+    state.index_rows = False
+    
+    def add_rows(rows, position):
+        claimed = state.claim(row[0] for row in rows)
+        new_rows = [row for row in rows if row[0] in claimed]
+        if new_rows:
+            state.add_item({'position': position, 'rows': new_rows}, position)
+        metrics.count("rows_collected", len(new_rows))
+        return len(new_rows)
+    
+    # Несколько шагов прокрутки, чтобы страница сама запросила данные
+    use_container = detect_scroll_container(page)
     scroll_position = start_position
+    payloads = drain_captured_responses(captured)
+    for _ in range(NETWORK_LEARN_STEPS):
+        scroll_position += SCROLL_STEP
+        snapshot = take_wait_snapshot(page)
+        scroll_to_position(page, scroll_position, use_container)
+        wait_for_step(page, snapshot)
+        payloads.extend(drain_captured_responses(captured))
     
-    # Загрузка уже сохранённых данных
-    data_to_save = load_temp_data()
-    for item in data_to_save:
-        soup = BeautifulSoup(item['html_content'], 'html.parser')
-        for tr in soup.find_all('tr', id=True):
-            seen_ids.add(tr['id'])
+    totals = new_total_watch()
+    for payload in payloads:
+        added = add_rows(payload['rows'], scroll_position)
+        print(f"📥 Перехвачен ответ {payload['method']} {payload['url']}: {len(payload['rows'])} строк, новых {added}")
+        note_total(totals, payload['total'])
+    state.total_count = totals['total']
+    if state.total_count:
+        print(f"🎯 Всего позиций в каталоге: {state.total_count} (источник: API)")
     
-    if seen_ids:
-        print(f"📂 Загружено {len(seen_ids)} уникальных id из сохраненных данных")
+    paging = learn_paging(payloads)
+    if not paging:
+        print("⚠️ Не удалось определить параметры постраничной выдачи, переключаемся на прокрутку")
+        state.index_rows = True
+        total = scroll_to_load_table_container(page, scroll_position, state=state)
+        state.close()
+        return total
     
-    # Проверка наличия контейнера
-    try:
-        container = page.locator(".main_content_container").first
-        if container.count() > 0:
-            print("✅ Найден контейнер main_content_container")
-            use_container = True
-        else:
-            print("⚠️ Контейнер не найден, используем прокрутку окна")
-            use_container = False
-    except:
-        print("⚠️ Используем прокрутку окна вместо контейнера")
-        use_container = False
-    
-    while empty_attempts < max_empty_attempts:
-        # Получаем текущую высоту
-        if use_container:
-            max_height = page.evaluate("""
-                () => {
-                    const container = document.querySelector('.main_content_container');
-                    return container ? container.scrollHeight : 0;
-                }
-            """)
-        else:
-            max_height = page.evaluate("() => document.body.scrollHeight")
-        
-        # Прокручиваем по шагу
-        if use_container:
-            page.evaluate(f"""
-                () => {{
-                    const container = document.querySelector('.main_content_container');
-                    if (container) {{
-                        container.scrollTop = {scroll_position};
-                    }}
-                }}
-            """)
-        else:
-            page.evaluate(f"() => window.scrollTo(0, {scroll_position})")
-        
-        # Ждем подгрузки контента
-        time.sleep(2)
-        
-        # Парсим новые строки
-        html_content = page.content()
-        soup = BeautifulSoup(html_content, 'html.parser')
-        table_container = soup.find('div', class_='table_container')
-        
-        new_trs = []
-        if table_container:
-            for tr in table_container.find_all('tr', id=True):
-                tr_id = tr['id']
-                if tr_id not in seen_ids:
-                    seen_ids.add(tr_id)
-                    new_trs.append(str(tr))
-        
-        if new_trs:
-            html_content = "<table>" + "".join(new_trs) + "</table>"
-            data_to_save.append({
-                'position': scroll_position,
-                'html_content': html_content
-            })
-            empty_attempts = 0
-            print(f"✅ Найдено {len(new_trs)} новых строк на позиции {scroll_position}px (всего: {len(seen_ids)})")
-            
-            # Сохраняем промежуточные данные каждые 50 новых записей
-            if len(data_to_save) % 50 == 0:
-                save_temp_data(data_to_save)
-                save_last_position(scroll_position)
-        else:
-            empty_attempts += 1
-            if empty_attempts % 10 == 0:
-                print(f"⏳ Новых данных не найдено на позиции {scroll_position}px (попытка {empty_attempts}/{max_empty_attempts})")
-        
-        # Увеличиваем позицию прокрутки
-        scroll_position += scroll_step
-        
-        # Проверяем достижение максимальной высоты или лимита
-        if scroll_position >= max_height or scroll_position >= MAX_SCROLL_POSITION:
-            print(f"🏁 Достигнут предел прокрутки: {scroll_position}px")
+    print(f"🔎 Endpoint: {paging['method']} {paging['url']}")
+    print(f"   Параметр страницы: {paging['page_param']}, размер: {paging['size_param'] or 'нет'}")
+    if paging['probe_zero']:
+        paging['start_value'] = probe_zero_page(context, paging)
+    
+    # Размер страницы - длина первой полученной: API может урезать запрошенный NETWORK_PAGE_SIZE
+    page_size = None
+    previous_ids = None
+    value = paging['start_value']
+    confirming = False  # Собрано total строк: следующая страница проверяет, что выдача кончилась
+    for page_number in range(NETWORK_MAX_PAGES):
+        confirming = confirming or state.complete()
+        with metrics.stage("network_fetch"):
+            rows = fetch_network_page(context, paging, value)
+        metrics.count("network_pages")
+        if not rows:
+            print(f"🏁 Пустая страница выдачи на значении {paging['page_param']}={value}")
             break
-        
-        # Небольшая пауза между итерациями
-        time.sleep(SCROLL_STEP_PAUSE)
+        page_ids = [row[0] for row in rows]
+        if page_ids == previous_ids:
+            print(f"🏁 Повтор предыдущей страницы на значении {paging['page_param']}={value}: параметр страницы не действует")
+            break
+        previous_ids = page_ids
+        # Номер страницы API - не позиция прокрутки: в журнал и прогресс идет достигнутая прокрутка,
+        # а выдача при возобновлении листается заново с отсевом уже собранных id.
+        # Поэтому страница без новых строк - не конец выдачи (уже собрана в прошлый раз или при изучении)
+        added = add_rows(rows, scroll_position)
+        print(f"✅ Страница {page_number + 1}: {len(rows)} строк, новых {added} (всего: {len(state.seen_ids)})")
+        state.report_progress(value, paging['start_value'], None)
+        if confirming:
+            if not added:
+                print(f"🏁 Собран весь каталог ({state.total_count} позиций), следующая страница новых строк не дала")
+                metrics.count("early_stop_total_reached")
+                break
+            reject_total(totals, state)
+            confirming = False
+        if page_size is None:
+            page_size = len(rows)
+        elif len(rows) < page_size:
+            print(f"🏁 Неполная страница ({len(rows)} из {page_size} строк), выдача закончилась")
+            break
+        value += len(rows) if paging['is_offset'] else 1
     
-    # Финальное сохранение данных
-    if data_to_save:
-        save_temp_data(data_to_save)
-        save_last_position(scroll_position)
-        print(f"✅ Сбор данных завершен. Всего собрано {len(seen_ids)} уникальных HTML строк.")
+    # Неполная выдача (например, неверно угаданное начало нумерации) иначе закончилась бы молча
+    if state.total_count and not state.complete():
+        print(f"⚠️ Через API собрано {len(state.seen_ids)} из {state.total_count} позиций, досбор прокруткой")
+        state.index_rows = True
+        scroll_to_load_table_container(page, scroll_position, state=state)
+    
+    state.checkpoint(scroll_position)
+    state.close()
+    print(f"✅ Сбор через API завершен. Всего собрано {len(state.seen_ids)} уникальных строк.")
+    return len(state.seen_ids)
+
+
+
+# --- Функция перехода на страницу номенклатур ---
+def open_nomenclatures(page):
+    """Открывает страницу номенклатур и ждет загрузки таблицы"""
+    print("📋 Переход на страницу номенклатур...")
+    started = time.monotonic()
+    page.goto(NOMENCLATURES_URL, wait_until="domcontentloaded", timeout=PAGE_TIMEOUT)
+    
+    if WAIT_MODE == "event":
+        # Форма входа вместо таблицы означает, что сессия недействительна
+        print(f"⏳ Ожидание первых строк таблицы (не более {POST_NAVIGATION_WAIT} секунд)...")
+        try:
+            page.wait_for_selector(
+                '.table_container tr[id], input[name="email"]', state="attached", timeout=POST_NAVIGATION_WAIT * 1000
+            )
+            print(f"⏱️ Страница загружена за {time.monotonic() - started:.1f}с")
+        except PlaywrightTimeout:
+            print(f"⚠️ Строки таблицы не появились за {POST_NAVIGATION_WAIT} секунд, продолжаем")
+    else:
+        print(f"⏳ Ожидание {POST_NAVIGATION_WAIT} секунд для загрузки страницы...")
+        page.wait_for_timeout(POST_NAVIGATION_WAIT * 1000)
+    metrics.add_stage("navigation", time.monotonic() - started)
     
-    return len(seen_ids)
+    return not page.url.startswith(LOGIN_URL) and page.locator('input[name="email"]').count() == 0
 
 
 
@@ -421,14 +3158,20 @@ def login_and_navigate(page):
         print("🔐 Отправка данных авторизации...")
         page.click('button[type="submit"]')
         
-        print(f"⏳ Ожидание {POST_LOGIN_WAIT} секунд после авторизации...")
-        time.sleep(POST_LOGIN_WAIT)
-        
-        print("📋 Переход на страницу номенклатур...")
-        page.goto(NOMENCLATURES_URL, wait_until="domcontentloaded", timeout=PAGE_TIMEOUT)
+        if WAIT_MODE == "event":
+            print(f"⏳ Ожидание ухода со страницы входа (не более {POST_LOGIN_WAIT} секунд)...")
+            started = time.monotonic()
+            try:
+                page.wait_for_url(lambda url: not url.startswith(LOGIN_URL), timeout=POST_LOGIN_WAIT * 1000)
+                print(f"⏱️ Авторизация подтверждена за {time.monotonic() - started:.1f}с")
+            except PlaywrightTimeout:
+                print(f"⚠️ Страница входа не сменилась за {POST_LOGIN_WAIT} секунд, продолжаем")
+        else:
+            print(f"⏳ Ожидание {POST_LOGIN_WAIT} секунд после авторизации...")
+            page.wait_for_timeout(POST_LOGIN_WAIT * 1000)
         
-        print(f"⏳ Ожидание {POST_NAVIGATION_WAIT} секунд для загрузки страницы...")
-        time.sleep(POST_NAVIGATION_WAIT)
+        if not open_nomenclatures(page):
+            return False
         
         print("✅ Авторизация успешна!")
         return True
@@ -442,6 +3185,33 @@ def login_and_navigate(page):
 
 
 
+# --- Функция проверки сохраненной сессии ---
+def ensure_session(page):
+    """Открывает страницу номенклатур с сохраненной сессией и авторизуется, только если она устарела"""
+    if os.path.exists(STORAGE_STATE_FILE):
+        print(f"🔑 Проверка сохраненной сессии из {STORAGE_STATE_FILE}...")
+        try:
+            if open_nomenclatures(page):
+                print("✅ Сессия действительна, авторизация пропущена")
+                return True
+            print("⚠️ Сессия устарела (переадресация на страницу входа)")
+        except Exception as e:
+            print(f"⚠️ Ошибка при проверке сессии: {e}")
+    return login_and_navigate(page)
+
+
+
+# --- Функция сохранения состояния сессии ---
+def save_storage_state(context):
+    """Сохраняет cookies и localStorage контекста для следующих запусков"""
+    try:
+        context.storage_state(path=STORAGE_STATE_FILE)
+        print(f"💾 Состояние сессии сохранено в {STORAGE_STATE_FILE}")
+    except Exception as e:
+        print(f"⚠️ Ошибка при сохранении состояния сессии: {e}")
+
+
+
 # --- Функция сохранения cookies ---
 def save_cookies(context):
     """Сохраняет cookies в файл"""
@@ -473,29 +3243,268 @@ def load_cookies(context):
 
 
 
+# --- Статистика блокировки ресурсов за запуск (общая для всех контекстов) ---
+resource_stats = {'blocked': {}, 'loaded': {}, 'loaded_bytes': {}}
+resource_stats_lock = threading.Lock()
+
+
+
+# --- Функция сброса статистики ресурсов ---
+def reset_resource_stats():
+    """Обнуляет счетчики ресурсов перед очередным заданием службы"""
+    with resource_stats_lock:
+        for stats in resource_stats.values():
+            stats.clear()
+
+
+
+# --- Функция классификации запроса для блокировки ---
+def blocked_category(request, portal_host):
+    """Возвращает причину блокировки запроса или None, если его нужно пропустить"""
+    url = request.url
+    if any(allowed in url for allowed in BLOCK_ALLOWLIST):
+        return None
+    resource_type = request.resource_type
+    if resource_type in BLOCK_RESOURCE_TYPES or (BLOCK_CSS and resource_type == "stylesheet"):
+        return resource_type
+    if any(domain in url for domain in TRACKER_DOMAINS):
+        return "tracker"
+    if BLOCK_THIRD_PARTY_SCRIPTS and resource_type == "script" and urlsplit(url).hostname != portal_host:
+        return "third_party_script"
+    return None
+
+
+
+# --- Функция учета заблокированного запроса ---
+def count_blocked(category):
+    """Увеличивает счетчик заблокированных запросов по причине"""
+    with resource_stats_lock:
+        resource_stats['blocked'][category] = resource_stats['blocked'].get(category, 0) + 1
+
+
+
+# --- Функция размера полученного ответа ---
+def received_bytes(sizes):
+    """Возвращает байты ответа, полученные по сети: заголовки и тело в сжатом виде"""
+    return max(0, sizes.get('responseHeadersSize', 0)) + max(0, sizes.get('responseBodySize', 0))
+
+
+
+# --- Функция учета загруженного запроса ---
+def count_loaded(resource_type, size):
+    """Увеличивает счетчики загруженных запросов и байт по типу ресурса"""
+    with resource_stats_lock:
+        resource_stats['loaded'][resource_type] = resource_stats['loaded'].get(resource_type, 0) + 1
+        resource_stats['loaded_bytes'][resource_type] = resource_stats['loaded_bytes'].get(resource_type, 0) + size
+
+
+
+# --- Функция учета завершенного запроса ---
+def count_finished(request):
+    """Считает завершенный запрос по размерам, которые сообщает браузер (Content-Length часто нет)"""
+    try:
+        size = received_bytes(request.sizes())
+    except PlaywrightError:
+        size = 0  # Страница или контекст уже закрыты
+    count_loaded(request.resource_type, size)
+
+
+
+# --- Функция учета завершенного запроса (async) ---
+async def count_finished_async(request):
+    """То же, что count_finished, для контекста async_playwright"""
+    try:
+        size = received_bytes(await request.sizes())
+    except PlaywrightError:
+        size = 0
+    count_loaded(request.resource_type, size)
+
+
+
+# --- Функция проверки, включена ли блокировка ---
+def blocking_enabled():
+    """Возвращает True, если задан хотя бы один вид блокировки"""
+    return bool(BLOCK_RESOURCE_TYPES or BLOCK_CSS or TRACKER_DOMAINS or BLOCK_THIRD_PARTY_SCRIPTS)
+
+
+
+# --- Функция подключения блокировки ресурсов к контексту ---
+def setup_resource_blocking(context):
+    """Прерывает запросы картинок, шрифтов, трекеров и т.п. и считает загруженные байты"""
+    portal_host = urlsplit(NOMENCLATURES_URL).hostname
+    
+    def handle_route(route):
+        category = blocked_category(route.request, portal_host)
+        if category:
+            count_blocked(category)
+            route.abort()
+        else:
+            route.continue_()
+    
+    if blocking_enabled():
+        context.route("**/*", handle_route)
+    context.on("requestfinished", count_finished)
+
+
+
+# --- Функция подключения блокировки ресурсов к асинхронному контексту ---
+async def setup_resource_blocking_async(context):
+    """То же, что setup_resource_blocking, для контекста async_playwright"""
+    portal_host = urlsplit(NOMENCLATURES_URL).hostname
+    
+    async def handle_route(route):
+        category = blocked_category(route.request, portal_host)
+        if category:
+            count_blocked(category)
+            await route.abort()
+        else:
+            await route.continue_()
+    
+    if blocking_enabled():
+        await context.route("**/*", handle_route)
+    context.on("requestfinished", count_finished_async)
+
+
+
+# --- Функция вывода статистики блокировки ---
+def print_resource_stats():
+    """Печатает заблокированные запросы по типам (экономия) и загруженные запросы с байтами"""
+    with resource_stats_lock:
+        blocked = dict(resource_stats['blocked'])
+        loaded = dict(resource_stats['loaded'])
+        loaded_bytes = dict(resource_stats['loaded_bytes'])
+    print("🚫 Статистика ресурсов:")
+    # Размер заблокированного ответа неизвестен - экономия измеряется числом несделанных запросов
+    print(f"   Сэкономлено (заблокировано) запросов: {sum(blocked.values())}"
+          + (f" ({', '.join(f'{k}={v}' for k, v in sorted(blocked.items()))})" if blocked else ""))
+    print(f"   Загружено запросов: {sum(loaded.values())}, получено {sum(loaded_bytes.values()) / (1024 * 1024):.2f} МБ")
+    for resource_type, size in sorted(loaded_bytes.items(), key=lambda x: -x[1]):
+        print(f"      {resource_type}: {loaded[resource_type]} запросов, {size / 1024:.1f} КБ")
+
+
+
+# Аргументы запуска Chromium
+BROWSER_ARGS = [
+    '--disable-blink-features=AutomationControlled',
+    '--disable-dev-shm-usage',
+    '--no-sandbox'
+]
+
+
+
+# --- Функция запуска браузера ---
+def launch_browser(p):
+    """Запускает Chromium с настройками из .env"""
+    print(f"🌐 Запуск браузера (headless={HEADLESS})...")
+    return p.chromium.launch(headless=HEADLESS, args=BROWSER_ARGS)
+
+
+
+# --- Функция параметров контекста браузера ---
+def context_options():
+    """Возвращает viewport, user agent и сохраненную сессию для нового контекста"""
+    return {
+        'viewport': {'width': 1920, 'height': 1080},
+        'user_agent': USER_AGENT,
+        'ignore_https_errors': True,
+        'storage_state': STORAGE_STATE_FILE if os.path.exists(STORAGE_STATE_FILE) else None
+    }
+
+
+
+# --- Функция создания контекста браузера ---
+def create_context(browser):
+    """Создает контекст с нужным viewport и user agent, подхватывая сохраненную сессию"""
+    context = browser.new_context(**context_options())
+    setup_resource_blocking(context)
+    return context
+
+
+
+# --- Функция сбора и обработки данных на авторизованной странице ---
+def run_crawl(page, context, captured=None, ranges=None):
+    """Собирает таблицу (или только диапазоны ranges) с открытой страницы номенклатур и выгружает результат"""
+    # Папки нужны только обходу по папкам, остальным режимам они лишь утяжеляют DOM
+    if CRAWL_MODE != "folders" or ranges:
+        remove_folder_container(page)
+    
+    if ranges:
+        start_position = ranges[0][0]
+        print(f"🎯 Точечный пересбор: {', '.join(f'{start}-{end}px' for start, end in ranges)}")
+    else:
+        start_position = get_last_position()
+        print(f"📍 Начинаем с позиции: {start_position}px")
+    
+    print("="*60)
+    print("📊 НАЧАЛО СБОРА ДАННЫХ")
+    print("="*60)
+    emit_progress("phase", phase="crawl", position=start_position)
+    # Точечный пересбор заведомо не видел остальной каталог - удаленных по нему не определить
+    include_removed = False if ranges else None
+    with metrics.stage("crawl"):
+        if ranges:
+            total_html_rows = recrawl_ranges(page, ranges)
+        elif CRAWL_MODE == "network":
+            total_html_rows = crawl_via_network(page, context, captured, start_position)
+        elif CRAWL_MODE == "pipeline":
+            total_html_rows = crawl_pipeline(start_position)
+        elif CRAWL_MODE == "folders":
+            total_html_rows = crawl_folders(page)
+            # Записи пропущенных папок есть в хранилище, но не в журнале - иначе они попали бы в удаленные
+            if metrics.counters.get('folders_crawled', 0) < metrics.counters.get('folders_listed', 0):
+                include_removed = False
+        elif SHARD_COUNT > 1:
+            total_html_rows = crawl_sharded(start_position)
+        else:
+            total_html_rows = scroll_to_load_table_container(page, start_position)
+    
+    print("="*60)
+    print(f"✅ Сбор HTML завершен. Собрано {total_html_rows} уникальных HTML строк.")
+    print("="*60)
+    
+    print("\n🔄 Начинаем обработку собранных данных...")
+    emit_progress("phase", phase="process", rows=total_html_rows)
+    with metrics.stage("process"):
+        processed = process_html_to_excel(include_removed=include_removed)
+    if not processed:
+        # Файл результата остался от прошлого запуска - успехом такой запуск не считается
+        metrics.status = "error"
+        print("\n" + "="*60)
+        print(f"❌ ОБРАБОТКА НЕ ЗАВЕРШЕНА, {FINAL_EXCEL} не обновлен")
+        print("="*60)
+        return
+    metrics.status = "ok"
+    print("\n" + "="*60)
+    print(f"✅ ПРОГРАММА ЗАВЕРШЕНА УСПЕШНО")
+    print(f"📁 Результат сохранен в файл: {FINAL_EXCEL}")
+    print("="*60)
+
+
+
+# --- Функция завершения отчета о запуске ---
+def report_run():
+    """Пишет отчет о метриках и отправляет событие done"""
+    report = metrics.write()
+    metrics.print_stages(report)
+    emit_progress(
+        "done", status=report['status'], rows=report['counters'].get('rows_collected', 0),
+        duration_seconds=report['duration_seconds'], result=FINAL_EXCEL
+    )
+    return report
+
+
+
 # --- Главная функция ---
-def main():
-    """Главная функция программы"""
+def main(ranges=None):
+    """Главная функция программы (ranges - только точечный пересбор диапазонов прокрутки)"""
     print("="*60)
     print("🚀 ЗАПУСК ПРОГРАММЫ СБОРА ДАННЫХ")
     print("="*60)
     
     with sync_playwright() as p:
-        print(f"🌐 Запуск браузера (headless={HEADLESS})...")
-        browser = p.chromium.launch(
-            headless=HEADLESS,
-            args=[
-                '--disable-blink-features=AutomationControlled',
-                '--disable-dev-shm-usage',
-                '--no-sandbox'
-            ]
-        )
-        
-        context = browser.new_context(
-            viewport={'width': 1920, 'height': 1080},
-            user_agent=USER_AGENT,
-            ignore_https_errors=True
-        )
+        with metrics.stage("browser_start"):
+            browser = launch_browser(p)
+            context = create_context(browser)
         
         page = context.new_page()
         page.set_default_timeout(PAGE_TIMEOUT)
@@ -503,47 +3512,382 @@ def main():
         try:
             cookies_loaded = load_cookies(context)
             
-            if not login_and_navigate(page):
+            # Перехват подключаем до авторизации, чтобы не пропустить первые ответы списка
+            captured = start_network_capture(page) if CRAWL_MODE == "network" else None
+            
+            emit_progress("phase", phase="session")
+            with metrics.stage("session"):
+                session_ok = ensure_session(page)
+            if not session_ok:
                 print("❌ Не удалось авторизоваться. Завершение работы.")
+                metrics.status = "login_failed"
                 return
             
             save_cookies(context)
-            remove_folder_container(page)
-            
-            start_position = get_last_position()
-            print(f"📍 Начинаем с позиции: {start_position}px")
-            
-            print("="*60)
-            print("📊 НАЧАЛО СБОРА ДАННЫХ")
-            print("="*60)
-            total_html_rows = scroll_to_load_table_container(page, start_position)
-            
-            print("="*60)
-            print(f"✅ Сбор HTML завершен. Собрано {total_html_rows} уникальных HTML строк.")
-            print("="*60)
-            
-            print("\n🔄 Начинаем обработку собранных данных...")
-            process_html_to_excel()
-            print("\n" + "="*60)
-            print(f"✅ ПРОГРАММА ЗАВЕРШЕНА УСПЕШНО")
-            print(f"📁 Результат сохранен в файл: {FINAL_EXCEL}")
-            print("="*60)
+            save_storage_state(context)
+            run_crawl(page, context, captured, ranges)
             
         except KeyboardInterrupt:
             print("\n⚠️ Программа прервана пользователем")
-            save_last_position(0)
+            metrics.status = "interrupted"
+            # Каждый шаг уже в индексе позиций: следующий запуск продолжит с места остановки
+            print(f"📍 Прогресс сохранен в {POSITION_INDEX_DB}")
         except Exception as e:
             print(f"❌ Критическая ошибка в main(): {e}")
+            metrics.status = "error"
             import traceback
             traceback.print_exc()
         finally:
+            # Сохраняем обновленные за время работы cookies для следующего запуска
+            if not page.url.startswith(LOGIN_URL) and page.url != "about:blank":
+                save_storage_state(context)
+            print_resource_stats()
             print("\n🛑 Закрытие браузера...")
             context.close()
             browser.close()
             print("✅ Браузер закрыт.")
+            report_run()
+
+
+
+# --- Скрипт проверки, что вкладка показывает таблицу, а не форму входа ---
+PAGE_READY_JS = """
+() => !!document.querySelector('.table_container tr[id]') && !document.querySelector('input[name="email"]')
+"""
+
+
+
+# --- Прогретый браузер службы ---
+class WarmBrowser:
+    """Chromium с авторизованной вкладкой номенклатур, который живет между заданиями сбора"""
+    
+    def __init__(self, p):
+        self.p = p
+        self.browser = None
+        self.context = None
+        self.page = None
+        self.captured = None
+        self.ready = False  # Вкладка открыта заново и еще не использовалась для сбора
+        self.busy = False
+        self.runs = 0  # Заданий с последнего запуска браузера
+        self.jobs = 0  # Заданий за все время службы
+        self.launched_at = None
+        self.validated_at = None
+        self.checked_at = None
+        self.last_error = None
+        self.lock = threading.Lock()
+    
+    def start(self):
+        """Запускает браузер и открывает вкладку с таблицей"""
+        with metrics.stage("browser_start"):
+            self.browser = launch_browser(self.p)
+            self.context = create_context(self.browser)
+        load_cookies(self.context)
+        self.launched_at = time.monotonic()
+        self.runs = 0
+        self.refresh()
+    
+    def close(self):
+        """Сохраняет сессию и закрывает браузер"""
+        if self.browser is None:
+            return
+        try:
+            if self.page is not None and not self.page.url.startswith(LOGIN_URL) and self.page.url != "about:blank":
+                save_storage_state(self.context)
+            self.context.close()
+            self.browser.close()
+        except Exception as e:
+            print(f"⚠️ Ошибка при закрытии браузера: {e}")
+        self.browser = self.context = self.page = self.captured = None
+        self.ready = False
+    
+    def refresh(self):
+        """Открывает новую вкладку с таблицей номенклатур, при устаревшей сессии авторизуется заново"""
+        # Вкладка после сбора несет раздутый DOM и подписки прошлого задания - проще открыть новую
+        if self.page is not None:
+            self.page.close()
+        self.page = self.context.new_page()
+        self.page.set_default_timeout(PAGE_TIMEOUT)
+        self.captured = start_network_capture(self.page) if CRAWL_MODE == "network" else None
+        self.ready = ensure_session(self.page)
+        self.validated_at = self.checked_at = time.monotonic()
+        if self.ready:
+            save_cookies(self.context)
+            save_storage_state(self.context)
+            print("🔥 Вкладка номенклатур готова к следующему заданию")
+        return self.ready
+    
+    def healthy(self):
+        """Браузер подключен, вкладка отвечает и показывает таблицу, а не форму входа"""
+        try:
+            return (self.browser is not None and self.browser.is_connected()
+                    and not self.page.url.startswith(LOGIN_URL) and bool(self.page.evaluate(PAGE_READY_JS)))
+        except Exception as e:
+            self.last_error = str(e)
+            return False
+    
+    def recycle_reason(self):
+        """Причина перезапуска браузера или None"""
+        if not self.browser.is_connected():
+            return "браузер отключился"
+        if DAEMON_RECYCLE_RUNS and self.runs >= DAEMON_RECYCLE_RUNS:
+            return f"выполнено заданий: {self.runs}"
+        if DAEMON_RECYCLE_HOURS and time.monotonic() - self.launched_at >= DAEMON_RECYCLE_HOURS * 3600:
+            return f"браузер работает дольше {DAEMON_RECYCLE_HOURS:g} ч"
+        return None
+    
+    def recycle(self, reason):
+        """Закрывает браузер и запускает его заново"""
+        print(f"♻️ Перезапуск браузера: {reason}")
+        self.close()
+        self.start()
+    
+    def idle(self, seconds):
+        """Ждет между заданиями через вкладку, чтобы ее запросы проходили через обработчик маршрутов"""
+        try:
+            if self.page is not None and not self.page.is_closed():
+                self.page.wait_for_timeout(seconds * 1000)
+                return
+        except PlaywrightError:
+            pass  # Упавшую вкладку заменит следующая проверка здоровья
+        time.sleep(seconds)
+    
+    def maintain(self):
+        """Обслуживание между заданиями: перезапуск, проверка здоровья, прогрев вкладки и перепроверка сессии"""
+        try:
+            if self.browser is None:
+                self.start()
+                return
+            reason = self.recycle_reason()
+            if reason:
+                self.recycle(reason)
+            elif not self.ready:
+                print("🔄 Прогрев вкладки для следующего задания...")
+                if not self.refresh():
+                    self.recycle("сессия не восстановлена")
+            elif not self.healthy():
+                print(f"⚠️ Проверка здоровья не пройдена{f': {self.last_error}' if self.last_error else ''}")
+                if not self.refresh():
+                    self.recycle("сессия не восстановлена")
+            elif time.monotonic() - self.validated_at >= DAEMON_REVALIDATE_MINUTES * 60:
+                print("🔑 Плановая перепроверка сессии...")
+                self.refresh()
+            self.checked_at = time.monotonic()
+        except Exception as e:
+            # Следующая проверка начнет с чистого запуска
+            print(f"❌ Ошибка обслуживания браузера: {e}")
+            self.last_error = str(e)
+            self.close()
+    
+    def prepare_job(self):
+        """Перед заданием: прогретая здоровая вкладка используется сразу, иначе - перепроверка или перезапуск"""
+        if self.browser is None:
+            self.start()
+        elif self.recycle_reason():
+            self.recycle(self.recycle_reason())
+        elif not (self.ready and self.healthy()):
+            self.refresh()
+        if not self.ready:
+            self.recycle("сессия не восстановлена")
+        return self.ready
+    
+    def run_job(self, conn, ranges=None):
+        """Выполняет задание сбора на прогретой вкладке, события прогресса уходят клиенту в сокет"""
+        metrics.reset()
+        reset_resource_stats()
+        progress_channel.update(fd=conn.fileno(), enabled=True, last_sent=0.0)
+        try:
+            emit_progress("phase", phase="session")
+            with metrics.stage("session"):
+                session_ok = self.prepare_job()
+            if not session_ok:
+                print("❌ Не удалось авторизоваться, задание пропущено")
+                metrics.status = "login_failed"
+                return
+            print(f"⏱️ Вкладка готова через {metrics.stages['session'][1]:.2f}с после получения задания")
+            self.ready = False
+            run_crawl(self.page, self.context, self.captured, ranges)
+        except KeyboardInterrupt:
+            print("\n⚠️ Служба остановлена во время сбора")
+            metrics.status = "interrupted"
+            raise
+        except Exception as e:
+            print(f"❌ Ошибка задания: {e}")
+            metrics.status = "error"
+            self.last_error = str(e)
+            import traceback
+            traceback.print_exc()
+        finally:
+            self.runs += 1
+            self.jobs += 1
+            print_resource_stats()
+            report_run()
+            progress_channel['enabled'] = False
+            conn.close()
+            with self.lock:
+                self.busy = False
+    
+    def health(self):
+        """Состояние службы для команды health"""
+        now = time.monotonic()
+        return {
+            'event': 'health',
+            'pid': os.getpid(),
+            'status': "busy" if self.busy else ("ready" if self.ready else "warming"),
+            'runs': self.runs,
+            'jobs': self.jobs,
+            'browser_age_seconds': round(now - self.launched_at) if self.launched_at else None,
+            'validated_seconds_ago': round(now - self.validated_at) if self.validated_at else None,
+            'checked_seconds_ago': round(now - self.checked_at) if self.checked_at else None,
+            'last_error': self.last_error
+        }
+
+
+
+# --- Функция отправки команды службе ---
+def daemon_request(request, timeout=5):
+    """Отправляет команду службе и возвращает первый ответ или None, если служба не запущена"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(DAEMON_SOCKET)
+            client.sendall((json.dumps(request) + "\n").encode('utf-8'))
+            line = client.makefile('r', encoding='utf-8').readline()
+            return json.loads(line) if line else None
+    except (OSError, ValueError):
+        return None
+
+
+
+# --- Функция обработки клиента службы ---
+def handle_daemon_client(conn, warm, jobs):
+    """Читает одну команду клиента: crawl (с необязательными ranges) ставит задание в очередь, health и stop отвечают сразу"""
+    def reply(payload):
+        conn.sendall((json.dumps(payload, ensure_ascii=False) + "\n").encode('utf-8'))
+    
+    try:
+        conn.settimeout(10)
+        request = json.loads(conn.makefile('r', encoding='utf-8').readline() or "{}")
+        conn.settimeout(None)
+        command = request.get('command')
+        if command == 'crawl':
+            ranges = merge_ranges((int(start), int(end)) for start, end in request.get('ranges') or [])
+            # Одно задание за раз: бот и так объединяет одновременные запросы
+            with warm.lock:
+                busy = warm.busy
+                warm.busy = True
+            if busy:
+                reply({'event': 'done', 'status': 'busy'})
+            else:
+                reply({'event': 'accepted', 'pid': os.getpid(), 'warm': warm.ready})
+                jobs.put((conn, ranges))  # Соединение закроет задание после события done
+                return
+        elif command == 'health':
+            reply(warm.health())
+        elif command == 'stop':
+            reply({'event': 'stopping'})
+            jobs.put(None)
+        else:
+            reply({'event': 'error', 'message': f"неизвестная команда: {command}"})
+    except (OSError, ValueError, TypeError) as e:
+        print(f"⚠️ Ошибка клиента службы: {e}")
+    conn.close()
+
+
+
+# --- Функция приема подключений к службе ---
+def accept_daemon_clients(server, warm, jobs):
+    """Принимает подключения к сокету, каждое обрабатывается в своем потоке"""
+    while True:
+        try:
+            conn, _ = server.accept()
+        except OSError:
+            return  # Сокет закрыт при остановке службы
+        threading.Thread(target=handle_daemon_client, args=(conn, warm, jobs), daemon=True).start()
+
+
+
+# --- Функция службы с прогретым браузером ---
+def serve():
+    """Держит браузер с авторизованной вкладкой и выполняет задания сбора из Unix-сокета"""
+    print("="*60)
+    print("🔥 ЗАПУСК СЛУЖБЫ СБОРА ДАННЫХ")
+    print("="*60)
+    
+    if daemon_request({'command': 'health'}) is not None:
+        print(f"❌ Служба уже запущена на сокете {DAEMON_SOCKET}")
+        return
+    if os.path.exists(DAEMON_SOCKET):
+        os.remove(DAEMON_SOCKET)  # Остался от аварийно завершенной службы
+    
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(DAEMON_SOCKET)
+    os.chmod(DAEMON_SOCKET, 0o600)
+    server.listen(8)
+    print(f"🔌 Сокет: {DAEMON_SOCKET}")
+    print(f"🩺 Проверка раз в {DAEMON_HEALTH_INTERVAL:g}с, перепроверка сессии раз в {DAEMON_REVALIDATE_MINUTES:g} мин")
+    print(f"♻️ Перезапуск браузера: после {DAEMON_RECYCLE_RUNS or '∞'} заданий или {DAEMON_RECYCLE_HOURS or '∞'} ч")
+    
+    jobs = queue.Queue()
+    with sync_playwright() as p:
+        warm = WarmBrowser(p)
+        threading.Thread(target=accept_daemon_clients, args=(server, warm, jobs), daemon=True).start()
+        try:
+            warm.maintain()
+            next_check = time.monotonic() + DAEMON_HEALTH_INTERVAL
+            while True:
+                try:
+                    job = jobs.get_nowait()
+                except queue.Empty:
+                    # Простой отмеряется вызовами Playwright, а не блокирующим jobs.get:
+                    # иначе запросы прогретой вкладки висели бы до следующего задания
+                    warm.idle(1)
+                    if time.monotonic() >= next_check:
+                        warm.maintain()
+                        next_check = time.monotonic() + DAEMON_HEALTH_INTERVAL
+                    continue
+                if job is None:
+                    print("🛑 Получена команда остановки службы")
+                    break
+                print("\n" + "="*60)
+                print(f"📥 Задание сбора #{warm.jobs + 1}")
+                print("="*60)
+                warm.run_job(*job)
+                # Сразу готовим новую вкладку, чтобы следующее задание не ждало загрузки
+                warm.maintain()
+                next_check = time.monotonic() + DAEMON_HEALTH_INTERVAL
+        except KeyboardInterrupt:
+            print("\n⚠️ Служба остановлена пользователем")
+        finally:
+            server.close()
+            if os.path.exists(DAEMON_SOCKET):
+                os.remove(DAEMON_SOCKET)
+            print("\n🛑 Закрытие браузера...")
+            warm.close()
+            print("✅ Служба остановлена.")
 
 
 
 
 if __name__ == "__main__":
-    main()
+    if "--export" in sys.argv:
+        # Только выгрузка хранилища в файлы и поисковый индекс, без запуска браузера
+        export_store()
+        build_search_index()
+    elif "--serve" in sys.argv:
+        # Служба: браузер и авторизация живут между заданиями, задания - через DAEMON_SOCKET
+        serve()
+    elif "--recrawl" in sys.argv or "--recrawl-codes" in sys.argv:
+        # Точечный пересбор: перемотка к сохраненным в индексе позициям без прокрутки всего списка
+        ranges = recrawl_ranges_from_args(sys.argv)
+        if not ranges:
+            print("❌ Нет диапазонов для пересбора")
+        elif os.path.exists(JOURNAL_FILE) and os.path.getsize(JOURNAL_FILE):
+            print(f"❌ Есть незавершенный сбор ({JOURNAL_FILE}), сначала завершите его обычным запуском")
+        else:
+            main(ranges)
+    elif "--health" in sys.argv or "--stop" in sys.argv:
+        response = daemon_request({'command': 'health' if "--health" in sys.argv else 'stop'})
+        print(json.dumps(response, ensure_ascii=False, indent=2) if response else f"❌ Служба не отвечает на {DAEMON_SOCKET}")
+    else:
+        main()
@@ -0,0 +1,422 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import importlib.util
+import shutil
+import socket
+from datetime import datetime
+
+import pandas as pd
+
+
+# --- Пути к записанным данным и результатам ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PARSER_SCRIPT = os.path.join(BASE_DIR, "angelina-v2.py")
+RECORDED_HTML = os.path.join(BASE_DIR, "table_container_html.xlsx")
+RECORDED_RESULT = os.path.join(BASE_DIR, "результат.xlsx")
+RESULTS_FILE = os.path.join(BASE_DIR, "benchmark_results.jsonl")
+
+
+# Сколько строк в одном синтетическом HTML блоке (как в среднем на шаге прокрутки)
+BLOB_ROWS = 24
+ALL_STAGES = ["parse_bs4", "parse_lxml", "parse_lxml_pool", "clean", "merge", "excel_write"]
+
+
+ROW_RE = re.compile(r'<tr id=.*?</tr>', re.DOTALL)
+ROW_HEAD_RE = re.compile(r'^<tr id="([^"]*)"><td>([^<]*)</td>')
+
+
+
+# --- Функция загрузки модуля парсера ---
+def load_parser_module():
+    """Импортирует angelina-v2.py как модуль (имя файла с дефисом не импортируется напрямую)"""
+    # Учетные данные не нужны, но модуль проверяет их при импорте
+    os.environ.setdefault("APP_EMAIL", "benchmark@localhost")
+    os.environ.setdefault("APP_PASSWORD", "benchmark")
+    spec = importlib.util.spec_from_file_location("angelina_v2", PARSER_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    # Регистрация нужна, чтобы функции модуля передавались в пул процессов
+    sys.modules["angelina_v2"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+
+# --- Функция чтения записанных строк таблицы ---
+def load_template_rows():
+    """Достает HTML отдельных строк tr из записанного table_container_html.xlsx"""
+    print(f"📂 Чтение записанного HTML из {RECORDED_HTML}...")
+    blobs = pd.read_excel(RECORDED_HTML, engine='openpyxl')['html_content']
+    rows = [row for blob in blobs for row in ROW_RE.findall(blob)]
+    print(f"📋 Найдено {len(rows)} записанных строк")
+    return rows
+
+
+
+# --- Функция генерации синтетических HTML блоков ---
+def synth_blobs(template_rows, size):
+    """Отдает блоки HTML на size строк: сначала записанные, дальше их копии с новыми id и кодами"""
+    count = len(template_rows)
+    batch = []
+    for i in range(size):
+        row = template_rows[i % count]
+        if i >= count:
+            row = ROW_HEAD_RE.sub(
+                lambda m: f'<tr id="{m.group(1)}-{i // count}"><td>S{i:010d}</td>', row, count=1
+            )
+        batch.append(row)
+        if len(batch) == BLOB_ROWS:
+            yield "<table>" + "".join(batch) + "</table>"
+            batch = []
+    if batch:
+        yield "<table>" + "".join(batch) + "</table>"
+
+
+
+# --- Замер пикового RSS процесса во время этапа ---
+class PeakRss:
+    """Фоновый поток, который опрашивает RSS и запоминает максимум"""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.start_rss = 0
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _rss(self):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self.page_size
+        except OSError:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, self._rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = self._rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, self._rss())
+
+    @property
+    def peak_mb(self):
+        return (self.peak_rss - self.start_rss) / (1024 * 1024)
+
+
+
+# --- Функция замера одного этапа ---
+def measure(stage, size, fn):
+    """Выполняет этап, возвращая результат и запись с временем, скоростью и памятью"""
+    with PeakRss() as rss:
+        started = time.perf_counter()
+        rows, value = fn()
+        seconds = time.perf_counter() - started
+    result = {
+        'stage': stage,
+        'size': size,
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'rows_per_sec': round(rows / seconds, 1) if seconds else None,
+        'peak_mb': round(rss.peak_mb, 1)
+    }
+    print(f"   {stage:<16} {rows:>9} строк  {seconds:>8.2f}с  {result['rows_per_sec'] or 0:>11.0f} строк/с  +{rss.peak_mb:.0f} МБ")
+    return value, result
+
+
+
+# --- Функция прогона всех этапов на одном размере ---
+def run_size(parser, template_rows, size, stages, workers, work_dir):
+    """Прогоняет выбранные этапы на size строк и возвращает записи замеров"""
+    print(f"\n📏 Размер: {size} строк")
+    results = []
+    raw_rows = None
+
+    if "parse_bs4" in stages:
+        _, result = measure("parse_bs4", size, lambda: (
+            sum(len(parser.parse_html_rows(blob, "bs4")) for blob in synth_blobs(template_rows, size)), None
+        ))
+        results.append(result)
+
+    if "parse_lxml" in stages:
+        def parse_lxml():
+            rows = [row for blob in synth_blobs(template_rows, size) for row in parser.parse_html_rows(blob, "lxml")]
+            return len(rows), rows
+        raw_rows, result = measure("parse_lxml", size, parse_lxml)
+        results.append(result)
+
+    if "parse_lxml_pool" in stages:
+        def parse_pool():
+            # Блоки отдаются пулу окнами, чтобы не держать весь HTML в памяти
+            total = 0
+            window = []
+            for blob in synth_blobs(template_rows, size):
+                window.append(blob)
+                if len(window) == 4096:
+                    total += sum(map(len, parser.parse_html_blobs(window, "lxml", workers)))
+                    window = []
+            if window:
+                total += sum(map(len, parser.parse_html_blobs(window, "lxml", workers)))
+            return total, None
+        _, result = measure("parse_lxml_pool", size, parse_pool)
+        results.append(result)
+
+    new_df = None
+    if "clean" in stages or "merge" in stages or "excel_write" in stages:
+        if raw_rows is None:
+            raw_rows = [row for blob in synth_blobs(template_rows, size) for row in parser.parse_html_rows(blob, "lxml")]
+
+        def clean():
+            df = parser.records_frame(raw_rows)
+            return len(df), df
+        new_df, result = measure("clean", size, clean)
+        if "clean" in stages:
+            results.append(result)
+    raw_rows = None
+
+    store_path = os.path.join(work_dir, f"store_{size}.sqlite")
+    if "merge" in stages or "excel_write" in stages:
+        # Хранилище заполняется существующим результатом заранее и в замер не входит
+        conn = parser.open_store(store_path)
+        parser.bootstrap_store(conn, RECORDED_RESULT)
+
+        def merge():
+            # Тот же путь, что в process_html_to_excel: дедупликация upsert-ом в staging,
+            # отчет об изменениях с отметкой пропавших кодов и перенос staging в хранилище
+            parser.create_nomenclatures_table(conn, "staging", temp=True)
+            parser.upsert_records(conn, new_df, table="staging")
+            unique_records = parser.store_count(conn, "staging")
+            parser.merge_staging_with_delta(conn, unique_records, delta_file=os.path.join(work_dir, f"delta_{size}.csv"))
+            conn.execute("DROP TABLE temp.staging")
+            return unique_records, None
+        _, result = measure("merge", size, merge)
+        conn.close()
+        if "merge" in stages:
+            results.append(result)
+
+    if "excel_write" in stages:
+        excel_path = os.path.join(work_dir, f"result_{size}.xlsx")
+        _, result = measure("excel_write", size, lambda: (
+            parser.write_excel_streaming(parser.store_chunks(store_path), excel_path), None
+        ))
+        results.append(result)
+
+    return results
+
+
+
+# --- Функция сквозного прогона краулера на mock-портале ---
+def run_e2e(args):
+    """Запускает настоящий angelina-v2.py против локального mock-портала и считает пропуски и дубли"""
+    import mock_portal
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = mock_portal.start_server(port, args.rows, args.page_size, args.latency_ms, args.mode, folders=args.folders)
+    base_url = f"http://127.0.0.1:{port}"
+    print(f"\n🧪 Mock-портал: {base_url} (строк: {args.rows}, задержка: {args.latency_ms} мс, режим: {args.mode}, папок: {args.folders})")
+
+    overrides = dict(item.split("=", 1) for item in args.env)
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            # Копия скрипта в пустом каталоге: так load_dotenv не подхватит боевой .env
+            script = os.path.join(work_dir, "angelina-v2.py")
+            shutil.copy(PARSER_SCRIPT, script)
+            journal_file = os.path.join(work_dir, "journal.jsonl")
+            report_file = os.path.join(work_dir, "run_report.json")
+            env = dict(os.environ)
+            env.update({
+                "LOGIN_URL": f"{base_url}/login",
+                "NOMENCLATURES_URL": f"{base_url}/nomenclatures",
+                "APP_EMAIL": "benchmark@localhost",
+                "APP_PASSWORD": "benchmark",
+                "HEADLESS": "true",
+                "MAX_SCROLL_POSITION": str(args.rows * mock_portal.ROW_HEIGHT + 10000),
+                "JOURNAL_FILE": journal_file,
+                "METRICS_REPORT_FILE": report_file,
+                "FINAL_EXCEL": os.path.join(work_dir, "result.xlsx"),
+                "EXPORT_FORMATS": "csv.gz",
+                "KEEP_TEMP_FILES": "true"
+            })
+            env.update(overrides)
+
+            log_path = os.path.join(work_dir, "crawler.log")
+            started = time.perf_counter()
+            with open(log_path, "w", encoding="utf-8") as log:
+                completed = subprocess.run(
+                    [sys.executable, script], cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT,
+                    timeout=args.timeout
+                )
+            wall = time.perf_counter() - started
+
+            # Журнал уже без повторов (claim отсеивает их под блокировкой), поэтому повторы берем
+            # из отчета краулера: строки, которые страница отдала как новые, а claim отклонил
+            counters = {}
+            if os.path.exists(report_file):
+                with open(report_file, encoding="utf-8") as f:
+                    try:
+                        counters = json.load(f).get('counters', {})
+                    except ValueError:
+                        pass
+            result_csv = os.path.join(work_dir, "result.csv.gz")
+            codes = set(pd.read_csv(result_csv, dtype=str)["Код номенклатуры"]) if os.path.exists(result_csv) else set()
+
+            if completed.returncode != 0 or not codes:
+                with open(log_path, encoding="utf-8") as f:
+                    print("❌ Краулер завершился с ошибкой, последние строки журнала:")
+                    print("".join(f.readlines()[-30:]))
+    finally:
+        server.shutdown()
+
+    expected = {mock_portal.make_row(i)["code"] for i in range(args.rows)}
+    missed = len(expected - codes)
+    # Повторы считает только извлечение evaluate: page.content() каждый шаг отдает всю таблицу,
+    # и в режимах html и network счетчика нет - это "не измерено", а не ноль
+    duplicates = counters.get('rows_duplicate')
+    result = {
+        'stage': f"e2e_{args.mode}",
+        'size': args.rows,
+        'rows': len(codes & expected),
+        'seconds': round(wall, 2),
+        'rows_per_sec': round(len(codes & expected) / wall, 1) if wall else None,
+        'missed': missed,
+        'duplicates': duplicates,
+        'latency_ms': args.latency_ms,
+        'folders': args.folders,
+        'env': overrides
+    }
+    print(f"   ⏱️ Время: {wall:.1f}с, собрано: {result['rows']} из {args.rows}, {result['rows_per_sec'] or 0:.1f} строк/с")
+    print(f"   ❓ Пропущено строк: {missed}, 🔁 повторно собрано: {'n/a' if duplicates is None else duplicates}")
+    return [result]
+
+
+
+# --- Функция получения текущего коммита ---
+def git_commit():
+    """Возвращает короткий хеш текущего коммита или None"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+
+# --- Функция сравнения с прошлым прогоном ---
+def compare_with_previous(results, results_file):
+    """Печатает изменение скорости этапов относительно последнего сохраненного прогона"""
+    if not os.path.exists(results_file):
+        return
+    previous = {}
+    with open(results_file, encoding='utf-8') as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            for result in run['results']:
+                previous[(result['stage'], result['size'])] = (run.get('commit'), result)
+
+    print("\n📊 Сравнение с прошлым прогоном:")
+    for result in results:
+        key = (result['stage'], result['size'])
+        if key not in previous or not previous[key][1]['rows_per_sec'] or not result['rows_per_sec']:
+            continue
+        commit, old = previous[key]
+        ratio = result['rows_per_sec'] / old['rows_per_sec']
+        mark = "⚠️" if ratio < 0.9 else "✅"
+        print(f"   {mark} {result['stage']:<16} {result['size']:>9}: x{ratio:.2f} к {commit or 'прошлому прогону'}")
+
+
+
+def main():
+    parser_args = argparse.ArgumentParser(description="Офлайн-бенчмарк этапов разбора и слияния на записанном HTML")
+    parser_args.add_argument("--sizes", default="10000,100000", help="Размеры в строках через запятую, например 10000,100000,1000000")
+    parser_args.add_argument("--stages", default=",".join(ALL_STAGES), help="Этапы через запятую: " + ", ".join(ALL_STAGES))
+    parser_args.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Процессов для parse_lxml_pool")
+    parser_args.add_argument("--output", default=RESULTS_FILE, help="JSONL файл, куда дописываются результаты")
+    parser_args.add_argument("--compare", action="store_true", help="Сравнить с последним сохраненным прогоном")
+    e2e_args = parser_args.add_argument_group("сквозной прогон краулера на mock-портале")
+    e2e_args.add_argument("--e2e", action="store_true", help="Запустить angelina-v2.py против mock_portal.py вместо офлайн-этапов")
+    e2e_args.add_argument("--rows", type=int, default=2000, help="Строк в каталоге mock-портала")
+    e2e_args.add_argument("--page-size", type=int, default=50, help="Строк в одной подгрузке mock-портала")
+    e2e_args.add_argument("--latency-ms", type=int, default=200, help="Задержка ответа API mock-портала, мс")
+    e2e_args.add_argument("--mode", choices=["append", "virtual"], default="append", help="Поведение таблицы mock-портала")
+    e2e_args.add_argument("--folders", type=int, default=0, help="Папок каталога mock-портала (для CRAWL_MODE=folders)")
+    e2e_args.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                          help="Переменная окружения для краулера, например --env SCROLL_STEP=1200")
+    e2e_args.add_argument("--timeout", type=int, default=3600, help="Ограничение времени прогона краулера, сек")
+    args = parser_args.parse_args()
+
+    if args.e2e:
+        print("=" * 60)
+        print("⏱️ СКВОЗНОЙ БЕНЧМАРК КРАУЛЕРА")
+        print("=" * 60)
+        results = run_e2e(args)
+        save_results(results, args)
+        return
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(stages) - set(ALL_STAGES)
+    if unknown:
+        print(f"❌ Неизвестные этапы: {', '.join(sorted(unknown))}")
+        return
+
+    print("=" * 60)
+    print("⏱️ БЕНЧМАРК ЭТАПОВ РАЗБОРА И СЛИЯНИЯ")
+    print("=" * 60)
+    parser = load_parser_module()
+    template_rows = load_template_rows()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in sizes:
+            results.extend(run_size(parser, template_rows, size, stages, args.workers, work_dir))
+
+    save_results(results, args)
+
+
+
+# --- Функция сохранения результатов прогона ---
+def save_results(results, args):
+    """Сравнивает с прошлым прогоном (по запросу) и дописывает результаты в JSONL"""
+    if args.compare:
+        compare_with_previous(results, args.output)
+
+    run = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'workers': args.workers,
+        'results': results
+    }
+    with open(args.output, "a", encoding='utf-8') as f:
+        f.write(json.dumps(run, ensure_ascii=False) + "\n")
+    print(f"\n💾 Результаты дописаны в {args.output}")
+
+
+
+if __name__ == "__main__":
+    main()
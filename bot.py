@@ -1,10 +1,18 @@
 import os
+import json
+import html
+import time
+import sqlite3
 import asyncio
-import subprocess
+import hashlib
+import zipfile
 from datetime import datetime
+from urllib.parse import quote
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, FSInputFile
-from aiogram.filters import CommandStart
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -17,18 +25,52 @@ load_dotenv()
 # Токен бота
 BOT_TOKEN = os.getenv("API_BOT")
 
+# Адрес своего Bot API сервера (например, http://127.0.0.1:8081); пусто - api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+BOT_API_LOCAL = os.getenv("BOT_API_LOCAL", "false").lower() == "true"  # Сервер запущен с --local
+
 # Пути к файлам
 BASE_DIR = "/root/Angelina"
 MAIN_SCRIPT = os.path.join(BASE_DIR, "angelina-v2.py")
 RESULT_FILE = os.path.join(BASE_DIR, "результат.xlsx")
+STORE_FILE = os.path.join(BASE_DIR, "результат.sqlite")
+RESULT_ZIP = os.path.join(BASE_DIR, "результат.zip")
+SEARCH_FILE = os.path.join(BASE_DIR, "результат_поиск.sqlite")
+
+# Поиск по последним результатам
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", "10"))  # Строк в ответе
+SEARCH_MMAP_MB = int(os.getenv("SEARCH_MMAP_MB", "256"))  # Сколько файла индекса отображать в память
+
+# Кэш отправленных документов: sha256 файла -> file_id в Telegram
+DELIVERY_CACHE_FILE = os.path.join(BASE_DIR, ".delivery_cache.json")
+DELIVERY_CACHE_SIZE = 20  # Сколько последних версий файла помнить
+ZIP_THRESHOLD_MB = float(os.getenv("ZIP_THRESHOLD_MB", "5"))  # Больше этого размера отправляется zip
+
+# Результат моложе этого окна отдается сразу, без нового запуска парсера
+RESULT_FRESHNESS_MINUTES = float(os.getenv("RESULT_FRESHNESS_MINUTES", "30"))
 PYTHON_PATH = os.path.join(BASE_DIR, ".venv/bin/python")
-TMUX_SESSION = "Angelina"
+PARSER_LOG = os.path.join(BASE_DIR, "parsing.log")
+
+# Сокет службы angelina-v2.py --serve: если она запущена, сбор идет в ее прогретом браузере
+PARSER_SOCKET = os.getenv("PARSER_SOCKET", os.path.join(BASE_DIR, "angelina.sock"))
+
+# Не чаще одного редактирования сообщения о статусе за N секунд (лимиты Telegram)
+STATUS_UPDATE_INTERVAL = float(os.getenv("STATUS_UPDATE_INTERVAL", "5"))
 
-# Файл-маркер для отслеживания статуса
-PID_FILE = os.path.join(BASE_DIR, ".parsing_pid")
+# Названия этапов из событий прогресса парсера
+PHASE_TITLES = {
+    'starting': "🚀 Запуск браузера",
+    'session': "🔑 Авторизация",
+    'crawl': "📜 Сбор данных",
+    'process': "🔄 Обработка данных",
+    'export': "💾 Выгрузка файлов"
+}
 
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
+if BOT_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL, is_local=BOT_API_LOCAL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
@@ -37,8 +79,22 @@ class ParsingStates(StatesGroup):
     idle = State()
     parsing = State()
 
-# Флаг для блокировки повторных запусков
-is_parsing = False
+# Текущий запуск парсера: один на всех, кто его запросил
+class ParseJob:
+    """Запуск парсера и подписчики, которые получат его результат"""
+    
+    def __init__(self):
+        self.started = datetime.now()
+        self.subscribers = []  # (сообщение пользователя, сообщение о статусе, FSM контекст)
+        self.progress = {'phase': 'starting'}
+        self.pid = None
+        self.task = None
+
+
+current_job = None
+
+# Индекс поиска открывается при первом запросе и переоткрывается, когда парсер подменит файл
+search_index = {'conn': None, 'mtime': None}
 
 
 # Клавиатура
@@ -56,6 +112,7 @@ def get_main_keyboard(parsing: bool = False):
         keyboard = ReplyKeyboardMarkup(
             keyboard=[
                 [KeyboardButton(text="🚀 Запустить парсинг")],
+                [KeyboardButton(text="📥 Последний файл")],
                 [KeyboardButton(text="🗑️ Удалить прошлый файл")]
             ],
             resize_keyboard=True
@@ -85,90 +142,158 @@ async def safe_edit_message(message: Message, text: str, **kwargs):
         return False
 
 
-def check_tmux_session_exists():
-    """Проверяет существование tmux сессии"""
+def file_sha256(path):
+    """Считает sha256 файла порциями"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_delivery_cache():
+    """Читает кэш file_id отправленных файлов"""
     try:
-        result = subprocess.run(
-            ["tmux", "has-session", "-t", TMUX_SESSION],
-            capture_output=True,
-            timeout=5
-        )
-        return result.returncode == 0
-    except:
-        return False
+        with open(DELIVERY_CACHE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
 
-def is_process_running(pid):
-    """Проверяет, запущен ли процесс с указанным PID"""
+def save_delivery_cache(cache):
+    """Сохраняет кэш, оставляя только последние версии файла"""
+    keys = list(cache)[-DELIVERY_CACHE_SIZE:]
     try:
-        os.kill(pid, 0)
-        return True
-    except OSError:
-        return False
+        with open(DELIVERY_CACHE_FILE + ".tmp", "w") as f:
+            json.dump({key: cache[key] for key in keys}, f)
+        os.replace(DELIVERY_CACHE_FILE + ".tmp", DELIVERY_CACHE_FILE)
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить кэш отправок: {e}")
+
 
+def build_result_zip():
+    """Упаковывает файл результатов в zip рядом с ним"""
+    with zipfile.ZipFile(RESULT_ZIP + ".tmp", "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+        archive.write(RESULT_FILE, arcname=os.path.basename(RESULT_FILE))
+    os.replace(RESULT_ZIP + ".tmp", RESULT_ZIP)
+    return os.path.getsize(RESULT_ZIP)
 
-async def run_in_tmux():
-    """Запускает парсинг в tmux сессии"""
+
+async def send_result(message: Message, caption: str):
+    """Отправляет файл результатов: повторно - по file_id, большой файл - в zip"""
+    digest = await asyncio.to_thread(file_sha256, RESULT_FILE)
+    cache = load_delivery_cache()
+    entry = cache.pop(digest, {})
+    use_zip = os.path.getsize(RESULT_FILE) / (1024 * 1024) > ZIP_THRESHOLD_MB
+    key = "zip_file_id" if use_zip else "file_id"
+    
+    sent = None
+    if entry.get(key):
+        try:
+            # Тот же файл уже загружен в Telegram - отправка мгновенная, без выгрузки
+            sent = await message.answer_document(document=entry[key], caption=caption, parse_mode="HTML")
+        except TelegramBadRequest as e:
+            print(f"⚠️ Сохраненный file_id не принят, загружаем файл заново: {e}")
+    
+    if sent is None:
+        if use_zip:
+            zip_size = await asyncio.to_thread(build_result_zip)
+            caption += f"\n🗜️ Сжато в zip: {zip_size / (1024 * 1024):.2f} МБ"
+            document = FSInputFile(RESULT_ZIP)
+        else:
+            document = FSInputFile(RESULT_FILE)
+        sent = await message.answer_document(document=document, caption=caption, parse_mode="HTML")
+    
+    entry[key] = sent.document.file_id
+    cache[digest] = entry
+    save_delivery_cache(cache)
+    return sent
+
+
+def format_duration(seconds):
+    """Форматирует секунды как 1ч 2м 3с"""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}ч {minutes}м {seconds}с"
+    return f"{minutes}м {seconds}с"
+
+
+async def start_parser():
+    """Запускает angelina-v2.py напрямую и возвращает процесс и поток событий прогресса"""
+    read_fd, write_fd = os.pipe()
     try:
-        # Проверяем существование сессии
-        if not check_tmux_session_exists():
-            # Создаем новую сессию если не существует
-            subprocess.run(
-                ["tmux", "new-session", "-d", "-s", TMUX_SESSION],
-                check=True,
-                timeout=10
+        with open(PARSER_LOG, "ab") as log:
+            log.write(f"\n===== {datetime.now().strftime('%d.%m.%Y %H:%M:%S')} =====\n".encode("utf-8"))
+            log.flush()
+            # Парсер пишет события строками JSON в унаследованный дескриптор PROGRESS_FD
+            process = await asyncio.create_subprocess_exec(
+                PYTHON_PATH, MAIN_SCRIPT,
+                cwd=BASE_DIR,
+                stdout=log,
+                stderr=asyncio.subprocess.STDOUT,
+                env={**os.environ, "PROGRESS_FD": str(write_fd), "PYTHONUNBUFFERED": "1"},
+                pass_fds=(write_fd,)
             )
-            await asyncio.sleep(1)
-        
-        # Очищаем экран в tmux
-        subprocess.run(
-            ["tmux", "send-keys", "-t", TMUX_SESSION, "clear", "C-m"],
-            check=True,
-            timeout=5
-        )
-        await asyncio.sleep(0.5)
-        
-        # Переходим в нужную директорию
-        subprocess.run(
-            ["tmux", "send-keys", "-t", TMUX_SESSION, f"cd {BASE_DIR}", "C-m"],
-            check=True,
-            timeout=5
-        )
-        await asyncio.sleep(0.5)
-        
-        # Активируем виртуальное окружение
-        subprocess.run(
-            ["tmux", "send-keys", "-t", TMUX_SESSION, "source .venv/bin/activate", "C-m"],
-            check=True,
-            timeout=5
-        )
-        await asyncio.sleep(0.5)
-        
-        # Запускаем программу и сохраняем PID
-        command = f"python angelina-v2.py & echo $! > {PID_FILE}"
-        subprocess.run(
-            ["tmux", "send-keys", "-t", TMUX_SESSION, command, "C-m"],
-            check=True,
-            timeout=5
-        )
-        
-        # Ждем создания PID файла
-        for _ in range(10):
-            if os.path.exists(PID_FILE):
-                break
-            await asyncio.sleep(0.5)
-        
-        # Читаем PID
-        if os.path.exists(PID_FILE):
-            with open(PID_FILE, 'r') as f:
-                pid = int(f.read().strip())
-            return pid
-        
+    except Exception:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    
+    reader = asyncio.StreamReader()
+    loop = asyncio.get_running_loop()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(read_fd, "rb"))
+    return process, reader
+
+
+async def connect_daemon():
+    """Отправляет задание сбора службе и возвращает (reader, writer) или None, если служба не запущена"""
+    if not os.path.exists(PARSER_SOCKET):
         return None
-        
-    except Exception as e:
-        print(f"Ошибка запуска в tmux: {e}")
+    try:
+        reader, writer = await asyncio.open_unix_connection(PARSER_SOCKET)
+    except OSError:
+        return None
+    writer.write(b'{"command": "crawl"}\n')
+    await writer.drain()
+    return reader, writer
+
+
+async def read_progress_event(reader, timeout):
+    """Ждет следующее событие прогресса: {} по таймауту, None когда парсер закрыл канал"""
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+    except asyncio.TimeoutError:
+        return {}
+    if not line:
         return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        return {}
+
+
+def format_progress(progress, elapsed, pid):
+    """Текст сообщения о статусе по последнему состоянию прогресса"""
+    lines = [
+        f"🔄 <b>Парсинг в процессе...</b>\n",
+        f"📍 Этап: {PHASE_TITLES.get(progress.get('phase'), progress.get('phase'))}",
+        f"🆔 PID: <code>{pid}</code>",
+        f"⏱️ Прошло времени: {format_duration(elapsed)}"
+    ]
+    if progress.get('rows') is not None:
+        total = f" из {progress['total']}" if progress.get('total') else ""
+        lines.append(f"📦 Собрано строк: {progress['rows']}{total}")
+    if progress.get('position') is not None and progress.get('phase') == 'crawl':
+        lines.append(f"📜 Позиция прокрутки: {progress['position']}px")
+    if progress.get('rows_per_sec'):
+        lines.append(f"⚡ Скорость: {progress['rows_per_sec']:.1f} строк/с")
+    if progress.get('eta_seconds') is not None and progress.get('phase') == 'crawl':
+        lines.append(f"⏳ Осталось примерно: {format_duration(progress['eta_seconds'])}")
+    lines.append(f"\n📄 Лог: <code>{PARSER_LOG}</code>")
+    return "\n".join(lines)
 
 
 @dp.message(CommandStart())
@@ -176,12 +301,12 @@ async def cmd_start(message: Message, state: FSMContext):
     """Обработчик команды /start"""
     await state.set_state(ParsingStates.idle)
     
-    session_status = "✅ Найдена" if check_tmux_session_exists() else "⚠️ Не найдена (будет создана)"
-    
     welcome_text = (
         "👋 <b>Добро пожаловать в бот управления парсингом!</b>\n\n"
-        "🔹 <b>Запустить парсинг</b> - начать сбор данных в tmux сессии\n"
-        "🔹 <b>Удалить прошлый файл</b> - очистить результаты\n\n"
+        "🔹 <b>Запустить парсинг</b> - начать сбор данных\n"
+        "🔹 <b>Удалить прошлый файл</b> - очистить результаты\n"
+        "🔹 <code>/code код</code> - найти номенклатуру по коду\n"
+        "🔹 <code>/find слова</code> - поиск по названию, марке стали и НТД\n\n"
         "📊 Выберите действие:"
     )
     
@@ -192,177 +317,258 @@ async def cmd_start(message: Message, state: FSMContext):
     )
 
 
-@dp.message(F.text == "🚀 Запустить парсинг")
-async def start_parsing(message: Message, state: FSMContext):
-    """Запуск парсинга"""
-    global is_parsing
-    
-    if is_parsing:
-        await message.answer(
-            "⚠️ <b>Парсинг уже запущен!</b>\n"
-            "Пожалуйста, дождитесь завершения текущего процесса.",
-            parse_mode="HTML"
+def result_age_minutes():
+    """Возраст файла результатов в минутах или None, если файла нет"""
+    if not os.path.exists(RESULT_FILE):
+        return None
+    return (time.time() - os.path.getmtime(RESULT_FILE)) / 60
+
+
+async def subscribe(job: ParseJob, message: Message, state: FSMContext, joined: bool):
+    """Добавляет пользователя в подписчики запуска и присылает ему сообщение о статусе"""
+    if joined:
+        text = (
+            f"🔗 <b>Парсинг уже идет, вы добавлены в список получателей</b>\n\n"
+            f"⏱️ Запущен: {job.started.strftime('%H:%M:%S')}\n"
+            f"Файл придет автоматически, как только сбор завершится."
         )
-        return
-    
-    # Проверяем существование tmux сессии
-    if not check_tmux_session_exists():
-        status_info = f"📺 Создаю tmux сессию ...\n\n"
     else:
-        status_info = f"📺 Использую существующую сессию\n\n"
-    
-    is_parsing = True
+        text = (
+            f"🔄 <b>Запускаю парсинг...</b>\n\n"
+            f"⏳ Запуск программы...\n\n"
+        )
+    status_msg = await message.answer(text, parse_mode="HTML", reply_markup=get_main_keyboard(parsing=True))
+    job.subscribers.append((message, status_msg, state))
     await state.set_state(ParsingStates.parsing)
-    
-    # Отправляем сообщение о начале
-    status_msg = await message.answer(
-        f"🔄 <b>Запускаю парсинг...</b>\n\n"
-        f"{status_info}"
-        f"⏳ Запуск программы в tmux...\n\n",
-        parse_mode="HTML",
-        reply_markup=get_main_keyboard(parsing=True)
-    )
-    
-    start_time = datetime.now()
+
+
+async def edit_all(job: ParseJob, text: str):
+    """Обновляет сообщение о статусе у всех подписчиков"""
+    for _, status_msg, _ in list(job.subscribers):
+        await safe_edit_message(status_msg, text, parse_mode="HTML")
+
+
+async def run_parse_job(job: ParseJob):
+    """Выполняет один запуск парсера и раздает результат всем подписчикам"""
+    global current_job
     
     try:
-        # Запуск в tmux
-        pid = await run_in_tmux()
-        
-        if not pid:
-            raise Exception("Не удалось получить PID процесса")
-        
-        # Обновляем сообщение что программа запущена
-        await safe_edit_message(
-            status_msg,
-            f"✅ <b>Программа запущена в tmux!</b>\n\n"
-            f"🆔 PID процесса: <code>{pid}</code>\n\n"
-            f"🔄 Начинаю мониторинг...\n\n",
-            parse_mode="HTML"
-        )
-        
-        await asyncio.sleep(2)
-        
-        # Мониторим процесс
-        update_interval = 30  # секунд
-        last_update_time = datetime.now()
+        # Прогретая служба начинает сбор сразу, иначе - холодный запуск отдельного процесса
+        daemon = await connect_daemon()
+        if daemon is not None:
+            reader, writer = daemon
+            process = None
+            job.pid = "служба"
+        else:
+            process, reader = await start_parser()
+            job.pid = process.pid
         
-        while is_process_running(pid):
-            # Проверяем каждую секунду, но обновляем раз в 30 секунд
-            await asyncio.sleep(1)
+        # Читаем события прогресса, а сообщения редактируем не чаще STATUS_UPDATE_INTERVAL
+        last_update = 0.0
+        last_text = None
+        while True:
+            event = await read_progress_event(reader, STATUS_UPDATE_INTERVAL)
+            if event is None:
+                break
+            if event.get('event') == 'accepted':
+                job.pid = f"{event['pid']} (служба)"
+                continue
+            job.progress.update({key: value for key, value in event.items() if key != 'event'})
             
-            current_time = datetime.now()
-            if (current_time - last_update_time).total_seconds() >= update_interval:
-                # Обновляем статус
-                elapsed = (current_time - start_time).total_seconds()
-                minutes = int(elapsed // 60)
-                seconds = int(elapsed % 60)
-                
-                status_text = (
-                    f"🔄 <b>Парсинг в процессе...</b>\n\n"
-                    f"📺 Сессия: <code>{TMUX_SESSION}</code>\n"
-                    f"🆔 PID: <code>{pid}</code>\n"
-                    f"⏱️ Прошло времени: {minutes}м {seconds}с\n\n"
-                    f"📊 Процесс активен, данные собираются...\n\n"
-                    f"💡 Подключиться: <code>tmux attach -t {TMUX_SESSION}</code>"
+            now = time.monotonic()
+            if event.get('event') != 'done' and now - last_update >= STATUS_UPDATE_INTERVAL:
+                text = format_progress(job.progress, (datetime.now() - job.started).total_seconds(), job.pid)
+                if len(job.subscribers) > 1:
+                    text += f"\n👥 Ждут результат: {len(job.subscribers)}"
+                if text != last_text:
+                    await edit_all(job, text)
+                    last_text = text
+                last_update = now
+        
+        # Служба уже выполняет чужое задание (cron, --recrawl): второй обход рядом с ним
+        # писал бы в тот же журнал, поэтому не запускаемся и не выдаем старый файл за свежий
+        if process is None and job.progress.get('status') == 'busy':
+            writer.close()
+            current_job = None
+            await edit_all(
+                job,
+                "⏳ <b>Парсер занят другим сбором</b>\n\n"
+                "Файл результатов не обновлялся. Попробуйте запустить парсинг чуть позже."
+            )
+            for message, _, _ in job.subscribers:
+                await message.answer(
+                    "Можно повторить запуск, когда текущий сбор закончится.",
+                    reply_markup=get_main_keyboard()
                 )
-                
-                await safe_edit_message(status_msg, status_text, parse_mode="HTML")
-                last_update_time = current_time
+            return
+        
+        if process is not None:
+            return_code = await process.wait()
+            exit_info = f"код выхода {return_code}"
+        else:
+            writer.close()
+            # Служба закрыла сокет без события done - считаем запуск неудачным
+            return_code = 0 if job.progress.get('status') == 'ok' else 1
+            exit_info = "служба"
         
         # Процесс завершился
-        elapsed = (datetime.now() - start_time).total_seconds()
+        elapsed = (datetime.now() - job.started).total_seconds()
         minutes = int(elapsed // 60)
         seconds = int(elapsed % 60)
+        run_status = job.progress.get('status', 'ok' if return_code == 0 else 'error')
         
-        # Удаляем PID файл
-        if os.path.exists(PID_FILE):
-            os.remove(PID_FILE)
+        # Дальше подписчиков не добавляем: новые запросы увидят свежий файл
+        current_job = None
         
         # Обновляем сообщение о завершении
-        await safe_edit_message(
-            status_msg,
-            f"✅ <b>Парсинг завершен!</b>\n\n"
+        await edit_all(
+            job,
+            f"{'✅' if run_status == 'ok' else '⚠️'} <b>Парсинг завершен!</b>\n\n"
             f"⏱️ Время выполнения: {minutes}м {seconds}с\n"
-            f"📺 Сессия: <code>{TMUX_SESSION}</code>\n\n"
-            f"📤 Проверяю файл результатов...",
-            parse_mode="HTML"
+            f"📦 Собрано строк: {job.progress.get('rows', 0)}\n"
+            f"🔚 Статус: <code>{run_status}</code> ({exit_info})\n\n"
+            f"📤 Проверяю файл результатов..."
         )
         
-        # Небольшая задержка
-        await asyncio.sleep(2)
+        # Неудачный запуск файл не обновляет - подписчики получают результат прошлого сбора
+        stale_note = (
+            f"⚠️ Запуск завершился со статусом <code>{run_status}</code>, файл от предыдущего сбора\n\n"
+            if run_status != 'ok' else ""
+        )
         
-        # Отправка файла
-        if os.path.exists(RESULT_FILE):
-            file_size = os.path.getsize(RESULT_FILE) / (1024 * 1024)  # MB
-            
-            try:
-                document = FSInputFile(RESULT_FILE)
-                await message.answer_document(
-                    document=document,
-                    caption=(
+        # Отправка файла: первому подписчику - загрузкой, остальным - по file_id из кэша
+        for message, _, _ in job.subscribers:
+            if os.path.exists(RESULT_FILE):
+                file_size = os.path.getsize(RESULT_FILE) / (1024 * 1024)  # MB
+                try:
+                    await send_result(
+                        message,
                         f"📊 <b>Результаты парсинга</b>\n\n"
+                        f"{stale_note}"
                         f"📁 Размер файла: {file_size:.2f} МБ\n"
                         f"⏱️ Время выполнения: {minutes}м {seconds}с\n"
                         f"📅 Дата: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-                    ),
-                    parse_mode="HTML"
-                )
-                
-                await message.answer(
-                    "✅ <b>Готово!</b>\n\n"
-                    "Вы можете запустить новый парсинг или удалить файл результатов.",
-                    parse_mode="HTML",
-                    reply_markup=get_main_keyboard()
-                )
-            except Exception as e:
+                    )
+                    await message.answer(
+                        "✅ <b>Готово!</b>\n\n"
+                        "Вы можете запустить новый парсинг или удалить файл результатов.",
+                        parse_mode="HTML",
+                        reply_markup=get_main_keyboard()
+                    )
+                except Exception as e:
+                    await message.answer(
+                        f"❌ <b>Ошибка при отправке файла:</b>\n"
+                        f"<code>{str(e)}</code>\n\n",
+                        parse_mode="HTML",
+                        reply_markup=get_main_keyboard()
+                    )
+            else:
                 await message.answer(
-                    f"❌ <b>Ошибка при отправке файла:</b>\n"
-                    f"<code>{str(e)}</code>\n\n",
+                    "⚠️ <b>Файл результатов не найден!</b>\n\n"
+                    "Возможно, произошла ошибка во время парсинга.\n"
+                    f"Проверьте лог: <code>{PARSER_LOG}</code>",
                     parse_mode="HTML",
                     reply_markup=get_main_keyboard()
                 )
-        else:
-            await message.answer(
-                "⚠️ <b>Файл результатов не найден!</b>\n\n"
-                "Возможно, произошла ошибка во время парсинга.\n"
-                f"Проверьте логи: <code>tmux attach -t {TMUX_SESSION}</code>",
-                parse_mode="HTML",
-                reply_markup=get_main_keyboard()
-            )
     
     except Exception as e:
         error_message = (
             f"❌ <b>Критическая ошибка:</b>\n"
             f"<code>{str(e)}</code>\n\n"
             f"Тип: {type(e).__name__}\n\n"
-            f"Проверьте tmux: <code>tmux attach -t {TMUX_SESSION}</code>"
+            f"Проверьте лог: <code>{PARSER_LOG}</code>"
         )
         
-        await safe_edit_message(status_msg, error_message, parse_mode="HTML")
+        await edit_all(job, error_message)
         
+        for message, _, _ in job.subscribers:
+            await message.answer(
+                "Произошла критическая ошибка. Проверьте лог парсера.",
+                reply_markup=get_main_keyboard()
+            )
+    
+    finally:
+        if current_job is job:
+            current_job = None
+        for _, _, state in job.subscribers:
+            await state.set_state(ParsingStates.idle)
+
+
+@dp.message(F.text == "🚀 Запустить парсинг")
+async def start_parsing(message: Message, state: FSMContext):
+    """Запуск парсинга: свежий результат отдается сразу, идущий запуск - общий для всех"""
+    global current_job
+    
+    # Свежий результат уже есть - новый обход не нужен
+    age = result_age_minutes()
+    if current_job is None and age is not None and age < RESULT_FRESHNESS_MINUTES:
+        file_size = os.path.getsize(RESULT_FILE) / (1024 * 1024)  # MB
+        try:
+            await send_result(
+                message,
+                f"📊 <b>Результаты парсинга</b>\n\n"
+                f"📁 Размер файла: {file_size:.2f} МБ\n"
+                f"🕐 Собраны {int(age)} мин назад (новый запуск не нужен, окно свежести {RESULT_FRESHNESS_MINUTES:.0f} мин)"
+            )
+        except Exception as e:
+            await message.answer(
+                f"❌ <b>Ошибка при отправке файла:</b>\n"
+                f"<code>{str(e)}</code>",
+                parse_mode="HTML"
+            )
+        return
+    
+    # Запуск уже идет - подписываемся на его результат
+    if current_job is not None:
+        if any(subscriber.chat.id == message.chat.id for subscriber, _, _ in current_job.subscribers):
+            await message.answer(
+                "⏳ <b>Парсинг уже выполняется!</b>\n\n"
+                "Вы получите файл автоматически после окончания парсинга.",
+                parse_mode="HTML"
+            )
+            return
+        await subscribe(current_job, message, state, joined=True)
+        return
+    
+    job = ParseJob()
+    current_job = job
+    await subscribe(job, message, state, joined=False)
+    job.task = asyncio.create_task(run_parse_job(job))
+
+
+@dp.message(F.text == "📥 Последний файл")
+async def send_last_result(message: Message):
+    """Отправка последнего файла результатов без запуска парсинга"""
+    if not os.path.exists(RESULT_FILE):
         await message.answer(
-            "Произошла критическая ошибка. Проверьте логи в tmux.",
-            reply_markup=get_main_keyboard()
+            "ℹ️ <b>Файл результатов не найден</b>\n\n"
+            "Запустите парсинг, чтобы его создать.",
+            parse_mode="HTML",
+            reply_markup=get_main_keyboard(parsing=current_job is not None)
         )
+        return
     
-    finally:
-        is_parsing = False
-        await state.set_state(ParsingStates.idle)
-        # Очищаем PID файл
-        if os.path.exists(PID_FILE):
-            try:
-                os.remove(PID_FILE)
-            except:
-                pass
+    file_size = os.path.getsize(RESULT_FILE) / (1024 * 1024)  # MB
+    modified = datetime.fromtimestamp(os.path.getmtime(RESULT_FILE))
+    try:
+        await send_result(
+            message,
+            f"📊 <b>Последние результаты парсинга</b>\n\n"
+            f"📁 Размер файла: {file_size:.2f} МБ\n"
+            f"📅 Дата: {modified.strftime('%d.%m.%Y %H:%M')}"
+        )
+    except Exception as e:
+        await message.answer(
+            f"❌ <b>Ошибка при отправке файла:</b>\n"
+            f"<code>{str(e)}</code>",
+            parse_mode="HTML"
+        )
 
 
 @dp.message(F.text == "🗑️ Удалить прошлый файл")
 async def delete_result(message: Message):
     """Удаление файла результатов"""
-    global is_parsing
-    
-    if is_parsing:
+    if current_job is not None:
         await message.answer(
             "⚠️ <b>Невозможно удалить файл во время парсинга!</b>\n"
             "Дождитесь завершения процесса.",
@@ -375,6 +581,12 @@ async def delete_result(message: Message):
             file_size = os.path.getsize(RESULT_FILE) / (1024 * 1024)  # MB
             os.remove(RESULT_FILE)
             
+            # Вместе с файлом очищаем хранилище, из которого он выгружается, его zip и индекс поиска
+            close_search_index()
+            for store_file in [STORE_FILE, STORE_FILE + "-wal", STORE_FILE + "-shm", RESULT_ZIP, SEARCH_FILE]:
+                if os.path.exists(store_file):
+                    os.remove(store_file)
+            
             await message.answer(
                 f"✅ <b>Файл успешно удален!</b>\n\n"
                 f"📁 Удален файл: <code>результат.xlsx</code>\n"
@@ -398,6 +610,139 @@ async def delete_result(message: Message):
         )
 
 
+def close_search_index():
+    """Закрывает соединение с индексом поиска"""
+    if search_index['conn'] is not None:
+        search_index['conn'].close()
+    search_index['conn'] = None
+    search_index['mtime'] = None
+
+
+def open_search_index():
+    """Лениво открывает индекс поиска только для чтения с отображением в память, None - индекса нет"""
+    if not os.path.exists(SEARCH_FILE):
+        close_search_index()
+        return None
+    
+    mtime = os.path.getmtime(SEARCH_FILE)
+    if search_index['conn'] is None or search_index['mtime'] != mtime:
+        close_search_index()
+        # Парсер не меняет файл, а подменяет его целиком, поэтому immutable безопасен и снимает блокировки
+        conn = sqlite3.connect(f"file:{quote(SEARCH_FILE)}?mode=ro&immutable=1", uri=True)
+        conn.execute(f"PRAGMA mmap_size={SEARCH_MMAP_MB * 1024 * 1024}")
+        conn.row_factory = sqlite3.Row
+        search_index['conn'] = conn
+        search_index['mtime'] = mtime
+    return search_index['conn']
+
+
+def find_by_code(conn, code):
+    """Точное совпадение кода, иначе коды с таким началом"""
+    rows = conn.execute("SELECT * FROM items WHERE code = ?", (code,)).fetchall()
+    if rows:
+        return rows
+    return conn.execute(
+        "SELECT * FROM items WHERE code >= ? AND code < ? ORDER BY code LIMIT ?",
+        (code, code + "\uffff", SEARCH_LIMIT + 1)
+    ).fetchall()
+
+
+def search_items(conn, text):
+    """Ищет строки, где встречаются все слова запроса (название, марка стали, НТД)"""
+    terms = text.split()
+    # Триграммный индекс работает со словами от 3 символов, короткие ищутся в search_text:
+    # LIKE и lower() в SQLite не различают регистр только у латиницы, поэтому регистр приводит Python
+    long_terms = [term for term in terms if len(term) >= 3]
+    short_terms = [term for term in terms if len(term) < 3]
+    
+    if long_terms:
+        sql = "SELECT items.* FROM search JOIN items ON items.id = search.rowid WHERE search MATCH ?"
+        params = [" AND ".join('"' + term.replace('"', '""') + '"' for term in long_terms)]
+    else:
+        sql = "SELECT items.* FROM items WHERE 1"
+        params = []
+    for term in short_terms:
+        sql += " AND instr(items.search_text, ?) > 0"
+        params.append(term.lower())
+    # Строки индекса лежат в порядке кода: без сортировки LIMIT останавливает поиск на первых совпадениях
+    sql += " LIMIT ?"
+    params.append(SEARCH_LIMIT + 1)
+    return conn.execute(sql, params).fetchall()
+
+
+def format_items(rows, title):
+    """Форматирует найденные строки для ответа в чате"""
+    lines = [f"{title}\n"]
+    for row in rows[:SEARCH_LIMIT]:
+        name = row['fullname'] or row['shortname'] or ""
+        details = [f"остаток: {row['stock'] if row['stock'] is not None else '—'}"]
+        if row['price'] is not None:
+            details.append(f"цена: {row['price']:.2f} руб")
+        for value in (row['steel'], row['ntd']):
+            if value:
+                details.append(html.escape(value))
+        if row['weight'] is not None:
+            details.append(f"вес: {row['weight']:g}")
+        lines.append(f"<code>{html.escape(row['code'])}</code> {html.escape(name)}\n   {' · '.join(details)}")
+    if len(rows) > SEARCH_LIMIT:
+        lines.append(f"\n… показаны первые {SEARCH_LIMIT}, уточните запрос")
+    return "\n".join(lines)
+
+
+async def answer_search(message: Message, query, lookup, usage):
+    """Выполняет поиск по индексу и отвечает найденными строками"""
+    if not query:
+        await message.answer(usage, parse_mode="HTML")
+        return
+    
+    try:
+        conn = open_search_index()
+        if conn is None:
+            await message.answer(
+                "ℹ️ <b>Индекс поиска не найден</b>\n\n"
+                "Он создается после завершения парсинга.",
+                parse_mode="HTML"
+            )
+            return
+        started = time.perf_counter()
+        rows = lookup(conn, query)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+    except sqlite3.Error as e:
+        close_search_index()
+        await message.answer(
+            f"❌ <b>Ошибка поиска:</b>\n"
+            f"<code>{html.escape(str(e))}</code>",
+            parse_mode="HTML"
+        )
+        return
+    
+    if not rows:
+        await message.answer(f"🔍 Ничего не найдено: <code>{html.escape(query)}</code>", parse_mode="HTML")
+        return
+    await message.answer(
+        format_items(rows, f"🔍 <b>Найдено</b> ({elapsed_ms:.0f} мс):"),
+        parse_mode="HTML"
+    )
+
+
+@dp.message(Command("code"))
+async def cmd_code(message: Message, command: CommandObject):
+    """Поиск номенклатуры по коду: /code 00000012345"""
+    await answer_search(
+        message, (command.args or "").strip(), find_by_code,
+        "ℹ️ Укажите код номенклатуры: <code>/code 00000012345</code>"
+    )
+
+
+@dp.message(Command("find"))
+async def cmd_find(message: Message, command: CommandObject):
+    """Поиск по наименованию, марке стали и НТД: /find тройник 09Г2С"""
+    await answer_search(
+        message, (command.args or "").strip(), search_items,
+        "ℹ️ Укажите слова для поиска: <code>/find тройник 57х4 09Г2С</code>"
+    )
+
+
 @dp.message(F.text.in_(["⏸️ Идет парсинг...", "🚫 Недоступно"]))
 async def parsing_in_progress(message: Message):
     """Обработчик нажатий во время парсинга"""
@@ -415,20 +760,24 @@ async def unknown_command(message: Message):
         "❓ <b>Неизвестная команда</b>\n\n"
         "Используйте кнопки меню для управления ботом.",
         parse_mode="HTML",
-        reply_markup=get_main_keyboard(parsing=is_parsing)
+        reply_markup=get_main_keyboard(parsing=current_job is not None)
     )
 
 
 async def main():
     """Главная функция"""
     print("=" * 60)
-    print("🤖 TELEGRAM BOT - PARSER (TMUX MODE)")
+    print("🤖 TELEGRAM BOT - PARSER")
     print("=" * 60)
     print(f"📂 Рабочая директория: {BASE_DIR}")
     print(f"🐍 Python: {PYTHON_PATH}")
     print(f"📄 Скрипт: {MAIN_SCRIPT}")
     print(f"📊 Файл результатов: {RESULT_FILE}")
-    print(f"📺 Tmux сессия: {TMUX_SESSION}")
+    print(f"📄 Лог парсера: {PARSER_LOG}")
+    print(f"🔎 Индекс поиска: {SEARCH_FILE}")
+    print(f"🛰️ Bot API: {BOT_API_URL or 'api.telegram.org'}")
+    print(f"🔥 Служба парсера: {PARSER_SOCKET} ({'найдена' if os.path.exists(PARSER_SOCKET) else 'нет, запуск отдельным процессом'})")
+    print(f"🕐 Окно свежести результата: {RESULT_FRESHNESS_MINUTES:.0f} мин")
     print("=" * 60)
     print("✅ Проверка окружения...")
     
@@ -445,19 +794,6 @@ async def main():
         print(f"❌ Скрипт не найден: {MAIN_SCRIPT}")
         return
     
-    # Проверка tmux
-    try:
-        subprocess.run(["tmux", "-V"], capture_output=True, check=True, timeout=5)
-        print("✅ Tmux установлен")
-    except:
-        print("❌ Tmux не найден! Установите: apt install tmux")
-        return
-    
-    if check_tmux_session_exists():
-        print(f"✅ Tmux сессия '{TMUX_SESSION}' найдена")
-    else:
-        print(f"⚠️ Tmux сессия '{TMUX_SESSION}' не найдена (будет создана при запуске)")
-    
     print("✅ Все проверки пройдены!")
     print("🚀 Запуск бота...")
     print("=" * 60)
@@ -0,0 +1,131 @@
+import time
+import asyncio
+import argparse
+from aiohttp import web
+
+
+# --- Параметры по умолчанию ---
+DEFAULT_PORT = 8081
+DEFAULT_CHAT = {'id': 1, 'type': "private", 'first_name': "Тест"}
+BOT_USER = {'id': 1000, 'is_bot': True, 'first_name': "Angelina", 'username': "angelina_mock_bot"}
+
+
+# --- Журнал вызовов и выданные file_id ---
+class BotApiState:
+    """Записанные вызовы sendDocument и загруженные файлы (file_id -> имя и размер)"""
+
+    def __init__(self):
+        self.calls = []
+        self.files = {}
+        self.message_id = 0
+
+    def uploads(self):
+        """Вызовы sendDocument, загрузившие файл"""
+        return [call for call in self.calls if call['uploaded']]
+
+    def next_message(self, **fields):
+        """Сообщение с новым message_id в формате Bot API"""
+        self.message_id += 1
+        return {'message_id': self.message_id, 'date': int(time.time()), 'chat': DEFAULT_CHAT, **fields}
+
+
+
+# --- Функция ответа Bot API ---
+def api_result(result):
+    return web.json_response({'ok': True, 'result': result})
+
+
+def api_error(code, description):
+    return web.json_response({'ok': False, 'error_code': code, 'description': description}, status=code)
+
+
+
+# --- Функция обработки sendDocument ---
+async def send_document(state, form):
+    """Загрузка выдает новый file_id, строка document - повторная отправка уже загруженного файла"""
+    document = form.get('document')
+    # aiogram передает файл отдельной частью формы и ссылку на нее вида attach://<имя>
+    if isinstance(document, str) and document.startswith("attach://"):
+        document = form.get(document[len("attach://"):])
+
+    if isinstance(document, web.FileField):
+        size = len(document.file.read())
+        file_id = f"file-{len(state.files) + 1}"
+        state.files[file_id] = {'file_name': document.filename, 'file_size': size}
+        uploaded = True
+    elif document in state.files:
+        file_id = document
+        uploaded = False
+    else:
+        return api_error(400, "Bad Request: wrong file identifier/HTTP URL specified")
+
+    info = state.files[file_id]
+    state.calls.append({
+        'chat_id': form.get('chat_id'), 'uploaded': uploaded, 'file_id': file_id,
+        'file_name': info['file_name'], 'file_size': info['file_size'], 'caption': form.get('caption')
+    })
+    return api_result(state.next_message(
+        document={'file_id': file_id, 'file_unique_id': f"u{file_id}", **info},
+        caption=form.get('caption')
+    ))
+
+
+
+# --- Функция создания приложения ---
+def create_app(state=None):
+    """Приложение, отвечающее на /bot<токен>/<метод> как Bot API"""
+    state = state or BotApiState()
+
+    async def handle(request):
+        method = request.match_info['method']
+        form = await request.post()
+        if method == "sendDocument":
+            return await send_document(state, form)
+        if method == "getMe":
+            return api_result(BOT_USER)
+        # Остальные методы (sendMessage, editMessageText...) - просто сообщение с текстом
+        return api_result(state.next_message(text=form.get('text', "")))
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+
+# --- Функция запуска сервера ---
+async def start_server(port=0, state=None):
+    """Запускает Bot API на 127.0.0.1 и возвращает (runner, адрес); port=0 - любой свободный"""
+    runner = web.AppRunner(create_app(state))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    host, bound_port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{bound_port}"
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API для проверки отправки результатов")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    async def serve():
+        state = BotApiState()
+        runner, url = await start_server(args.port, state)
+        print(f"🧪 Mock Bot API запущен: {url} (BOT_API_URL={url})")
+        try:
+            while True:
+                await asyncio.sleep(3600)
+        finally:
+            print(f"📤 Вызовов sendDocument: {len(state.calls)}, из них загрузок: {len(state.uploads())}")
+            await runner.cleanup()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("\n⚠️ Mock Bot API остановлен")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+
+# --- Параметры по умолчанию ---
+DEFAULT_PORT = 8765
+DEFAULT_ROWS = 5000
+DEFAULT_PAGE_SIZE = 50
+DEFAULT_LATENCY_MS = 200
+DEFAULT_FOLDERS = 0
+ROW_HEIGHT = 40
+SESSION_COOKIE = "mock_session"
+SESSION_VALUE = "ok"
+
+
+# 1x1 прозрачный PNG для иконок копирования (чтобы было что блокировать)
+PIXEL_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Вход</title></head>
+<body>
+<form method="post" action="/login">
+    <input name="email" type="email">
+    <input name="password" type="password">
+    <button type="submit">Войти</button>
+</form>
+</body></html>
+"""
+
+
+NOMENCLATURES_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Номенклатуры</title>
+<style>
+    body { margin: 0; font-family: sans-serif; }
+    .main_content_container { height: 100vh; overflow-y: auto; }
+    .folder_container { min-height: 120px; background: #eee; }
+    .folder_item { display: inline-block; margin: 4px; padding: 2px 6px; cursor: pointer; }
+    .folder_item.active { background: #ccc; }
+    .table_container table { border-collapse: collapse; width: 100%; }
+    .table_container tr { height: __ROW_HEIGHT__px; }
+    .table_container td { padding: 0 4px; white-space: nowrap; overflow: hidden; }
+</style>
+</head><body>
+<div class="main_content_container">
+    <div class="folder_container">Папки номенклатуры</div>
+    <div class="nomenclatures_total">Найдено: __ROWS__</div>
+    <div class="table_container">
+        <table>
+            <thead><tr><th>Код</th><th></th><th>Наименование</th><th>Остаток</th><th>Цена</th><th>НТД</th><th>Марка стали</th><th>Вес</th><th></th></tr></thead>
+            <tbody id="rows"></tbody>
+        </table>
+    </div>
+</div>
+<script>
+    const MODE = "__MODE__";
+    const FOLDERS = __FOLDERS__;
+    const PAGE_SIZE = __PAGE_SIZE__;
+    const ROW_HEIGHT = __ROW_HEIGHT__;
+    const container = document.querySelector('.main_content_container');
+    const tbody = document.getElementById('rows');
+    const counter = document.querySelector('.nomenclatures_total');
+    let total = __ROWS__;
+    let folder = null;
+    let generation = 0;
+
+    const copy = (text) => `<div class="row_width_copy"><span>${text}</span><!--!-->
+<img class="copy_ico" src="/images/copy_ico.png"></div>`;
+    const renderRow = (r) => `<tr id="${r.id}"><td>${r.code}</td>` +
+        `<td shortname="" style="display: none;">${copy(r.shortName)}</td>` +
+        `<td fullname="">${copy(r.fullName)}</td><!--!-->\n` +
+        `<td>${r.rest}</td><!--!-->\n<td>${copy(r.price)}</td>` +
+        `<td style="width: 200px;">${r.ntd}</td><!--!-->\n<td>${r.steel}</td><!--!-->\n` +
+        `<td>${r.weight}</td><td><div class="nomenclatures_table_icons"></div></td></tr>`;
+
+    const fetchRows = async (skip, take) => {
+        const folderParam = folder === null ? '' : `&folder=${folder}`;
+        const response = await fetch(`/api/nomenclatures?skip=${skip}&take=${take}${folderParam}`);
+        const data = await response.json();
+        total = data.total;
+        counter.textContent = `Найдено: ${total}`;
+        return data.items;
+    };
+
+    let reload = () => {};
+    if (FOLDERS > 0) {
+        // Папки: строка i лежит в папке i % FOLDERS, выбор папки перезагружает таблицу с начала
+        const folders = document.querySelector('.folder_container');
+        folders.innerHTML = Array.from({length: FOLDERS}, (_, k) =>
+            `<div class="folder_item" data-id="folder-${k}">Папка ${k + 1}</div>`).join('');
+        folders.querySelectorAll('.folder_item').forEach((item, k) => item.addEventListener('click', () => {
+            folders.querySelectorAll('.folder_item').forEach(other => other.classList.remove('active'));
+            item.classList.add('active');
+            folder = k;
+            generation++;
+            container.scrollTop = 0;
+            tbody.innerHTML = '';
+            reload();
+        }));
+    }
+
+    if (MODE === 'virtual') {
+        // Виртуализация: полная высота задана сразу, в DOM только строки около видимой области
+        const buffer = 10;
+        let requestId = 0;
+        const render = async () => {
+            const id = ++requestId;
+            const visible = Math.ceil(container.clientHeight / ROW_HEIGHT);
+            const first = Math.max(0, Math.floor(container.scrollTop / ROW_HEIGHT) - buffer);
+            const take = Math.max(1, Math.min(total - first, visible + 2 * buffer));
+            const items = await fetchRows(first, take);
+            if (id !== requestId) {
+                return;
+            }
+            const before = first * ROW_HEIGHT;
+            const after = Math.max(0, (total - first - items.length) * ROW_HEIGHT);
+            tbody.innerHTML = `<tr style="height: ${before}px"></tr>` + items.map(renderRow).join('') +
+                `<tr style="height: ${after}px"></tr>`;
+        };
+        let scheduled = false;
+        container.addEventListener('scroll', () => {
+            if (!scheduled) {
+                scheduled = true;
+                requestAnimationFrame(() => { scheduled = false; render(); });
+            }
+        });
+        reload = render;
+        render();
+    } else {
+        // Подгрузка: новые страницы дописываются в конец при приближении к низу
+        let loaded = 0;
+        let loading = false;
+        const check = () => {
+            if (container.scrollTop + container.clientHeight * 2 >= container.scrollHeight) {
+                loadMore();
+            }
+        };
+        const loadMore = async () => {
+            if (loading || loaded >= total) {
+                return;
+            }
+            loading = true;
+            const started = generation;
+            const items = await fetchRows(loaded, PAGE_SIZE);
+            loading = false;
+            if (started !== generation) {
+                // Пока шел запрос, выбрали другую папку
+                loadMore();
+                return;
+            }
+            tbody.insertAdjacentHTML('beforeend', items.map(renderRow).join(''));
+            loaded += items.length;
+            check();
+        };
+        container.addEventListener('scroll', check);
+        reload = () => { loaded = 0; loadMore(); };
+        loadMore();
+    }
+</script>
+</body></html>
+"""
+
+
+
+# --- Функция генерации строки каталога ---
+def make_row(index):
+    """Детерминированно строит запись номенклатуры по номеру"""
+    return {
+        'id': f"00000000-0000-0000-0000-{index:012d}",
+        'code': f"{index:011d}",
+        'shortName': f"П{57 + index % 200}х4-45х3-09Г2С-60 ГОСТ 17376-2001",
+        'fullName': f"Тройник П {57 + index % 200}х4-45х3-09Г2С-60 ГОСТ 17376-2001",
+        'rest': index % 500,
+        'price': f"{100 + index % 9000},50",
+        'ntd': "ГОСТ 17376-2001",
+        'steel': "09Г2С",
+        'weight': f"{(index % 100) / 10:.1f}"
+    }
+
+
+
+# --- Функция создания обработчика запросов ---
+def make_handler(rows, page_size, latency_ms, mode, quiet=True, folders=DEFAULT_FOLDERS):
+    """Создает класс обработчика с заданными размером каталога, задержкой, режимом таблицы и числом папок"""
+    page = (NOMENCLATURES_PAGE
+            .replace("__MODE__", mode)
+            .replace("__FOLDERS__", str(folders))
+            .replace("__ROWS__", str(rows))
+            .replace("__PAGE_SIZE__", str(page_size))
+            .replace("__ROW_HEIGHT__", str(ROW_HEIGHT)))
+
+    class MockPortalHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            if not quiet:
+                super().log_message(format, *args)
+
+        def _send(self, status, body=b"", content_type="text/html; charset=utf-8", headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # Браузер закрыт, пока ответ API ждал задержки - отвечать уже некому
+
+        def _logged_in(self):
+            return f"{SESSION_COOKIE}={SESSION_VALUE}" in self.headers.get("Cookie", "")
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/login":
+                self._send(200, LOGIN_PAGE.encode("utf-8"))
+            elif url.path == "/nomenclatures":
+                if not self._logged_in():
+                    self._send(302, headers={"Location": "/login"})
+                    return
+                self._send(200, page.encode("utf-8"))
+            elif url.path == "/api/nomenclatures":
+                if not self._logged_in():
+                    self._send(401, b"{}", "application/json")
+                    return
+                query = parse_qs(url.query)
+                skip = int(query.get("skip", ["0"])[0])
+                take = min(int(query.get("take", [str(page_size)])[0]), 1000)
+                time.sleep(latency_ms / 1000)
+                indices = range(rows)
+                if folders and query.get("folder"):
+                    indices = range(int(query["folder"][0]), rows, folders)
+                items = [make_row(i) for i in indices[skip:skip + take]]
+                body = json.dumps({'total': len(indices), 'items': items}, ensure_ascii=False).encode("utf-8")
+                self._send(200, body, "application/json; charset=utf-8")
+            elif url.path.startswith("/images/"):
+                self._send(200, PIXEL_PNG, "image/png")
+            else:
+                self._send(404, b"not found", "text/plain")
+
+        def do_POST(self):
+            if urlsplit(self.path).path != "/login":
+                self._send(404, b"not found", "text/plain")
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            form = parse_qs(self.rfile.read(length).decode("utf-8"))
+            if form.get("email", [""])[0] and form.get("password", [""])[0]:
+                self._send(302, headers={
+                    "Location": "/nomenclatures",
+                    "Set-Cookie": f"{SESSION_COOKIE}={SESSION_VALUE}; Path=/"
+                })
+            else:
+                self._send(200, LOGIN_PAGE.encode("utf-8"))
+
+    return MockPortalHandler
+
+
+
+# --- Функция запуска сервера в фоне ---
+def start_server(port=DEFAULT_PORT, rows=DEFAULT_ROWS, page_size=DEFAULT_PAGE_SIZE,
+                 latency_ms=DEFAULT_LATENCY_MS, mode="append", quiet=True, folders=DEFAULT_FOLDERS):
+    """Запускает mock-портал в фоновом потоке и возвращает сервер (server.shutdown() для остановки)"""
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", port), make_handler(rows, page_size, latency_ms, mode, quiet, folders)
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена портала номенклатур для тестов производительности")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="Количество строк каталога")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE, help="Строк в одной подгрузке")
+    parser.add_argument("--latency-ms", type=int, default=DEFAULT_LATENCY_MS, help="Задержка ответа API, мс")
+    parser.add_argument("--mode", choices=["append", "virtual"], default="append",
+                        help="append - строки дописываются при прокрутке, virtual - в DOM только видимые строки")
+    parser.add_argument("--folders", type=int, default=DEFAULT_FOLDERS,
+                        help="Папок каталога (строка i в папке i %% N), 0 - без папок")
+    parser.add_argument("--verbose", action="store_true", help="Печатать журнал запросов")
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.rows, args.page_size, args.latency_ms, args.mode,
+                          quiet=not args.verbose, folders=args.folders)
+    print(f"🧪 Mock-портал запущен: http://127.0.0.1:{args.port}/login")
+    print(f"   Строк: {args.rows}, подгрузка: {args.page_size}, задержка: {args.latency_ms} мс, режим: {args.mode}, папок: {args.folders}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\n⚠️ Mock-портал остановлен")
+        server.shutdown()
+
+
+
+if __name__ == "__main__":
+    main()
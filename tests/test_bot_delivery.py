@@ -0,0 +1,76 @@
+import os
+import sys
+import asyncio
+
+import pytest
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# bot.py создает бота при импорте - ему нужен токен правильного вида
+os.environ.setdefault("API_BOT", "123456:TEST")
+
+import bot as bot_module
+import mock_bot_api
+
+
+@pytest.fixture
+def result_files(tmp_path, monkeypatch):
+    """Файл результата, zip и кэш отправок во временном каталоге"""
+    result = tmp_path / "результат.xlsx"
+    result.write_bytes(b"version 1" * 1000)
+    monkeypatch.setattr(bot_module, "RESULT_FILE", str(result))
+    monkeypatch.setattr(bot_module, "RESULT_ZIP", str(tmp_path / "результат.zip"))
+    monkeypatch.setattr(bot_module, "DELIVERY_CACHE_FILE", str(tmp_path / ".delivery_cache.json"))
+    monkeypatch.setattr(bot_module, "ZIP_THRESHOLD_MB", 5)
+    return result
+
+
+def deliver(times, before_each=None):
+    """Отправляет файл результатов times раз через mock Bot API и возвращает его журнал"""
+    async def run():
+        state = mock_bot_api.BotApiState()
+        runner, url = await mock_bot_api.start_server(state=state)
+        session = AiohttpSession(api=TelegramAPIServer.from_base(url))
+        test_bot = Bot(token=os.environ["API_BOT"], session=session)
+        message = Message.model_validate({
+            'message_id': 1, 'date': 0, 'chat': mock_bot_api.DEFAULT_CHAT, 'text': "📥 Последний файл"
+        }).as_(test_bot)
+        try:
+            for attempt in range(times):
+                if before_each:
+                    before_each(attempt)
+                await bot_module.send_result(message, "📊 Результаты")
+        finally:
+            await session.close()
+            await runner.cleanup()
+        return state
+
+    return asyncio.run(run())
+
+
+def test_repeat_delivery_reuses_file_id(result_files):
+    state = deliver(3)
+    assert [call['uploaded'] for call in state.calls] == [True, False, False]
+    assert {call['file_id'] for call in state.calls} == {"file-1"}
+    assert state.calls[0]['file_name'] == "результат.xlsx"
+
+
+def test_changed_file_is_uploaded_again(result_files):
+    def change_on_second(attempt):
+        if attempt == 1:
+            result_files.write_bytes(b"version 2" * 1000)
+
+    state = deliver(3, change_on_second)
+    assert [call['uploaded'] for call in state.calls] == [True, True, False]
+    assert [call['file_id'] for call in state.calls] == ["file-1", "file-2", "file-2"]
+
+
+def test_large_file_is_sent_as_zip(result_files, monkeypatch):
+    monkeypatch.setattr(bot_module, "ZIP_THRESHOLD_MB", 0.001)
+    state = deliver(2)
+    assert [call['uploaded'] for call in state.calls] == [True, False]
+    assert state.calls[0]['file_name'] == "результат.zip"
+    assert state.calls[0]['file_size'] < os.path.getsize(result_files)